@@ -0,0 +1,85 @@
+import asyncio
+import tracemalloc
+from contextlib import nullcontext
+
+import pytest
+from asgiref.sync import iscoroutinefunction
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from fcm_django.testing import FakeTransport
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--fcm-tokens",
+        default="10000,100000,1000000",
+        help="Comma separated audience sizes for the send benchmarks.",
+    )
+
+
+def pytest_configure(config):
+    # recording the warning for every prepared message would dominate the timings
+    config.addinivalue_line(
+        "filterwarnings", "ignore:Message.token is deprecated:DeprecationWarning"
+    )
+
+
+def pytest_generate_tests(metafunc):
+    if "tokens" in metafunc.fixturenames:
+        sizes = [
+            int(size) for size in metafunc.config.getoption("fcm_tokens").split(",")
+        ]
+        metafunc.parametrize("tokens", sizes, ids=[f"{size}_tokens" for size in sizes])
+
+
+@pytest.fixture
+def fake_transport():
+    with FakeTransport() as transport:
+        yield transport
+
+
+@pytest.fixture
+def measure(benchmark):
+    """
+    Benchmarks ``func`` and records tokens/second, peak memory (tracemalloc) and the
+    number of queries in ``benchmark.extra_info``, which is saved with the
+    baseline. Memory and queries come from an extra, untimed run. Coroutine
+    functions are run with asyncio.run; their queries run on other threads and
+    are not counted. Pass ``count_queries=False`` for code that has no database
+    access.
+
+    :returns the extra info
+    """
+
+    def measure(func, tokens, rounds=3, setup=None, count_queries=True):
+        run = func
+        if iscoroutinefunction(func):
+            count_queries = False
+
+            def run():
+                return asyncio.run(func())
+
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            with (
+                CaptureQueriesContext(connection) if count_queries else nullcontext([])
+            ) as queries:
+                run()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        benchmark.pedantic(run, setup=setup, rounds=rounds, iterations=1)
+        benchmark.extra_info.update(
+            tokens=tokens,
+            tokens_per_second=round(tokens / benchmark.stats.stats.mean),
+            peak_memory_kib=peak_memory // 1024,
+        )
+        if count_queries:
+            benchmark.extra_info["queries"] = len(queries)
+        return benchmark.extra_info
+
+    return measure
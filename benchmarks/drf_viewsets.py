@@ -0,0 +1,120 @@
+"""
+Compare requests/second of the sync DRF device viewsets with their async (adrf)
+counterparts. Sync views are driven from a thread pool, async views from a single
+event loop, both with the same concurrency.
+
+    python benchmarks/drf_viewsets.py --requests 2000 --concurrency 50
+
+Uses a temporary SQLite database unless DATABASE_URL is set; numbers from SQLite
+(which serializes writes) understate what the async views gain on PostgreSQL.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/fcm_django_benchmark.sqlite3"
+)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings.default")
+
+import django  # noqa: E402
+
+django.setup()
+
+from adrf.routers import DefaultRouter as AsyncRouter  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.test import AsyncClient, Client, override_settings  # noqa: E402
+from django.urls import include, path  # noqa: E402
+from rest_framework.routers import DefaultRouter  # noqa: E402
+
+from fcm_django.api.adrf import AsyncFCMDeviceViewSet  # noqa: E402
+from fcm_django.api.rest_framework import FCMDeviceViewSet  # noqa: E402
+
+sync_router = DefaultRouter()
+sync_router.register("devices", FCMDeviceViewSet)
+async_router = AsyncRouter()
+async_router.register("devices", AsyncFCMDeviceViewSet)
+
+urlpatterns = [
+    path("sync/", include(sync_router.urls)),
+    path("async/", include(async_router.urls)),
+]
+
+
+def _register_payload(prefix, i):
+    return {"registration_id": f"{prefix}-token-{i}", "type": "android"}
+
+
+def run_sync(prefix, requests, concurrency):
+    client = Client()
+
+    def register(i):
+        response = client.post(f"/{prefix}/devices/", _register_payload(prefix, i))
+        assert response.status_code == 201, response.content
+
+    def retrieve(i):
+        response = client.get(f"/{prefix}/devices/{prefix}-token-{i}/")
+        assert response.status_code == 200, response.content
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for name, func in (("register", register), ("retrieve", retrieve)):
+            started = time.perf_counter()
+            list(executor.map(func, range(requests)))
+            results[name] = requests / (time.perf_counter() - started)
+    return results
+
+
+async def run_async(prefix, requests, concurrency):
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def register(i):
+        async with semaphore:
+            response = await client.post(
+                f"/{prefix}/devices/", _register_payload(prefix, i)
+            )
+        assert response.status_code == 201, response.content
+
+    async def retrieve(i):
+        async with semaphore:
+            response = await client.get(f"/{prefix}/devices/{prefix}-token-{i}/")
+        assert response.status_code == 200, response.content
+
+    results = {}
+    for name, func in (("register", register), ("retrieve", retrieve)):
+        started = time.perf_counter()
+        await asyncio.gather(*(func(i) for i in range(requests)))
+        results[name] = requests / (time.perf_counter() - started)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    database = settings.DATABASES["default"]
+    if database["ENGINE"] == "django.db.backends.sqlite3":
+        database.setdefault("OPTIONS", {})["timeout"] = 60
+    call_command("migrate", verbosity=0)
+
+    with override_settings(ROOT_URLCONF=__name__):
+        sync_results = run_sync("sync", args.requests, args.concurrency)
+        async_results = asyncio.run(run_async("async", args.requests, args.concurrency))
+
+    print(f"{'endpoint':<10} {'sync req/s':>12} {'async req/s':>12}")
+    for name in sync_results:
+        print(f"{name:<10} {sync_results[name]:>12.1f} {async_results[name]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
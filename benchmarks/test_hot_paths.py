@@ -0,0 +1,182 @@
+"""
+Benchmarks of the send, personalize and deactivate hot paths against a fake FCM
+transport, so only fcm-django's own work (message preparation, response handling,
+database queries) is measured.
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:20%
+
+Audience sizes default to 10k, 100k and 1M tokens (``--fcm-tokens 10000,100000`` to
+change them). Each benchmark saves tokens/second, peak memory and its query count
+with the baseline, and the query counts are asserted, so an extra query per batch
+or per device fails the suite outright.
+"""
+
+import pytest
+import swapper
+from firebase_admin import messaging
+
+from fcm_django.models import DeviceType
+from fcm_django.types import FirebaseResponseDict
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+# one token in FAILURE_EVERY comes back UNREGISTERED
+FAILURE_EVERY = 100
+
+
+def _rounds(tokens: int) -> int:
+    return 3 if tokens <= 100_000 else 1
+
+
+def _registration_ids(tokens: int) -> list[str]:
+    return [f"benchmark-token-{i}" for i in range(tokens)]
+
+
+def _create_devices(registration_ids: list[str]) -> None:
+    FCMDevice.objects.bulk_create(
+        (
+            FCMDevice(registration_id=registration_id, type=DeviceType.ANDROID)
+            for registration_id in registration_ids
+        ),
+        batch_size=1000,
+    )
+
+
+@pytest.fixture
+def audience(fake_transport, tokens):
+    """Tokens to send to, with the failing ones stored as active devices."""
+    registration_ids = _registration_ids(tokens)
+    failing = registration_ids[::FAILURE_EVERY]
+    fake_transport.failing = frozenset(failing)
+    _create_devices(failing)
+    return registration_ids
+
+
+def _reactivate_devices():
+    FCMDevice.objects.update(active=True)
+
+
+@pytest.mark.django_db
+def test_send_message(measure, audience, tokens):
+    info = measure(
+        lambda: FCMDevice.objects.send_message(
+            messaging.Message(data={"campaign": "benchmark"}),
+            skip_registration_id_lookup=True,
+            additional_registration_ids=audience,
+        ),
+        tokens,
+        rounds=_rounds(tokens),
+        setup=_reactivate_devices,
+    )
+
+    # one SELECT and one UPDATE to deactivate the failed devices
+    assert info["queries"] == 2
+
+
+@pytest.mark.django_db
+def test_send_message_to_queryset(measure, fake_transport):
+    tokens = 10_000
+    _create_devices(_registration_ids(tokens))
+
+    info = measure(
+        lambda: FCMDevice.objects.send_message(messaging.Message()),
+        tokens,
+    )
+
+    assert info["queries"] == 1
+
+
+@pytest.mark.django_db
+def test_asend_message(measure, fake_transport, tokens):
+    registration_ids = _registration_ids(tokens)
+
+    async def asend_message():
+        return await FCMDevice.objects.asend_message(
+            messaging.Message(data={"campaign": "benchmark"}),
+            skip_registration_id_lookup=True,
+            additional_registration_ids=registration_ids,
+        )
+
+    measure(asend_message, tokens, rounds=_rounds(tokens))
+
+
+@pytest.mark.django_db
+def test_send_bulk_personalized_messages(measure, audience, tokens):
+    message_data = {
+        registration_id: {"name": f"user {i}", "count": i}
+        for i, registration_id in enumerate(audience)
+    }
+
+    info = measure(
+        lambda: FCMDevice.objects.send_bulk_personalized_messages(
+            title_template="Hi {name}",
+            body_template="You have {count} new messages",
+            message_data=message_data,
+            data_fields={"campaign": "benchmark"},
+            skip_registration_id_lookup=True,
+            additional_registration_ids=audience,
+        ),
+        tokens,
+        rounds=_rounds(tokens),
+        setup=_reactivate_devices,
+    )
+
+    assert info["queries"] == 2
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("failures", [1_000, 10_000, 25_000])
+def test_deactivate_devices_with_error_results(measure, failures):
+    registration_ids = _registration_ids(failures)
+    _create_devices(registration_ids)
+    error = messaging.SendResponse(
+        None, messaging.UnregisteredError("Requested entity was not found.")
+    )
+    results = [error] * failures
+
+    info = measure(
+        lambda: FCMDevice.objects.deactivate_devices_with_error_results(
+            registration_ids, results
+        ),
+        failures,
+        setup=_reactivate_devices,
+    )
+
+    assert info["queries"] == 2
+
+
+@pytest.mark.django_db
+def test_handle_topic_subscription(measure, audience, tokens):
+    info = measure(
+        lambda: FCMDevice.objects.handle_topic_subscription(
+            True,
+            "benchmark",
+            skip_registration_id_lookup=True,
+            additional_registration_ids=audience,
+        ),
+        tokens,
+        rounds=_rounds(tokens),
+        setup=_reactivate_devices,
+    )
+
+    assert info["queries"] <= 2
+
+
+def test_firebase_response_dict_summary(measure, tokens):
+    registration_ids = _registration_ids(tokens)
+    ok = messaging.SendResponse({"name": "projects/p/messages/1"}, None)
+    error = messaging.SendResponse(
+        None, messaging.UnregisteredError("Requested entity was not found.")
+    )
+    response = FirebaseResponseDict(
+        response=messaging.BatchResponse(
+            [error if i % FAILURE_EVERY == 0 else ok for i in range(tokens)]
+        ),
+        registration_ids_sent=registration_ids,
+        deactivated_registration_ids=registration_ids[::FAILURE_EVERY],
+    )
+
+    measure(
+        lambda: response.summary, tokens, rounds=_rounds(tokens), count_queries=False
+    )
@@ -14,6 +14,13 @@ from firebase_admin.messaging import (
     TopicManagementResponse,
 )
 
+from fcm_django.batching import bypass_notification_buffer
+from fcm_django.caching import (
+    discard_dead_tokens,
+    get_dead_token_cache,
+    get_registration_id_cache,
+    invalidate_user_registration_ids,
+)
 from fcm_django.models import fcm_error_list
 from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
 from fcm_django.types import FirebaseResponseDict
@@ -138,32 +145,31 @@ class DeviceAdmin(admin.ModelAdmin):
         single_responses: list[tuple[SendResponse, str]] = []
 
         try:
-            for device in queryset:
-                device: "FCMDevice"
-                if bulk:
-                    response = queryset.send_message(
-                        Message(
-                            notification=Notification(
-                                title="Test notification", body="Test bulk notification"
-                            )
+            if bulk:
+                response = queryset.send_message(
+                    Message(
+                        notification=Notification(
+                            title="Test notification", body="Test bulk notification"
                         )
                     )
-                    total_failure = len(response.deactivated_registration_ids)
-                    return self._send_deactivated_message(
-                        request, response, total_failure, False
-                    )
-                else:
-                    response = device.send_message(
-                        Message(
-                            notification=Notification(
-                                title="Test notification",
-                                body="Test single notification",
-                            )
+                )
+                total_failure = len(response.deactivated_registration_ids)
+                return self._send_deactivated_message(
+                    request, response, total_failure, False
+                )
+            for device in queryset:
+                device: "FCMDevice"
+                response = device.send_message(
+                    Message(
+                        notification=Notification(
+                            title="Test notification",
+                            body="Test single notification",
                         )
                     )
-                    single_responses.append((response, device.registration_id))
-                    if type(response) != SendResponse:
-                        total_failure += 1
+                )
+                single_responses.append((response, device.registration_id))
+                if type(response) != SendResponse:
+                    total_failure += 1
         except FirebaseError as exc:
             self.message_user(request, str(exc), level=messages.ERROR)
             return
@@ -171,12 +177,15 @@ class DeviceAdmin(admin.ModelAdmin):
         self._send_deactivated_message(request, single_responses, total_failure, False)
 
     def send_message(self, request, queryset):
-        self.send_messages(request, queryset)
+        # Test notifications report their results, so they are never buffered
+        with bypass_notification_buffer():
+            self.send_messages(request, queryset)
 
     send_message.short_description = _("Send test notification")
 
     def send_bulk_message(self, request, queryset):
-        self.send_messages(request, queryset, True)
+        with bypass_notification_buffer():
+            self.send_messages(request, queryset, True)
 
     send_bulk_message.short_description = _("Send test notification in bulk")
 
@@ -190,20 +199,19 @@ class DeviceAdmin(admin.ModelAdmin):
         total_failure = 0
         single_responses = []
 
-        for device in queryset:
-            device: "FCMDevice"
-            if bulk:
-                response: "FirebaseResponseDict" = queryset.handle_topic_subscription(
-                    should_subscribe,
-                    "test-topic",
-                )
-                total_failure = response.response.failure_count
-                single_responses = [
-                    (x, response.registration_ids_sent[x.index])
-                    for x in response.response.errors
-                ]
-                break
-            else:
+        if bulk:
+            response: "FirebaseResponseDict" = queryset.handle_topic_subscription(
+                should_subscribe,
+                "test-topic",
+            )
+            total_failure = response.response.failure_count
+            single_responses = [
+                (x, response.registration_ids_sent[x.index])
+                for x in response.response.errors
+            ]
+        else:
+            for device in queryset:
+                device: "FCMDevice"
                 response = device.handle_topic_subscription(
                     should_subscribe,
                     "test-topic",
@@ -261,7 +269,20 @@ class DeviceAdmin(admin.ModelAdmin):
     send_topic_message.short_description = _("Send message test topic")
 
     def enable(self, request, queryset):
+        # read before the update, as the changelist may be filtered on active=False
+        user_ids = (
+            list(queryset.values_list("user_id", flat=True))
+            if get_registration_id_cache() is not None
+            else []
+        )
+        registration_ids = (
+            list(queryset.values_list("registration_id", flat=True))
+            if get_dead_token_cache()
+            else []
+        )
         queryset.update(active=True)
+        invalidate_user_registration_ids(queryset.model, user_ids, queryset.db)
+        discard_dead_tokens(registration_ids)
 
     enable.short_description = _("Enable selected devices")
 
@@ -0,0 +1,296 @@
+import swapper
+from adrf.generics import aget_object_or_404
+from adrf.serializers import ModelSerializer, Serializer
+from adrf.viewsets import GenericViewSet, ModelViewSet
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+from django.db.models import Q
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.fields import SerializerMethodField
+from rest_framework.relations import RelatedField
+from rest_framework.response import Response
+from rest_framework.serializers import ValidationError, as_serializer_error
+from rest_framework.validators import UniqueValidator
+
+from fcm_django.api.rest_framework import (
+    AuthorizedMixin,
+    BulkDeviceViewSetMixin,
+    DeviceSerializerMixin,
+    DeviceViewSetMixin,
+    RefreshRegistrationIdSerializer,
+    UniqueRegistrationSerializerMixin,
+)
+from fcm_django.fields import hash_registration_id
+from fcm_django.models import get_last_seen_kwargs
+from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+# Serializers
+class AsyncUniqueRegistrationSerializerMixin(
+    Serializer, UniqueRegistrationSerializerMixin
+):
+    """
+    Async counterpart of ``UniqueRegistrationSerializerMixin``. ``ais_valid`` runs
+    the registration_id checks on the async ORM, a sync ``is_valid`` runs them in
+    ``validate``.
+    """
+
+    _validating_async = False
+
+    def build_standard_field(self, field_name, model_field):
+        field_class, field_kwargs = super().build_standard_field(
+            field_name, model_field
+        )
+        if field_name == "registration_id":
+            # run by validate, or replaced by avalidate_registration_id
+            validators = field_kwargs.get("validators", [])
+            self._registration_id_unique_validators = [
+                validator
+                for validator in validators
+                if isinstance(validator, UniqueValidator)
+            ]
+            field_kwargs["validators"] = [
+                validator
+                for validator in validators
+                if not isinstance(validator, UniqueValidator)
+            ]
+        return field_class, field_kwargs
+
+    def validate(self, attrs):
+        if self._validating_async:
+            # checked by avalidate_registration_id
+            return attrs
+        if "registration_id" in attrs:
+            for validator in getattr(self, "_registration_id_unique_validators", []):
+                try:
+                    validator(attrs["registration_id"], self.fields["registration_id"])
+                except ValidationError as exc:
+                    raise ValidationError({"registration_id": exc.detail})
+        return super().validate(attrs)
+
+    async def ais_valid(self, *, raise_exception=False):
+        self._validating_async = True
+        try:
+            is_valid = self.is_valid()
+        finally:
+            self._validating_async = False
+        if is_valid:
+            try:
+                await self.avalidate_registration_id(self.validated_data)
+            except ValidationError as exc:
+                self._validated_data = {}
+                self._errors = as_serializer_error(exc)
+        if self._errors and raise_exception:
+            raise ValidationError(self.errors)
+        return not bool(self._errors)
+
+    async def avalidate_registration_id(self, attrs):
+        if self.context.get("upsert"):
+            return
+
+        devices = None
+        request_method, primary_key = self.get_registration_request_method()
+
+        Device = self.Meta.model
+        user = self.context["request"].user
+        registration_id = attrs.get("registration_id")
+
+        if request_method == "update":
+            if registration_id:
+                devices = Device.objects.filter_by_registration_id(
+                    registration_id
+                ).exclude(id=primary_key)
+                if user is not None and user.is_authenticated:
+                    if attrs.get("active", False):
+                        await devices.filter(~Q(user=user)).adeactivate(
+                            reason="duplicate_registration_id",
+                            source="serializer_update",
+                            metadata={
+                                "request_method": request_method,
+                                "target_user_id": user.id,
+                            },
+                        )
+                    devices = devices.filter(user=user)
+        elif request_method == "create":
+            devices = Device.objects.filter_by_registration_id(registration_id)
+            if user is not None and user.is_authenticated:
+                await devices.filter(~Q(user=user)).adeactivate(
+                    reason="duplicate_registration_id",
+                    source="serializer_create",
+                    metadata={
+                        "request_method": request_method,
+                        "target_user_id": user.id,
+                    },
+                )
+                devices = devices.filter(user=user, active=True)
+
+        if devices is not None and await devices.aexists():
+            raise ValidationError({"registration_id": "This field must be unique."})
+
+
+class AsyncFCMDeviceSerializer(AsyncUniqueRegistrationSerializerMixin, ModelSerializer):
+    class Meta(DeviceSerializerMixin.Meta):
+        model = FCMDevice
+
+        extra_kwargs = {"id": {"read_only": True, "required": False}}
+        extra_kwargs.update(DeviceSerializerMixin.Meta.extra_kwargs)
+
+    async def ato_representation(self, instance):
+        if any(
+            isinstance(field, (RelatedField, SerializerMethodField))
+            for field in self._readable_fields
+        ):
+            return await super().ato_representation(instance)
+        # plain model fields never touch the database, so skip the thread hop
+        # adrf makes for every field
+        return self.to_representation(instance)
+
+
+# Mixins
+class AsyncDeviceViewSetMixin(DeviceViewSetMixin):
+    """
+    Async counterpart of ``DeviceViewSetMixin``, for adrf viewsets.
+    """
+
+    async def acreate(self, request, *args, **kwargs):
+        if self.use_upsert(request):
+            return await self.aupsert(request, *args, **kwargs)
+
+        serializer = None
+        is_update = False
+        if (
+            SETTINGS.get("UPDATE_ON_DUPLICATE_REG_ID")
+            and "registration_id" in request.data
+        ):
+            instance = await self.queryset.model.objects.filter_by_registration_id(
+                request.data["registration_id"]
+            ).afirst()
+            if instance:
+                serializer = self.get_serializer(instance, data=request.data)
+                is_update = True
+        if not serializer:
+            serializer = self.get_serializer(data=request.data)
+
+        await serializer.ais_valid(raise_exception=True)
+        if is_update:
+            await self.perform_aupdate(serializer)
+            return Response(await serializer.adata)
+        else:
+            await self.perform_acreate(serializer)
+            data = await serializer.adata
+            headers = self.get_success_headers(data)
+            return Response(data, status=status.HTTP_201_CREATED, headers=headers)
+
+    async def aupdate(self, request, *args, **kwargs):
+        # adrf validates updates with the sync is_valid, which skips the
+        # registration_id checks of ais_valid
+        partial = kwargs.pop("partial", False)
+        instance = await self.aget_object()
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        await serializer.ais_valid(raise_exception=True)
+        await self.perform_aupdate(serializer)
+        return Response(await serializer.adata)
+
+    @action(detail=False, methods=["post"])
+    async def refresh(self, request, *args, **kwargs):
+        serializer = RefreshRegistrationIdSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        registration_id = serializer.validated_data["registration_id"]
+        queryset = self.get_queryset()
+        try:
+            replaced = await queryset.areplace_token(
+                serializer.validated_data["old_registration_id"], registration_id
+            )
+        except IntegrityError:
+            raise ValidationError({"registration_id": ["This field must be unique."]})
+        if not replaced:
+            raise NotFound()
+        instance = await queryset.filter_by_registration_id(registration_id).aget()
+        return Response(await self.get_serializer(instance).adata)
+
+    async def aupsert(self, request, *args, **kwargs):
+        serializer = self.get_upsert_serializer(data=request.data)
+        await serializer.ais_valid(raise_exception=True)
+
+        instance = await self.queryset.model.objects.filter_by_registration_id(
+            serializer.validated_data["registration_id"]
+        ).afirst()
+        await sync_to_async(self.perform_upsert)(serializer, instance)
+        data = await serializer.adata
+        if instance is not None:
+            return Response(data)
+        headers = self.get_success_headers(data)
+        return Response(data, status=status.HTTP_201_CREATED, headers=headers)
+
+    async def aget_object(self):
+        if self.lookup_field != "registration_id":
+            return await super().aget_object()
+        # Look registration IDs up through their indexed hash
+        queryset = await self.afilter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        obj = await aget_object_or_404(
+            queryset,
+            registration_id_hash=hash_registration_id(self.kwargs[lookup_url_kwarg]),
+        )
+        await sync_to_async(self.check_object_permissions)(self.request, obj)
+        return obj
+
+    async def afilter_queryset(self, queryset):
+        queryset = await super().afilter_queryset(queryset)
+        if self.action == "alist":
+            lean_fields = self.get_lean_list_fields()
+            if lean_fields:
+                queryset = queryset.values(*lean_fields)
+        return queryset
+
+    async def perform_acreate(self, serializer):
+        if self.request.user.is_authenticated:
+            if SETTINGS["ONE_DEVICE_PER_USER"] and self.request.data.get(
+                "active", True
+            ):
+                await FCMDevice.objects.filter(user=self.request.user).adeactivate(
+                    reason="one_device_per_user",
+                    source="perform_create",
+                    metadata={"user_id": self.request.user.id},
+                )
+            return await serializer.asave(
+                user=self.request.user, **get_last_seen_kwargs()
+            )
+        return await serializer.asave(**get_last_seen_kwargs())
+
+    async def perform_aupdate(self, serializer):
+        if self.request.user.is_authenticated:
+            if SETTINGS["ONE_DEVICE_PER_USER"] and self.request.data.get(
+                "active", False
+            ):
+                await FCMDevice.objects.filter(user=self.request.user).adeactivate(
+                    reason="one_device_per_user",
+                    source="perform_update",
+                    metadata={"user_id": self.request.user.id},
+                )
+
+            return await serializer.asave(
+                user=self.request.user, **get_last_seen_kwargs()
+            )
+        return await serializer.asave(**get_last_seen_kwargs())
+
+
+# ViewSets
+class AsyncFCMDeviceViewSet(
+    BulkDeviceViewSetMixin, AsyncDeviceViewSetMixin, ModelViewSet
+):
+    queryset = FCMDevice.objects.order_by("-id")
+    serializer_class = AsyncFCMDeviceSerializer
+
+
+class AsyncFCMDeviceCreateOnlyViewSet(AsyncDeviceViewSetMixin, GenericViewSet):
+    queryset = FCMDevice.objects.all()
+    serializer_class = AsyncFCMDeviceSerializer
+
+
+class AsyncFCMDeviceAuthorizedViewSet(AuthorizedMixin, AsyncFCMDeviceViewSet):
+    pass
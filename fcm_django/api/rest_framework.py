@@ -1,11 +1,25 @@
+from typing import Optional
+
 import swapper
+from django.db import IntegrityError, connections, router, transaction
 from django.db.models import Q
 from rest_framework import permissions, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.fields import CharField, ListField, SerializerMethodField
+from rest_framework.generics import get_object_or_404
 from rest_framework.mixins import CreateModelMixin
+from rest_framework.pagination import CursorPagination
+from rest_framework.relations import RelatedField
 from rest_framework.response import Response
 from rest_framework.serializers import ModelSerializer, Serializer, ValidationError
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueValidator
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 
+from fcm_django.caching import discard_dead_tokens, invalidate_user_registration_ids
+from fcm_django.fields import hash_registration_id
+from fcm_django.models import get_last_seen_kwargs
 from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
 
 FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
@@ -29,23 +43,28 @@ class DeviceSerializerMixin(ModelSerializer):
 
 
 class UniqueRegistrationSerializerMixin(Serializer):
-    def validate(self, attrs):
-        devices = None
-        primary_key = None
-        request_method = None
-
+    def get_registration_request_method(self):
+        """
+        Returns whether the serializer creates or updates a device, and the
+        primary key of the device being updated.
+        """
         if self.initial_data.get("registration_id", None):
             if self.instance:
-                request_method = "update"
-                primary_key = self.instance.id
-            else:
-                request_method = "create"
-        else:
-            if self.context["request"].method in ["PUT", "PATCH"]:
-                request_method = "update"
-                primary_key = self.instance.id
-            elif self.context["request"].method == "POST":
-                request_method = "create"
+                return "update", self.instance.id
+            return "create", None
+        if self.context["request"].method in ["PUT", "PATCH"]:
+            return "update", self.instance.id
+        if self.context["request"].method == "POST":
+            return "create", None
+        return None, None
+
+    def validate(self, attrs):
+        if self.context.get("upsert"):
+            # the upsert reassigns the device owning the registration_id itself
+            return attrs
+
+        devices = None
+        request_method, primary_key = self.get_registration_request_method()
 
         Device = self.Meta.model
         # if request authenticated, unique together with registration_id and
@@ -56,8 +75,8 @@ class UniqueRegistrationSerializerMixin(Serializer):
         if request_method == "update":
             if registration_id:
                 if user is not None and user.is_authenticated:
-                    devices = Device.objects.filter(
-                        registration_id=registration_id
+                    devices = Device.objects.filter_by_registration_id(
+                        registration_id
                     ).exclude(id=primary_key)
                     if attrs.get("active", False):
                         devices.filter(~Q(user=user)).deactivate(
@@ -70,12 +89,12 @@ class UniqueRegistrationSerializerMixin(Serializer):
                         )
                     devices = devices.filter(user=user)
                 else:
-                    devices = Device.objects.filter(
-                        registration_id=registration_id
+                    devices = Device.objects.filter_by_registration_id(
+                        registration_id
                     ).exclude(id=primary_key)
         elif request_method == "create":
             if user is not None and user.is_authenticated:
-                devices = Device.objects.filter(registration_id=registration_id)
+                devices = Device.objects.filter_by_registration_id(registration_id)
                 devices.filter(~Q(user=user)).deactivate(
                     reason="duplicate_registration_id",
                     source="serializer_create",
@@ -86,9 +105,9 @@ class UniqueRegistrationSerializerMixin(Serializer):
                 )
                 devices = devices.filter(user=user, active=True)
             else:
-                devices = Device.objects.filter(registration_id=registration_id)
+                devices = Device.objects.filter_by_registration_id(registration_id)
 
-        if devices:
+        if devices is not None and devices.exists():
             raise ValidationError({"registration_id": "This field must be unique."})
         return attrs
 
@@ -101,6 +120,28 @@ class FCMDeviceSerializer(ModelSerializer, UniqueRegistrationSerializerMixin):
         extra_kwargs.update(DeviceSerializerMixin.Meta.extra_kwargs)
 
 
+class RegistrationIdListSerializer(Serializer):
+    registration_ids = ListField(child=CharField(), allow_empty=False)
+
+
+class RefreshRegistrationIdSerializer(Serializer):
+    old_registration_id = CharField()
+    registration_id = CharField()
+
+
+# Pagination
+class DeviceCursorPagination(CursorPagination):
+    """
+    Keyset pagination on ``-id``: every page is a single indexed range scan, no
+    matter how deep into the device table it is.
+    """
+
+    ordering = "-id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
 # Permissions
 class IsOwner(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
@@ -113,14 +154,17 @@ class DeviceViewSetMixin:
     lookup_field = "registration_id"
 
     def create(self, request, *args, **kwargs):
+        if self.use_upsert(request):
+            return self.upsert(request, *args, **kwargs)
+
         serializer = None
         is_update = False
         if (
             SETTINGS.get("UPDATE_ON_DUPLICATE_REG_ID")
             and "registration_id" in request.data
         ):
-            instance = self.queryset.model.objects.filter(
-                registration_id=request.data["registration_id"]
+            instance = self.queryset.model.objects.filter_by_registration_id(
+                request.data["registration_id"]
             ).first()
             if instance:
                 serializer = self.get_serializer(instance, data=request.data)
@@ -139,6 +183,186 @@ class DeviceViewSetMixin:
                 serializer.data, status=status.HTTP_201_CREATED, headers=headers
             )
 
+    @action(detail=False, methods=["post"])
+    def refresh(self, request, *args, **kwargs):
+        """
+        Replaces a rotated registration ID (``old_registration_id``) with the new
+        one (``registration_id``) on the existing device.
+        """
+        serializer = RefreshRegistrationIdSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        registration_id = serializer.validated_data["registration_id"]
+        queryset = self.get_queryset()
+        try:
+            replaced = queryset.replace_token(
+                serializer.validated_data["old_registration_id"], registration_id
+            )
+        except IntegrityError:
+            raise ValidationError({"registration_id": ["This field must be unique."]})
+        if not replaced:
+            raise NotFound()
+        instance = queryset.filter_by_registration_id(registration_id).get()
+        return Response(self.get_serializer(instance).data)
+
+    # opt in to serialize list responses from ``values()`` rows when the
+    # serializer only reads plain model fields
+    lean_list_serialization = False
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action == "list":
+            lean_fields = self.get_lean_list_fields()
+            if lean_fields:
+                queryset = queryset.values(*lean_fields)
+        return queryset
+
+    def get_lean_list_fields(self) -> Optional[list[str]]:
+        """
+        Returns the model fields to select with ``values()`` for list responses,
+        or None when the serializer needs model instances.
+        """
+        if not self.lean_list_serialization:
+            return None
+        model_fields = {
+            field.name: field
+            for field in self.queryset.model._meta.concrete_fields
+            if not field.is_relation
+        }
+        sources = []
+        for field in self.get_serializer().fields.values():
+            if field.write_only:
+                continue
+            if field.source not in model_fields or isinstance(
+                field, (RelatedField, SerializerMethodField)
+            ):
+                return None
+            sources.append(field.source)
+        # the cursor of a cursor pagination is read from the rows too
+        ordering = getattr(self.paginator, "ordering", None) or ()
+        for field_name in [ordering] if isinstance(ordering, str) else ordering:
+            field_name = field_name.lstrip("-")
+            if field_name not in model_fields:
+                return None
+            if field_name not in sources:
+                sources.append(field_name)
+        return sources
+
+    def use_upsert(self, request) -> bool:
+        if not (
+            SETTINGS["UPSERT_DEVICE_REGISTRATION"]
+            and SETTINGS.get("UPDATE_ON_DUPLICATE_REG_ID")
+            and "registration_id" in request.data
+        ):
+            return False
+        Device = self.queryset.model
+        connection = connections[router.db_for_write(Device)]
+        return connection.features.supports_update_conflicts
+
+    def get_upsert_serializer(self, *args, **kwargs):
+        """
+        Returns a serializer that skips the registration_id uniqueness checks, for
+        writes that update the device already owning a registration_id instead.
+        """
+        kwargs["context"] = {**self.get_serializer_context(), "upsert": True}
+        serializer = self.get_serializer(*args, **kwargs)
+        fields = serializer.child.fields if kwargs.get("many") else serializer.fields
+        registration_id_field = fields.get("registration_id")
+        if registration_id_field is not None:
+            registration_id_field.validators = [
+                validator
+                for validator in registration_id_field.validators
+                if not isinstance(validator, UniqueValidator)
+            ]
+        return serializer
+
+    def upsert(self, request, *args, **kwargs):
+        """
+        Registers a device with a single ``INSERT ... ON CONFLICT`` on the
+        registration ID hash, which updates (and reassigns) the device already
+        owning the registration ID instead of failing.
+        """
+        serializer = self.get_upsert_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        instance = self.queryset.model.objects.filter_by_registration_id(
+            serializer.validated_data["registration_id"]
+        ).first()
+        self.perform_upsert(serializer, instance)
+        if instance is not None:
+            return Response(serializer.data)
+        headers = self.get_success_headers(serializer.data)
+        return Response(
+            serializer.data, status=status.HTTP_201_CREATED, headers=headers
+        )
+
+    def perform_upsert(self, serializer, instance=None):
+        Device = self.queryset.model
+        attrs = {**serializer.validated_data, **get_last_seen_kwargs()}
+        if self.request.user.is_authenticated:
+            attrs["user"] = self.request.user
+            if SETTINGS["ONE_DEVICE_PER_USER"] and self.request.data.get(
+                "active", instance is None
+            ):
+                Device.objects.filter(user=self.request.user).exclude(
+                    registration_id_hash=hash_registration_id(attrs["registration_id"])
+                ).deactivate(
+                    reason="one_device_per_user",
+                    source="perform_upsert",
+                    metadata={"user_id": self.request.user.id},
+                )
+
+        connection = connections[router.db_for_write(Device)]
+        device = Device(**attrs)
+        # the upsert may move the device away from its previous user
+        user_ids = [device.user_id, instance.user_id if instance is not None else None]
+        Device.objects.bulk_create(
+            [device],
+            update_conflicts=True,
+            unique_fields=(
+                ["registration_id_hash"]
+                if connection.features.supports_update_conflicts_with_target
+                else None
+            ),
+            update_fields=[
+                *attrs,
+                *(
+                    field.name
+                    for field in Device._meta.concrete_fields
+                    if getattr(field, "auto_now", False) and field.name not in attrs
+                ),
+            ],
+        )
+
+        invalidate_user_registration_ids(Device, user_ids)
+        if device.active:
+            discard_dead_tokens([device.registration_id])
+
+        if instance is not None:
+            for attr, value in attrs.items():
+                setattr(instance, attr, value)
+            device = instance
+        elif device.pk is None:
+            # backends that cannot return the primary key of an upserted row
+            device.pk = (
+                Device.objects.filter_by_registration_id(device.registration_id)
+                .values_list("pk", flat=True)
+                .get()
+            )
+        serializer.instance = device
+        return device
+
+    def get_object(self):
+        if self.lookup_field != "registration_id":
+            return super().get_object()
+        # Look registration IDs up through their indexed hash
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        obj = get_object_or_404(
+            queryset.filter_by_registration_id(self.kwargs[lookup_url_kwarg])
+        )
+        self.check_object_permissions(self.request, obj)
+        return obj
+
     def perform_create(self, serializer):
         if self.request.user.is_authenticated:
             if SETTINGS["ONE_DEVICE_PER_USER"] and self.request.data.get(
@@ -149,8 +373,8 @@ class DeviceViewSetMixin:
                     source="perform_create",
                     metadata={"user_id": self.request.user.id},
                 )
-            return serializer.save(user=self.request.user)
-        return serializer.save()
+            return serializer.save(user=self.request.user, **get_last_seen_kwargs())
+        return serializer.save(**get_last_seen_kwargs())
 
     def perform_update(self, serializer):
         if self.request.user.is_authenticated:
@@ -163,8 +387,130 @@ class DeviceViewSetMixin:
                     metadata={"user_id": self.request.user.id},
                 )
 
-            return serializer.save(user=self.request.user)
-        return serializer.save()
+            return serializer.save(user=self.request.user, **get_last_seen_kwargs())
+        return serializer.save(**get_last_seen_kwargs())
+
+
+class BulkDeviceViewSetMixin:
+    """
+    Adds ``bulk`` (register or update a list of devices) and ``bulk-deactivate``
+    (deactivate a list of registration IDs) actions to a viewset using
+    ``DeviceViewSetMixin``.
+    """
+
+    bulk_max_devices = 1000
+    bulk_batch_size = 500
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk_register(self, request, *args, **kwargs):
+        self.check_bulk_size(request.data)
+        serializer = self.get_upsert_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        created, updated = self.perform_bulk_register(serializer.validated_data)
+        return Response({"created": created, "updated": updated})
+
+    @action(detail=False, methods=["post"], url_path="bulk-deactivate")
+    def bulk_deactivate(self, request, *args, **kwargs):
+        serializer = RegistrationIdListSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        registration_ids = serializer.validated_data["registration_ids"]
+        self.check_bulk_size(registration_ids)
+
+        queryset = self.get_queryset()
+        deactivated_ids = []
+        for i in range(0, len(registration_ids), self.bulk_batch_size):
+            deactivated_ids += queryset.filter_by_registration_ids(
+                registration_ids[i : i + self.bulk_batch_size]
+            ).deactivate(
+                reason="bulk_deactivate",
+                source="bulk_deactivate",
+                metadata={"user_id": request.user.id},
+            )
+        return Response({"deactivated": len(deactivated_ids)})
+
+    def check_bulk_size(self, data):
+        if isinstance(data, list) and len(data) > self.bulk_max_devices:
+            raise ValidationError(
+                {
+                    api_settings.NON_FIELD_ERRORS_KEY: [
+                        f"Ensure this request has no more than "
+                        f"{self.bulk_max_devices} devices."
+                    ]
+                }
+            )
+
+    def perform_bulk_register(self, validated_data):
+        Device = self.queryset.model
+        user = self.request.user if self.request.user.is_authenticated else None
+        registration_ids = [attrs["registration_id"] for attrs in validated_data]
+        if len(set(registration_ids)) != len(registration_ids):
+            raise ValidationError({"registration_id": "This field must be unique."})
+        if (
+            user is not None
+            and SETTINGS["ONE_DEVICE_PER_USER"]
+            and sum(attrs.get("active", True) for attrs in validated_data) > 1
+        ):
+            raise ValidationError({"active": "Only one device per user may be active."})
+
+        existing = {}
+        for i in range(0, len(registration_ids), self.bulk_batch_size):
+            for device in Device.objects.filter_by_registration_ids(
+                registration_ids[i : i + self.bulk_batch_size]
+            ):
+                existing[device.registration_id] = device
+        if existing and not SETTINGS.get("UPDATE_ON_DUPLICATE_REG_ID"):
+            raise ValidationError({"registration_id": "This field must be unique."})
+
+        # updated devices may move away from their previous users
+        user_ids = {device.user_id for device in existing.values()}
+        if user is not None:
+            user_ids.add(user.pk)
+        new_devices = []
+        updated_devices = []
+        update_fields = set()
+        extra_attrs = get_last_seen_kwargs()
+        if user is not None:
+            extra_attrs["user"] = user
+        for attrs in validated_data:
+            attrs = {**attrs, **extra_attrs}
+            device = existing.get(attrs["registration_id"])
+            if device is None:
+                new_devices.append(Device(**attrs))
+                continue
+            for attr, value in attrs.items():
+                setattr(device, attr, value)
+            update_fields.update(attrs)
+            updated_devices.append(device)
+
+        with transaction.atomic(using=router.db_for_write(Device)):
+            if user is not None and SETTINGS["ONE_DEVICE_PER_USER"]:
+                Device.objects.filter(user=user).exclude(
+                    registration_id_hash__in=[
+                        hash_registration_id(registration_id)
+                        for registration_id in registration_ids
+                    ]
+                ).deactivate(
+                    reason="one_device_per_user",
+                    source="perform_bulk_register",
+                    metadata={"user_id": user.id},
+                )
+            Device.objects.bulk_create(new_devices, batch_size=self.bulk_batch_size)
+            if updated_devices:
+                for field in Device._meta.concrete_fields:
+                    if getattr(field, "auto_now", False):
+                        for device in updated_devices:
+                            field.pre_save(device, add=False)
+                        update_fields.add(field.name)
+                Device.objects.bulk_update(
+                    updated_devices, update_fields, batch_size=self.bulk_batch_size
+                )
+            invalidate_user_registration_ids(Device, user_ids)
+        discard_dead_tokens(
+            attrs["registration_id"]
+            for attrs in validated_data
+            if attrs.get("active", True)
+        )
+        return len(new_devices), len(updated_devices)
 
 
 class AuthorizedMixin:
@@ -176,7 +522,7 @@ class AuthorizedMixin:
 
 
 # ViewSets
-class FCMDeviceViewSet(DeviceViewSetMixin, ModelViewSet):
+class FCMDeviceViewSet(BulkDeviceViewSetMixin, DeviceViewSetMixin, ModelViewSet):
     queryset = FCMDevice.objects.order_by("-id")
     serializer_class = FCMDeviceSerializer
 
@@ -0,0 +1,460 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from collections.abc import Hashable, Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from copy import copy
+from functools import partial
+from operator import itemgetter
+from typing import TYPE_CHECKING, Any, NamedTuple, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    close_old_connections,
+    connections,
+    router,
+    transaction,
+)
+from firebase_admin import messaging
+
+from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
+
+if TYPE_CHECKING:
+    from fcm_django.models import AbstractFCMDevice
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingSend(NamedTuple):
+    model: type
+    registration_id: str
+    message: messaging.Message
+    app: Optional["firebase_admin.App"]
+    send_kwargs: dict[str, Any]
+    future: Future
+    queued_at: float
+
+    @property
+    def group_key(self) -> Hashable:
+        # send kwargs may be unhashable or unorderable, their repr is neither
+        send_kwargs = repr(sorted(self.send_kwargs.items(), key=itemgetter(0)))
+        return (self.model, self.app, send_kwargs)
+
+
+class SendCoalescer:
+    """
+    Holds single-device sends for up to ``max_delay`` seconds, or until
+    ``max_batch_size`` sends are queued, and flushes them through a single
+    firebase.messaging.send_each call. Every caller still receives its own
+    SendResponse, and devices failing with a deactivation error are deactivated
+    in bulk once per flush.
+    """
+
+    def __init__(
+        self, max_delay: float = 0.005, max_batch_size: Optional[int] = None
+    ) -> None:
+        self.max_delay = max_delay
+        self._max_batch_size = max_batch_size
+        self._pending: list[_PendingSend] = []
+        self._condition = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+
+    @property
+    def max_batch_size(self) -> int:
+        from fcm_django.models import MAX_MESSAGES_PER_BATCH
+
+        return min(
+            self._max_batch_size or MAX_MESSAGES_PER_BATCH, MAX_MESSAGES_PER_BATCH
+        )
+
+    def submit(
+        self,
+        device: "AbstractFCMDevice",
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> Future:
+        """
+        Queue a message for ``device``. The message is copied, so the same message
+        may be submitted for many devices.
+
+        :returns concurrent.futures.Future resolving to messaging.SendResponse
+        """
+        item = self._get_pending_send(device, message, app, more_send_message_kwargs)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Cannot submit to a closed SendCoalescer")
+            self._pending.append(item)
+            self._ensure_worker()
+            self._condition.notify()
+        return item.future
+
+    @staticmethod
+    def _get_pending_send(
+        device: "AbstractFCMDevice",
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"],
+        send_kwargs: dict[str, Any],
+    ) -> _PendingSend:
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        message = copy(message)
+        message.token = device.registration_id
+        return _PendingSend(
+            model=type(device),
+            registration_id=device.registration_id,
+            message=message,
+            app=app,
+            send_kwargs=send_kwargs,
+            future=Future(),
+            queued_at=time.monotonic(),
+        )
+
+    def send_message(
+        self,
+        device: "AbstractFCMDevice",
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> messaging.SendResponse:
+        """
+        Blocking equivalent of ``AbstractFCMDevice.send_message`` that goes through
+        the coalescer. Inside a transaction the message is sent from the calling
+        thread instead: the worker records the send results and deactivates failed
+        devices on its own connection, which would wait on the row locks of the
+        transaction while the transaction waits on the worker.
+
+        :raises FirebaseError
+        :returns messaging.SendResponse
+        """
+        if connections[router.db_for_write(type(device))].in_atomic_block:
+            item = self._get_pending_send(
+                device, message, app, more_send_message_kwargs
+            )
+            self._send([item])
+            future = item.future
+        else:
+            future = self.submit(device, message, app=app, **more_send_message_kwargs)
+        response = future.result()
+        if response.exception:
+            raise response.exception
+        return response
+
+    async def asend_message(
+        self,
+        device: "AbstractFCMDevice",
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> messaging.SendResponse:
+        """
+        Async equivalent of ``AbstractFCMDevice.asend_message`` that goes through
+        the coalescer.
+
+        :raises FirebaseError
+        :returns messaging.SendResponse
+        """
+        response = await asyncio.wrap_future(
+            self.submit(device, message, app=app, **more_send_message_kwargs)
+        )
+        if response.exception:
+            raise response.exception
+        return response
+
+    def flush(self) -> None:
+        """Send everything that is currently queued from the calling thread."""
+        with self._condition:
+            pending, self._pending = self._pending, []
+        self._send(pending)
+
+    def close(self) -> None:
+        """Flush pending sends and stop the background worker."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            worker = self._worker
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
+        self.flush()
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(
+                target=self._run, name="fcm-django-send-coalescer", daemon=True
+            )
+            self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                deadline = self._pending[0].queued_at + self.max_delay
+                while len(self._pending) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[: self.max_batch_size]
+                del self._pending[: self.max_batch_size]
+            self._send(batch)
+            close_old_connections()
+
+    def _send(self, pending: list[_PendingSend]) -> None:
+        try:
+            _send_pending(pending, self.max_batch_size)
+        except Exception as exc:
+            # never let the worker die with callers waiting on their futures
+            for item in pending:
+                if not item.future.done():
+                    item.future.set_exception(exc)
+
+
+def _send_pending(pending: list[_PendingSend], max_batch_size: int) -> None:
+    groups: dict[Hashable, list[_PendingSend]] = {}
+    for item in pending:
+        groups.setdefault(item.group_key, []).append(item)
+    for items in groups.values():
+        for i in range(0, len(items), max_batch_size):
+            _send_batch(items[i : i + max_batch_size])
+
+
+def _send_batch(items: list[_PendingSend]) -> None:
+    first = items[0]
+    try:
+        result = first.model.objects.send_many(
+            [(item.registration_id, item.message) for item in items],
+            app=first.app,
+            **first.send_kwargs,
+        )
+    except Exception as exc:
+        for item in items:
+            item.future.set_exception(exc)
+        return
+    for item, response in zip(items, result.response.responses):
+        item.future.set_result(response)
+
+
+_default_coalescer: Optional[SendCoalescer] = None
+_default_coalescer_lock = threading.Lock()
+
+
+def get_default_coalescer() -> SendCoalescer:
+    """
+    Returns the process-wide coalescer used by ``AbstractFCMDevice.send_message``
+    and ``asend_message`` when the ``COALESCE_SINGLE_SENDS`` setting is enabled.
+    """
+    global _default_coalescer
+    with _default_coalescer_lock:
+        max_delay = SETTINGS["COALESCE_MAX_DELAY"]
+        if _default_coalescer is None or _default_coalescer.max_delay != max_delay:
+            if _default_coalescer is not None:
+                _default_coalescer.close()
+            _default_coalescer = SendCoalescer(max_delay=max_delay)
+        return _default_coalescer
+
+
+@atexit.register
+def _close_default_coalescer() -> None:
+    if _default_coalescer is not None:
+        _default_coalescer.close()
+
+
+_notification_buffer: ContextVar[Optional["NotificationBuffer"]] = ContextVar(
+    "fcm_django_notification_buffer", default=None
+)
+_background_flush_executor: Optional[ThreadPoolExecutor] = None
+_background_flush_executor_lock = threading.Lock()
+
+
+class NotificationBuffer:
+    """
+    Collects ``send_message`` calls made on devices and querysets while it is
+    active and sends them as merged send_each batches when flushed. Sends made
+    inside a transaction are only flushed once it commits, and dropped if it is
+    rolled back.
+    """
+
+    def __init__(self, using: Optional[str] = None) -> None:
+        self.using = using
+        self._pending: list[_PendingSend] = []
+        self._uncommitted = 0
+        self._discarded = False
+
+    def __len__(self) -> int:
+        return len(self._pending) + self._uncommitted
+
+    def add(
+        self,
+        model: type,
+        registration_ids: Sequence[str],
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> None:
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        queued_at = time.monotonic()
+        items = []
+        for registration_id in registration_ids:
+            prepared_message = copy(message)
+            prepared_message.token = registration_id
+            items.append(
+                _PendingSend(
+                    model=model,
+                    registration_id=registration_id,
+                    message=prepared_message,
+                    app=app,
+                    send_kwargs=more_send_message_kwargs,
+                    future=Future(),
+                    queued_at=queued_at,
+                )
+            )
+        if connections[self.using or DEFAULT_DB_ALIAS].in_atomic_block:
+            # registered now, so a rollback of the transaction (or savepoint) the
+            # send was made in drops it, even if the buffer outlives it
+            self._uncommitted += len(items)
+            transaction.on_commit(partial(self._commit, items), using=self.using)
+        else:
+            self._pending.extend(items)
+
+    def _commit(self, items: list[_PendingSend]) -> None:
+        self._uncommitted -= len(items)
+        if not self._discarded:
+            self._pending.extend(items)
+
+    def flush(self) -> None:
+        from fcm_django.models import MAX_MESSAGES_PER_BATCH
+
+        pending, self._pending = self._pending, []
+        _send_pending(pending, MAX_MESSAGES_PER_BATCH)
+        # nobody waits on the futures of buffered sends, so report failures here
+        errors = {
+            id(item.future.exception()): item.future.exception()
+            for item in pending
+            if item.future.done() and item.future.exception() is not None
+        }
+        for error in errors.values():
+            logger.error(
+                "Flushing buffered notifications failed",
+                exc_info=(type(error), error, error.__traceback__),
+            )
+
+    def flush_in_background(self) -> Future:
+        global _background_flush_executor
+        with _background_flush_executor_lock:
+            if _background_flush_executor is None:
+                _background_flush_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="fcm-django-buffer-flush"
+                )
+        return _background_flush_executor.submit(self._flush_and_close_connections)
+
+    def _flush_and_close_connections(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing buffered notifications failed")
+        finally:
+            close_old_connections()
+
+    def discard(self) -> None:
+        """Drop the buffered sends, including those awaiting a commit."""
+        self._pending = []
+        self._discarded = True
+
+    def schedule_flush(self, using: Optional[str] = None) -> None:
+        """
+        Flush once the current transaction commits (immediately when not in a
+        transaction). Sends made in transactions that were rolled back are never
+        sent.
+        """
+        if self._discarded or not len(self):
+            return
+        transaction.on_commit(
+            (
+                self.flush_in_background
+                if SETTINGS["NOTIFICATION_BUFFER_BACKGROUND_FLUSH"]
+                else self.flush
+            ),
+            using=self.using if using is None else using,
+        )
+
+
+def get_notification_buffer() -> Optional[NotificationBuffer]:
+    """Returns the buffer collecting sends in the current context, if any."""
+    return _notification_buffer.get()
+
+
+@contextmanager
+def buffer_notifications(using: Optional[str] = None) -> Iterator[NotificationBuffer]:
+    """
+    Buffer every ``send_message`` / ``asend_message`` call made on devices and
+    querysets inside the block and send them on ``transaction.on_commit``. If the
+    block raises, or the surrounding transaction is rolled back, nothing is sent.
+    """
+    buffer = NotificationBuffer(using=using)
+    token = _notification_buffer.set(buffer)
+    try:
+        yield buffer
+    except BaseException:
+        buffer.discard()
+        raise
+    finally:
+        _notification_buffer.reset(token)
+    buffer.schedule_flush()
+
+
+@contextmanager
+def bypass_notification_buffer() -> Iterator[None]:
+    """Send immediately inside the block even if a buffer is active."""
+    token = _notification_buffer.set(None)
+    try:
+        yield
+    finally:
+        _notification_buffer.reset(token)
+
+
+class NotificationBufferMiddleware:
+    """
+    Buffers the notifications sent while handling a request and flushes them
+    once the request's database work is committed. Nothing is sent for server
+    error (5xx) responses, which is what a view raising turns into.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with buffer_notifications() as buffer:
+            response = self.get_response(request)
+            if response.status_code >= 500:
+                buffer.discard()
+            return response
+
+    async def __acall__(self, request):
+        buffer = NotificationBuffer()
+        token = _notification_buffer.set(buffer)
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            buffer.discard()
+            raise
+        finally:
+            _notification_buffer.reset(token)
+        if response.status_code >= 500:
+            buffer.discard()
+        await sync_to_async(buffer.schedule_flush)()
+        return response
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from functools import partial
+from typing import TYPE_CHECKING, Any, Optional
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.db import connections, router, transaction
+
+from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
+
+if TYPE_CHECKING:
+    from fcm_django.models import FCMDeviceQuerySet
+
+
+def get_registration_id_cache() -> Optional[BaseCache]:
+    """
+    The cache of the active registration IDs of every user, or None unless the
+    ``USER_REGISTRATION_ID_CACHE`` setting names a cache alias.
+    """
+    alias = SETTINGS["USER_REGISTRATION_ID_CACHE"]
+    return None if alias is None else caches[alias]
+
+
+def _get_cache_key(model: type, user_id: Any) -> str:
+    return f"fcm_django:registration_ids:{model._meta.label_lower}:{user_id}"
+
+
+def invalidate_user_registration_ids(
+    model: type, user_ids: Iterable[Any], using: Optional[str] = None
+) -> None:
+    """
+    Drops the cached registration IDs of ``user_ids``. ``user_ids`` is only
+    iterated when the cache is enabled, so it may be a lazy queryset.
+
+    Inside a transaction the entries are dropped again once it commits, as a
+    concurrent send could cache the devices as they were before the commit.
+    """
+    cache = get_registration_id_cache()
+    if cache is None:
+        return
+    keys = {
+        _get_cache_key(model, user_id) for user_id in user_ids if user_id is not None
+    }
+    if not keys:
+        return
+    cache.delete_many(keys)
+    using = using or router.db_for_write(model)
+    if connections[using].in_atomic_block:
+        transaction.on_commit(partial(cache.delete_many, keys), using=using)
+
+
+def get_user_registration_ids(
+    queryset: "FCMDeviceQuerySet", user_ids: Iterable[Any]
+) -> dict[Any, list[str]]:
+    """
+    Maps every user in ``user_ids`` to the registration IDs of their active devices
+    in ``queryset``. With the cache enabled and an unfiltered queryset, the users
+    are read from the cache, and the users missing from it are looked up with a
+    single query and cached. Misses are read from the write database: a lagging
+    replica would cache the devices as they were before an invalidation.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    cache = get_registration_id_cache()
+    if queryset.query.has_filters():
+        # the cache only holds the unfiltered devices of every user
+        cache = None
+
+    registration_ids: dict[Any, list[str]] = {}
+    if cache is not None:
+        keys = {
+            _get_cache_key(queryset.model, user_id): user_id for user_id in user_ids
+        }
+        for key, cached_registration_ids in cache.get_many(keys).items():
+            registration_ids[keys[key]] = cached_registration_ids
+    missing_user_ids = [
+        user_id for user_id in user_ids if user_id not in registration_ids
+    ]
+    if not missing_user_ids:
+        return registration_ids
+
+    if cache is None:
+        lookup = queryset._get_registration_id_lookup()
+    else:
+        lookup = queryset.filter(active=True)
+        lookup._for_write = True
+    fetched: dict[Any, list[str]] = {user_id: [] for user_id in missing_user_ids}
+    for user_id, registration_id in lookup.filter(
+        user_id__in=missing_user_ids
+    ).values_list("user_id", "registration_id"):
+        fetched.setdefault(user_id, []).append(registration_id)
+    if cache is not None:
+        cache.set_many(
+            {
+                _get_cache_key(queryset.model, user_id): user_registration_ids
+                for user_id, user_registration_ids in fetched.items()
+            },
+            timeout=SETTINGS["USER_REGISTRATION_ID_CACHE_TIMEOUT"],
+        )
+    registration_ids.update(fetched)
+    return registration_ids
+
+
+class DeadTokenCache:
+    """
+    Registration IDs Firebase recently reported as dead, kept in this process for
+    ``ttl`` seconds so sends skip them even when they come from outside the device
+    table. Holds at most ``max_size`` tokens, evicting the oldest first.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        # insertion order is expiry order, as every token lives for ttl seconds
+        self._expires_at: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._expires_at)
+
+    def __contains__(self, registration_id: str) -> bool:
+        return self._expires_at.get(registration_id, 0) > time.monotonic()
+
+    def add(self, registration_ids: Iterable[str]) -> None:
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for registration_id in registration_ids:
+                self._expires_at.pop(registration_id, None)
+                self._expires_at[registration_id] = expires_at
+            self._evict()
+
+    def discard(self, registration_ids: Iterable[str]) -> None:
+        """Forgets tokens that were registered again."""
+        with self._lock:
+            for registration_id in registration_ids:
+                self._expires_at.pop(registration_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._expires_at.clear()
+
+    def exclude(self, registration_ids: list[str]) -> list[str]:
+        """``registration_ids`` without the dead tokens, in the same order."""
+        if not self._expires_at:
+            return registration_ids
+        now = time.monotonic()
+        expires_at = self._expires_at
+        return [
+            registration_id
+            for registration_id in registration_ids
+            if expires_at.get(registration_id, 0) <= now
+        ]
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._expires_at:
+            registration_id, expires_at = next(iter(self._expires_at.items()))
+            if expires_at > now and len(self._expires_at) <= self.max_size:
+                return
+            del self._expires_at[registration_id]
+
+
+_dead_token_cache: Optional[DeadTokenCache] = None
+
+
+def get_dead_token_cache() -> Optional[DeadTokenCache]:
+    """
+    The DeadTokenCache of this process, or None unless the ``DEAD_TOKEN_CACHE_SIZE``
+    setting is positive.
+    """
+    global _dead_token_cache
+    max_size = SETTINGS["DEAD_TOKEN_CACHE_SIZE"]
+    if not max_size:
+        return None
+    ttl = SETTINGS["DEAD_TOKEN_CACHE_TTL"]
+    cache = _dead_token_cache
+    if cache is None or (cache.max_size, cache.ttl) != (max_size, ttl):
+        cache = _dead_token_cache = DeadTokenCache(max_size, ttl)
+    return cache
+
+
+def discard_dead_tokens(registration_ids: Iterable[str]) -> None:
+    """
+    Removes registered devices from the DeadTokenCache. ``registration_ids`` is
+    only iterated when the cache holds tokens, so it may be a lazy queryset.
+    """
+    dead_tokens = get_dead_token_cache()
+    if dead_tokens:
+        dead_tokens.discard(registration_ids)
@@ -1,3 +1,4 @@
+import hashlib
 import re
 import struct
 
@@ -9,7 +10,7 @@ from django.utils.translation import gettext_lazy as _
 UNSIGNED_64BIT_INT_MIN_VALUE = 0
 UNSIGNED_64BIT_INT_MAX_VALUE = 2**64 - 1
 
-__all__ = ["HexadecimalField", "HexIntegerField"]
+__all__ = ["HexadecimalField", "HexIntegerField", "RegistrationIdHashField"]
 
 hex_re = re.compile(r"^(([0-9A-f])|(0x[0-9A-f]))+$")
 signed_integer_engines = [
@@ -125,3 +126,43 @@ class HexIntegerField(models.BigIntegerField):
         # make sure validation is performed on integer value not string value
         value = _hex_string_to_unsigned_integer(value)
         return super(models.BigIntegerField, self).run_validators(value)
+
+
+def hash_registration_id(registration_id) -> str:
+    """Hex SHA-256 digest of a registration ID, as stored by RegistrationIdHashField"""
+    if not isinstance(registration_id, str):
+        # Mirror TextField/CharField.to_python so the digest matches what is stored
+        registration_id = str(registration_id)
+    return hashlib.sha256(registration_id.encode("utf-8")).hexdigest()
+
+
+class RegistrationIdHashField(models.CharField):
+    """
+    Fixed-width SHA-256 digest of another field (``registration_id`` by default),
+    kept in sync on every save and bulk_create.
+
+    Registration tokens can be up to 4kb, which cannot be indexed on every backend
+    (the MySQL compatibility mode stores them in an unindexed TEXT column). The
+    digest is 64 hex characters, so it can be uniquely indexed everywhere and used
+    for equality lookups instead of the token itself. A hex CharField is used over
+    a binary column since MySQL cannot put a unique index on a BLOB.
+    """
+
+    def __init__(self, *args, source_field: str = "registration_id", **kwargs):
+        self.source_field = source_field
+        kwargs["max_length"] = 64
+        kwargs.setdefault("editable", False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs["max_length"]
+        if self.source_field != "registration_id":
+            kwargs["source_field"] = self.source_field
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        source_value = getattr(model_instance, self.source_field)
+        value = None if source_value is None else hash_registration_id(source_value)
+        setattr(model_instance, self.attname, value)
+        return value
@@ -0,0 +1,56 @@
+import swapper
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from fcm_django.operations import add_active_device_indexes
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the active device indexes of ACTIVE_DEVICE_INDEXES on an already "
+        "migrated database, in place. Existing indexes are left alone."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrently",
+            action="store_true",
+            help=(
+                "Build the indexes with CREATE INDEX CONCURRENTLY, without locking "
+                "writes to the device table (PostgreSQL only)."
+            ),
+        )
+        parser.add_argument(
+            "--sql",
+            action="store_true",
+            help="Print the SQL instead of running it.",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help='Database to create the indexes in (default: "default").',
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        concurrently = options["concurrently"]
+        if concurrently and connection.vendor != "postgresql":
+            raise CommandError("--concurrently is only supported on PostgreSQL.")
+        # CREATE INDEX CONCURRENTLY cannot run in a transaction
+        with connection.schema_editor(
+            collect_sql=options["sql"], atomic=not concurrently
+        ) as schema_editor:
+            created = add_active_device_indexes(
+                schema_editor, FCMDevice, concurrently=concurrently
+            )
+        if options["sql"]:
+            for statement in schema_editor.collected_sql:
+                self.stdout.write(statement)
+            return
+        if created:
+            for index in created:
+                self.stdout.write(f"Created index {index.name}.")
+        else:
+            self.stdout.write("The active device indexes already exist.")
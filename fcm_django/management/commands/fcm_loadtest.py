@@ -0,0 +1,354 @@
+import math
+import random
+import sys
+import time
+import uuid
+from contextlib import ExitStack
+from functools import wraps
+from pathlib import Path
+from unittest import mock
+
+import swapper
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from firebase_admin import messaging
+
+from fcm_django.models import DeviceType
+from fcm_django.testing import FakeTransport, FCMEmulator, ReplayTransport
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+PATHS = ("sync", "async", "personalized", "topic")
+CREATE_BATCH_SIZE = 1000
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    """Nearest-rank percentile of ``values``, which must be sorted."""
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+def _parse_types(value: str) -> dict[str, float]:
+    weights = {}
+    for item in value.split(","):
+        device_type, _, weight = item.partition("=")
+        if device_type not in DeviceType.values:
+            raise CommandError(f"Unknown device type {device_type!r} in --types.")
+        try:
+            weights[device_type] = float(weight or 1)
+        except ValueError:
+            raise CommandError(f"Invalid weight {weight!r} in --types.")
+    return weights
+
+
+class _QueryTimer:
+    """Database execute wrapper counting and timing the queries."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Create synthetic devices, send to them through a fake or emulated FCM "
+        "transport and report throughput, batch latency, database time and memory. "
+        "Firebase is never contacted and the devices are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--devices",
+            type=int,
+            default=10000,
+            help="Number of synthetic devices (default: 10000).",
+        )
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=0,
+            help=(
+                "Spread the devices over this many synthetic users (default: 0, "
+                "devices without a user)."
+            ),
+        )
+        parser.add_argument(
+            "--types",
+            default="android=1,ios=1,web=1",
+            metavar="TYPE=WEIGHT,...",
+            help="Device type distribution (default: android=1,ios=1,web=1).",
+        )
+        parser.add_argument(
+            "--path",
+            choices=PATHS,
+            default="sync",
+            help=(
+                "Send path to run: send_message, asend_message, "
+                "send_bulk_personalized_messages or a topic subscription "
+                "(default: sync)."
+            ),
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0,
+            help="Share of tokens answered with UNREGISTERED (default: 0).",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            metavar="SECONDS",
+            help="Simulated FCM latency per request (default: 0).",
+        )
+        parser.add_argument(
+            "--emulator",
+            action="store_true",
+            help=(
+                "Send over HTTP to a local FCM emulator, exercising the "
+                "firebase_admin HTTP clients, instead of the in-process fake "
+                "transport. With --latency, every message is delayed."
+            ),
+        )
+        parser.add_argument(
+            "--replay",
+            type=Path,
+            metavar="FILE",
+            help=(
+                "Answer sends with the outcomes and latencies recorded in FILE by "
+                "fcm_django.testing.RecordingTransport, instead of --failure-rate "
+                "and --latency."
+            ),
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            help="Seed of the device type and failure choices.",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the synthetic devices and users instead of deleting them.",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help='Database to create the devices in (default: "default").',
+        )
+
+    def handle(self, *args, **options):
+        if options["devices"] < 1:
+            raise CommandError("--devices must be a positive integer.")
+        if options["users"] < 0:
+            raise CommandError("--users must not be negative.")
+        if not 0 <= options["failure_rate"] <= 1:
+            raise CommandError("--failure-rate must be between 0 and 1.")
+        if options["emulator"] and options["replay"]:
+            raise CommandError("--emulator and --replay are mutually exclusive.")
+        type_weights = _parse_types(options["types"])
+        database = options["database"]
+        name = f"fcm-loadtest-{uuid.uuid4().hex[:12]}"
+        rng = random.Random(options["seed"])
+
+        try:
+            user_ids = self.create_users(name, options["users"], database)
+            self.create_devices(
+                name, options["devices"], user_ids, type_weights, rng, database
+            )
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    f"Created {options['devices']} device(s) and "
+                    f"{len(user_ids)} user(s) named {name}."
+                )
+            self.run(FCMDevice.objects.using(database).filter(name=name), options)
+        finally:
+            if options["keep"]:
+                self.stdout.write(f"Kept the devices and users named {name}.")
+            else:
+                self.clean_up(name, options["users"], database)
+
+    @staticmethod
+    def get_user_model():
+        return FCMDevice._meta.get_field("user").related_model
+
+    def create_users(self, name: str, count: int, database: str) -> list:
+        if not count:
+            return []
+        User = self.get_user_model()
+        username_field = User.USERNAME_FIELD
+        User.objects.using(database).bulk_create(
+            (User(**{username_field: f"{name}-{i}"}) for i in range(count)),
+            batch_size=CREATE_BATCH_SIZE,
+        )
+        # not every backend returns the primary keys of bulk created rows
+        return list(
+            User.objects.using(database)
+            .filter(**{f"{username_field}__startswith": f"{name}-"})
+            .values_list("pk", flat=True)
+        )
+
+    @staticmethod
+    def create_devices(
+        name: str,
+        count: int,
+        user_ids: list,
+        type_weights: dict[str, float],
+        rng: random.Random,
+        database: str,
+    ) -> None:
+        device_types = list(type_weights)
+        weights = list(type_weights.values())
+        FCMDevice.objects.using(database).bulk_create(
+            (
+                FCMDevice(
+                    name=name,
+                    registration_id=f"{name}-{i}",
+                    type=rng.choices(device_types, weights)[0],
+                    user_id=user_ids[i % len(user_ids)] if user_ids else None,
+                )
+                for i in range(count)
+            ),
+            batch_size=CREATE_BATCH_SIZE,
+        )
+
+    def clean_up(self, name: str, users: int, database: str) -> None:
+        FCMDevice.objects.using(database).filter(name=name).delete()
+        if users:
+            User = self.get_user_model()
+            User.objects.using(database).filter(
+                **{f"{User.USERNAME_FIELD}__startswith": f"{name}-"}
+            ).delete()
+
+    def run(self, queryset, options) -> None:
+        path = options["path"]
+        message = messaging.Message(
+            notification=messaging.Notification(title="Load test", body="Load test")
+        )
+        message_data = None
+        if path == "personalized":
+            message_data = {
+                registration_id: {"name": f"device {pk}"}
+                for registration_id, pk in queryset.values_list("registration_id", "pk")
+            }
+
+        batch_latencies: list[float] = []
+
+        def timed(func):
+            if iscoroutinefunction(func):
+
+                @wraps(func)
+                async def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        batch_latencies.append(time.perf_counter() - start)
+
+            else:
+
+                @wraps(func)
+                def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        batch_latencies.append(time.perf_counter() - start)
+
+            return wrapper
+
+        with ExitStack() as stack:
+            app = None
+            if options["emulator"]:
+                emulator = stack.enter_context(
+                    FCMEmulator(
+                        latency=options["latency"],
+                        error_rates={"UNREGISTERED": options["failure_rate"]},
+                        seed=options["seed"],
+                    )
+                )
+                app = emulator.initialize_app()
+            else:
+                stack.enter_context(
+                    FakeTransport(
+                        failure_rate=options["failure_rate"],
+                        latency=options["latency"],
+                        seed=options["seed"],
+                    )
+                )
+                if options["replay"]:
+                    # topic subscriptions are still answered by the fake transport
+                    try:
+                        replay = ReplayTransport(options["replay"])
+                    except (OSError, ValueError) as e:
+                        raise CommandError(f"Cannot replay {options['replay']}: {e}")
+                    stack.enter_context(replay)
+            stack.enter_context(
+                mock.patch.multiple(
+                    messaging,
+                    send_each=timed(messaging.send_each),
+                    send_each_async=timed(messaging.send_each_async),
+                    subscribe_to_topic=timed(messaging.subscribe_to_topic),
+                )
+            )
+            query_timer = _QueryTimer()
+            stack.enter_context(connections[queryset.db].execute_wrapper(query_timer))
+
+            start = time.perf_counter()
+            if path == "sync":
+                response = queryset.send_message(message, app=app)
+            elif path == "async":
+                # async_to_sync runs the queries on this thread's connection
+                response = async_to_sync(queryset.asend_message)(message, app=app)
+            elif path == "personalized":
+                response = queryset.send_bulk_personalized_messages(
+                    title_template="Load test",
+                    body_template="Hello {name}",
+                    message_data=message_data,
+                    app=app,
+                )
+            else:
+                response = queryset.handle_topic_subscription(
+                    True, "fcm-loadtest", app=app
+                )
+            duration = time.perf_counter() - start
+
+        self.report(response, duration, sorted(batch_latencies), query_timer)
+
+    def report(self, response, duration, batch_latencies, query_timer) -> None:
+        tokens = len(response.registration_ids_sent)
+        self.stdout.write(
+            f"Sent to {tokens} token(s) in {duration:.2f}s: "
+            f"{tokens / duration:.0f} tokens/s"
+        )
+        if batch_latencies:
+            self.stdout.write(
+                f"Batch latency: p50 {_percentile(batch_latencies, 50) * 1000:.1f} ms, "
+                f"p99 {_percentile(batch_latencies, 99) * 1000:.1f} ms "
+                f"({len(batch_latencies)} batch(es))"
+            )
+        self.stdout.write(
+            f"Database: {query_timer.count} query(s), "
+            f"{query_timer.duration * 1000:.1f} ms"
+        )
+        self.stdout.write(
+            f"Deactivated {len(response.deactivated_registration_ids)} device(s)"
+        )
+        if resource is not None:
+            # ru_maxrss is in bytes on macOS and in kibibytes elsewhere
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == "darwin":
+                max_rss //= 1024
+            self.stdout.write(f"Peak memory (max RSS): {max_rss // 1024} MiB")
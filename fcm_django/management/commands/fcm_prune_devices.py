@@ -0,0 +1,178 @@
+import time
+from datetime import timedelta
+
+import swapper
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, models
+from django.utils import timezone
+
+from fcm_django.caching import invalidate_user_registration_ids
+from fcm_django.types import DeviceDeactivationData
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+class Command(BaseCommand):
+    help = (
+        "Deactivate or delete devices by age, inactivity or active=False, in small "
+        "primary key ordered chunks so large cleanups do not lock the device table."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--inactive",
+            action="store_true",
+            help="Only prune devices with active=False.",
+        )
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            metavar="DAYS",
+            help="Only prune devices created more than DAYS days ago.",
+        )
+        parser.add_argument(
+            "--unseen-for",
+            type=int,
+            metavar="DAYS",
+            help=(
+                "Only prune devices not seen for DAYS days. Devices without "
+                "last_seen are judged by their creation date."
+            ),
+        )
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete the matching devices instead of deactivating them.",
+        )
+        parser.add_argument(
+            "--raw-delete",
+            action="store_true",
+            help=(
+                "Delete with a plain DELETE per chunk, skipping cascade collection "
+                "and the pre_delete/post_delete signals. Implies --delete."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only print how many devices would be pruned.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of devices pruned per chunk (default: 1000).",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Seconds to sleep between chunks (default: 0).",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help='Database to prune devices in (default: "default").',
+        )
+
+    def handle(self, *args, **options):
+        delete = options["delete"] or options["raw_delete"]
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be a positive integer.")
+        if not (options["inactive"] or options["older_than"] or options["unseen_for"]):
+            raise CommandError(
+                "Pass at least one of --inactive, --older-than or --unseen-for."
+            )
+        if options["inactive"] and not delete:
+            raise CommandError("--inactive devices can only be pruned with --delete.")
+
+        devices = FCMDevice.objects.using(options["database"]).filter(
+            self.get_filter(options)
+        )
+        if not delete:
+            devices = devices.filter(active=True)
+
+        verb = "deleted" if delete else "deactivated"
+        if options["dry_run"]:
+            self.stdout.write(f"{devices.count()} device(s) would be {verb}.")
+            return
+
+        pruned = 0
+        for rows in self.iter_chunks(devices, options["chunk_size"]):
+            if delete:
+                pruned += self.delete_chunk(devices, rows, raw=options["raw_delete"])
+            else:
+                pruned += self.deactivate_chunk(devices, rows)
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        self.stdout.write(f"{pruned} device(s) {verb}.")
+
+    @staticmethod
+    def get_filter(options) -> models.Q:
+        now = timezone.now()
+        condition = models.Q()
+        if options["inactive"]:
+            condition &= models.Q(active=False)
+        if options["older_than"]:
+            condition &= models.Q(
+                date_created__lt=now - timedelta(days=options["older_than"])
+            )
+        if options["unseen_for"]:
+            seen_after = now - timedelta(days=options["unseen_for"])
+            condition &= models.Q(last_seen__lt=seen_after) | models.Q(
+                last_seen__isnull=True, date_created__lt=seen_after
+            )
+        return condition
+
+    @staticmethod
+    def iter_chunks(devices, chunk_size: int):
+        """
+        Yields the matching devices as lists of (registration_id, id, user_id, active)
+        rows, walking the primary key instead of using OFFSET.
+        """
+        devices = devices.order_by("pk")
+        last_pk = None
+        while True:
+            chunk = devices if last_pk is None else devices.filter(pk__gt=last_pk)
+            rows = list(
+                chunk.values_list("registration_id", "pk", "user_id", "active")[
+                    :chunk_size
+                ]
+            )
+            if not rows:
+                return
+            last_pk = rows[-1][1]
+            yield rows
+
+    @classmethod
+    def deactivate_chunk(cls, devices, rows) -> int:
+        deactivated = devices.filter(pk__in=[row[1] for row in rows]).update(
+            active=False
+        )
+        invalidate_user_registration_ids(
+            devices.model, [row[2] for row in rows], devices.db
+        )
+        cls.emit_device_deactivated(devices, rows)
+        return deactivated
+
+    @classmethod
+    def delete_chunk(cls, devices, rows, *, raw: bool) -> int:
+        chunk = devices.filter(pk__in=[row[1] for row in rows])
+        if raw:
+            deleted = chunk._raw_delete(devices.db)
+            invalidate_user_registration_ids(
+                devices.model, [row[2] for row in rows], devices.db
+            )
+        else:
+            deleted = chunk.delete()[1].get(chunk.model._meta.label, 0)
+        # deleting active devices deactivates them as far as receivers are concerned
+        cls.emit_device_deactivated(devices, rows)
+        return deleted
+
+    @staticmethod
+    def emit_device_deactivated(devices, rows) -> None:
+        devices._emit_device_deactivated_signal(
+            device_rows=[DeviceDeactivationData(*row[:3]) for row in rows if row[3]],
+            reason="pruned",
+            source="fcm_prune_devices",
+        )
@@ -0,0 +1,115 @@
+import json
+import time
+from pathlib import Path
+
+import swapper
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from fcm_django.types import TokenValidationResult
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+class _TimeUp(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Validate the tokens of active devices with dry_run sends and deactivate "
+        "the ones Firebase reports as unregistered or invalid."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Tokens per send_each call, at most 500 (default: 500).",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            help="Maximum number of tokens validated per second.",
+        )
+        parser.add_argument(
+            "--max-duration",
+            type=float,
+            metavar="SECONDS",
+            help=(
+                "Stop after SECONDS seconds. Use with --checkpoint to spread a "
+                "sweep over several off-peak windows."
+            ),
+        )
+        parser.add_argument(
+            "--checkpoint",
+            type=Path,
+            metavar="FILE",
+            help=(
+                "Resume from and record progress to FILE. The file is removed once "
+                "the sweep completes."
+            ),
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help='Database to read devices from (default: "default").',
+        )
+
+    def handle(self, *args, **options):
+        if not 0 < options["batch_size"] <= 500:
+            raise CommandError("--batch-size must be between 1 and 500.")
+        checkpoint = options["checkpoint"]
+        start_after = self.read_checkpoint(checkpoint) if checkpoint else None
+        deadline = (
+            time.monotonic() + options["max_duration"]
+            if options["max_duration"]
+            else None
+        )
+        progress = TokenValidationResult(0, [], start_after)
+
+        def on_batch(result: TokenValidationResult) -> None:
+            nonlocal progress
+            progress = result
+            if checkpoint:
+                checkpoint.write_text(
+                    json.dumps({"last_pk": result.last_pk}, default=str)
+                )
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    f"{result.checked_count} token(s) checked, "
+                    f"{len(result.deactivated_registration_ids)} deactivated"
+                )
+            if deadline is not None and time.monotonic() >= deadline:
+                raise _TimeUp
+
+        try:
+            FCMDevice.objects.using(options["database"]).validate_tokens(
+                batch_size=options["batch_size"],
+                max_per_second=options["rate"],
+                start_after=start_after,
+                on_batch=on_batch,
+            )
+        except _TimeUp:
+            completed = False
+        else:
+            completed = True
+            if checkpoint:
+                checkpoint.unlink(missing_ok=True)
+
+        self.stdout.write(
+            f"{progress.checked_count} token(s) checked, "
+            f"{len(progress.deactivated_registration_ids)} deactivated."
+        )
+        if not completed:
+            self.stdout.write(f"Stopped after device {progress.last_pk}.")
+
+    @staticmethod
+    def read_checkpoint(checkpoint: Path):
+        try:
+            return json.loads(checkpoint.read_text())["last_pk"]
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as e:
+            raise CommandError(f"Invalid checkpoint file {checkpoint}: {e}")
@@ -0,0 +1,14 @@
+from django.db import migrations
+
+from fcm_django.operations import AddActiveDeviceIndexes
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("fcm_django", "0011_fcmdevice_fcm_django_registration_id_user_id_idx"),
+    ]
+
+    operations = [
+        AddActiveDeviceIndexes(model_name="fcmdevice"),
+    ]
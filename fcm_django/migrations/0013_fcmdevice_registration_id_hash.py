@@ -0,0 +1,98 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+import fcm_django.fields
+from fcm_django.fields import hash_registration_id
+from fcm_django.operations import add_active_device_indexes
+from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
+
+_BATCH_SIZE = 1000
+
+
+def backfill_registration_id_hashes(apps, schema_editor):
+    FCMDevice = apps.get_model("fcm_django", "FCMDevice")
+    devices = FCMDevice.objects.using(schema_editor.connection.alias)
+    # Registration IDs are not unique in MySQL compatibility mode. Only the newest
+    # device of a duplicated token gets a hash so the unique index can be built.
+    # The older duplicates are deactivated, as token lookups (deactivation,
+    # deletion, token rotation) cannot find them and they would keep receiving
+    # sends forever.
+    duplicate_device_ids = set()
+    for row in (
+        devices.values("registration_id")
+        .annotate(count=Count("id"), newest_id=Max("id"))
+        .filter(count__gt=1)
+        .order_by()
+    ):
+        duplicate_device_ids.update(
+            devices.filter(registration_id=row["registration_id"])
+            .exclude(id=row["newest_id"])
+            .values_list("id", flat=True)
+        )
+    ordered_duplicate_ids = sorted(duplicate_device_ids)
+    for start in range(0, len(ordered_duplicate_ids), _BATCH_SIZE):
+        devices.filter(
+            id__in=ordered_duplicate_ids[start : start + _BATCH_SIZE]
+        ).update(active=False)
+
+    last_id = 0
+    while True:
+        batch = list(
+            devices.filter(id__gt=last_id)
+            .order_by("id")
+            .only("id", "registration_id")[:_BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+        to_update = []
+        for device in batch:
+            if device.id in duplicate_device_ids:
+                continue
+            device.registration_id_hash = hash_registration_id(device.registration_id)
+            to_update.append(device)
+        devices.bulk_update(to_update, ["registration_id_hash"])
+
+
+def restore_active_device_indexes(apps, schema_editor):
+    # SQLite rebuilds the table to add the unique constraint, dropping the indexes
+    # of 0012 as they are not part of the model state
+    if SETTINGS["ACTIVE_DEVICE_INDEXES"]:
+        add_active_device_indexes(
+            schema_editor, apps.get_model("fcm_django", "FCMDevice")
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("fcm_django", "0012_fcmdevice_active_device_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fcmdevice",
+            name="registration_id_hash",
+            field=fcm_django.fields.RegistrationIdHashField(
+                editable=False,
+                null=True,
+                verbose_name="Registration token hash",
+            ),
+        ),
+        migrations.RunPython(
+            backfill_registration_id_hashes, migrations.RunPython.noop, elidable=True
+        ),
+        migrations.AlterField(
+            model_name="fcmdevice",
+            name="registration_id_hash",
+            field=fcm_django.fields.RegistrationIdHashField(
+                editable=False,
+                null=True,
+                unique=True,
+                verbose_name="Registration token hash",
+            ),
+        ),
+        migrations.RunPython(
+            restore_active_device_indexes, migrations.RunPython.noop, elidable=True
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("fcm_django", "0013_fcmdevice_registration_id_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fcmdevice",
+            name="last_failure_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Last failed send"
+            ),
+        ),
+        migrations.AddField(
+            model_name="fcmdevice",
+            name="last_seen",
+            field=models.DateTimeField(
+                blank=True,
+                editable=False,
+                help_text="Last registration or refresh of the device",
+                null=True,
+                verbose_name="Last seen",
+            ),
+        ),
+        migrations.AddField(
+            model_name="fcmdevice",
+            name="last_success_at",
+            field=models.DateTimeField(
+                blank=True,
+                editable=False,
+                null=True,
+                verbose_name="Last successful send",
+            ),
+        ),
+    ]
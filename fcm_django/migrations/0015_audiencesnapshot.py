@@ -0,0 +1,76 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:39
+
+import django.db.models.deletion
+import swapper
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("fcm_django", "0014_fcmdevice_activity_tracking"),
+        swapper.dependency("fcm_django", "fcmdevice"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AudienceSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Created at"),
+                ),
+                (
+                    "expires_at",
+                    models.DateTimeField(db_index=True, verbose_name="Expires at"),
+                ),
+                ("size", models.PositiveIntegerField(default=0, verbose_name="Size")),
+            ],
+            options={
+                "verbose_name": "Audience snapshot",
+                "verbose_name_plural": "Audience snapshots",
+            },
+        ),
+        migrations.CreateModel(
+            name="AudienceSnapshotEntry",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("registration_id", models.TextField()),
+                (
+                    "device",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to=settings.FCM_DJANGO_FCMDEVICE_MODEL,
+                    ),
+                ),
+                (
+                    "snapshot",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="entries",
+                        to="fcm_django.audiencesnapshot",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["snapshot", "id"], name="fcm_django__snapsho_0d052c_idx"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -1,17 +1,42 @@
-from collections.abc import Sequence
+import asyncio
+import itertools
+import time
+from collections.abc import Callable, Iterable, Iterator, Sequence
 from copy import copy
+from datetime import timedelta
 from typing import Any, Optional, Union
 
 import swapper
 from asgiref.sync import sync_to_async
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from firebase_admin import messaging
 from firebase_admin.exceptions import FirebaseError, InvalidArgumentError
 
+from fcm_django.batching import (
+    bypass_notification_buffer,
+    get_default_coalescer,
+    get_notification_buffer,
+)
+from fcm_django.caching import (
+    discard_dead_tokens,
+    get_dead_token_cache,
+    get_registration_id_cache,
+    get_user_registration_ids,
+    invalidate_user_registration_ids,
+)
+from fcm_django.fields import RegistrationIdHashField, hash_registration_id
+from fcm_django.profiling import profiled, stage, timed_stage
 from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
 from fcm_django.signals import device_deactivated
-from fcm_django.types import DeviceDeactivationData, FirebaseResponseDict
+from fcm_django.types import (
+    AudienceSendResult,
+    DeviceDeactivationData,
+    FirebaseResponseDict,
+    FirebaseTopicResponseDict,
+    TokenValidationResult,
+)
 
 # Set by Firebase. Adjust when they adjust; developers can override too if we don't
 # upgrade package in time via a monkeypatch.
@@ -19,6 +44,16 @@ MAX_MESSAGES_PER_BATCH = 500
 MAX_DEVICES_PER_SUBSCRIBE_REQUEST = 1000
 
 
+def get_last_seen_kwargs() -> dict[str, Any]:
+    """
+    Field values stamping ``last_seen`` when a device is registered or refreshed,
+    empty unless the ``TRACK_DEVICE_ACTIVITY`` setting is enabled.
+    """
+    if not SETTINGS["TRACK_DEVICE_ACTIVITY"]:
+        return {}
+    return {"last_seen": timezone.now()}
+
+
 class Device(models.Model):
     id = models.AutoField(
         verbose_name="ID",
@@ -43,6 +78,19 @@ class Device(models.Model):
     date_created = models.DateTimeField(
         verbose_name=_("Creation date"), auto_now_add=True, null=True
     )
+    last_seen = models.DateTimeField(
+        verbose_name=_("Last seen"),
+        blank=True,
+        null=True,
+        editable=False,
+        help_text=_("Last registration or refresh of the device"),
+    )
+    last_success_at = models.DateTimeField(
+        verbose_name=_("Last successful send"), blank=True, null=True, editable=False
+    )
+    last_failure_at = models.DateTimeField(
+        verbose_name=_("Last failed send"), blank=True, null=True, editable=False
+    )
 
     class Meta:
         abstract = True
@@ -110,6 +158,7 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             return template
         return template.format_map(_MissingFormatDict(template_data))
 
+    @timed_stage("build")
     def _build_bulk_personalized_messages(
         self,
         registration_ids: list[str],
@@ -154,6 +203,156 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             if _validate_exception_for_deactivation(item.reason)
         ]
 
+    def filter_by_registration_ids(
+        self, registration_ids: Iterable[str]
+    ) -> "FCMDeviceQuerySet":
+        """
+        Filters on the indexed ``registration_id_hash`` column instead of the
+        registration IDs themselves, which are unindexed in MySQL compatibility mode.
+        """
+        return self.filter(
+            registration_id_hash__in=[
+                hash_registration_id(registration_id)
+                for registration_id in registration_ids
+            ]
+        )
+
+    def filter_by_registration_id(self, registration_id: str) -> "FCMDeviceQuerySet":
+        return self.filter(registration_id_hash=hash_registration_id(registration_id))
+
+    def _get_registration_id_hash_fields(self) -> list[RegistrationIdHashField]:
+        return [
+            field
+            for field in self.model._meta.concrete_fields
+            if isinstance(field, RegistrationIdHashField)
+        ]
+
+    def update(self, **kwargs) -> int:
+        """
+        Also sets ``registration_id_hash`` when ``registration_id`` is updated, as
+        UPDATEs skip ``pre_save``.
+
+        :raises ValueError when ``registration_id`` is set to an expression without
+        setting ``registration_id_hash``, as the digest is computed in Python
+        """
+        for field in self._get_registration_id_hash_fields():
+            if field.source_field not in kwargs or field.name in kwargs:
+                continue
+            value = kwargs[field.source_field]
+            if hasattr(value, "resolve_expression"):
+                raise ValueError(
+                    f"Cannot update {field.source_field} to an expression without "
+                    f"also updating {field.name}."
+                )
+            kwargs[field.name] = None if value is None else hash_registration_id(value)
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None) -> int:
+        """Also updates ``registration_id_hash`` when ``registration_id`` is updated."""
+        fields = list(fields)
+        hash_fields = [
+            field
+            for field in self._get_registration_id_hash_fields()
+            if field.source_field in fields and field.name not in fields
+        ]
+        if hash_fields:
+            objs = list(objs)
+            for obj in objs:
+                for field in hash_fields:
+                    field.pre_save(obj, False)
+            fields += [field.name for field in hash_fields]
+        return super().bulk_update(objs, fields, batch_size=batch_size)
+
+    bulk_update.alters_data = True
+
+    def replace_token(
+        self,
+        old_registration_id: str,
+        new_registration_id: str,
+        topics: Sequence[str] = (),
+        app: Optional["firebase_admin.App"] = None,
+    ) -> int:
+        """
+        Swaps the registration ID of the device in this queryset registered with
+        ``old_registration_id`` for ``new_registration_id`` with a single UPDATE,
+        keeping the device row and with it its user and other fields.
+
+        If another device is already registered with ``new_registration_id``, it is
+        deleted in the same transaction when ``UPDATE_ON_DUPLICATE_REG_ID`` is
+        enabled. Otherwise the unique constraint raises an IntegrityError.
+
+        :param old_registration_id: the registration ID the client rotated away from
+        :param new_registration_id: the registration ID replacing it
+        :param topics: topics to subscribe the new registration ID to. Firebase
+        keeps topic subscriptions per registration ID, so they do not carry over.
+        :param app: firebase_admin.App. Specify a specific app to use
+
+        :raises IntegrityError
+        :returns the number of devices whose registration ID was replaced
+        """
+        if old_registration_id == new_registration_id:
+            return int(self.filter_by_registration_id(old_registration_id).exists())
+
+        old_devices = self.filter_by_registration_id(old_registration_id)
+        with transaction.atomic(using=self.db):
+            if SETTINGS["UPDATE_ON_DUPLICATE_REG_ID"]:
+                self.model.objects.using(self.db).filter_by_registration_id(
+                    new_registration_id
+                ).filter(models.Exists(old_devices)).delete()
+            user_ids = (
+                list(old_devices.values_list("user_id", flat=True))
+                if get_registration_id_cache() is not None
+                else []
+            )
+            replaced = old_devices.update(
+                registration_id=new_registration_id,
+                registration_id_hash=hash_registration_id(new_registration_id),
+                **get_last_seen_kwargs(),
+            )
+            invalidate_user_registration_ids(self.model, user_ids, using=self.db)
+        if replaced:
+            discard_dead_tokens([new_registration_id])
+            for topic in topics:
+                self.handle_topic_subscription(
+                    True,
+                    topic,
+                    skip_registration_id_lookup=True,
+                    additional_registration_ids=[new_registration_id],
+                    app=app,
+                )
+        return replaced
+
+    async def areplace_token(
+        self,
+        old_registration_id: str,
+        new_registration_id: str,
+        topics: Sequence[str] = (),
+        app: Optional["firebase_admin.App"] = None,
+    ) -> int:
+        # transactions are only available to sync code
+        return await sync_to_async(self.replace_token)(
+            old_registration_id, new_registration_id, topics=topics, app=app
+        )
+
+    def _get_registration_id_lookup(self) -> "FCMDeviceQuerySet":
+        """
+        Active devices of the queryset, read from the
+        ``REGISTRATION_ID_READ_DATABASE`` alias unless the queryset is bound to a
+        database with ``using()`` or the write database is in a transaction, which
+        the read database could not see.
+        """
+        queryset = self.filter(active=True)
+        read_database = SETTINGS["REGISTRATION_ID_READ_DATABASE"]
+        if read_database is None or self._db is not None:
+            return queryset
+        write_database = router.db_for_write(self.model, **self._hints)
+        if connections[write_database].in_atomic_block:
+            return queryset.using(write_database)
+        return queryset.using(read_database)
+
+    @timed_stage("db")
     def get_registration_ids(
         self,
         skip_registration_id_lookup: bool = False,
@@ -166,17 +365,21 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         the list of IDs from additional_registration_ids
         :param additional_registration_ids: specific registration_ids to add to the
         QuerySet lookup
-        :returns a list of registration IDs
+        :returns a list of registration IDs, without the tokens of the
+        ``DEAD_TOKEN_CACHE``
         """
         registration_ids = (
             list(additional_registration_ids) if additional_registration_ids else []
         )
         if not skip_registration_id_lookup:
             registration_ids.extend(
-                self.filter(active=True).values_list("registration_id", flat=True)
+                self._get_registration_id_lookup().values_list(
+                    "registration_id", flat=True
+                )
             )
-        return registration_ids
+        return self._exclude_dead_tokens(registration_ids)
 
+    @timed_stage("db")
     async def aget_registration_ids(
         self,
         skip_registration_id_lookup: bool = False,
@@ -187,13 +390,101 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         )
         if not skip_registration_id_lookup:
             async for registration_id in (
-                self.filter(active=True)
+                self._get_registration_id_lookup()
                 .values_list("registration_id", flat=True)
                 .aiterator()
             ):
                 registration_ids.append(registration_id)
-        return registration_ids
+        return self._exclude_dead_tokens(registration_ids)
+
+    @staticmethod
+    def _exclude_dead_tokens(registration_ids: list[str]) -> list[str]:
+        dead_tokens = get_dead_token_cache()
+        if dead_tokens is None:
+            return registration_ids
+        return dead_tokens.exclude(registration_ids)
+
+    def delete(self):
+        user_ids = (
+            list(self.values_list("user_id", flat=True))
+            if get_registration_id_cache() is not None
+            else []
+        )
+        deleted = super().delete()
+        invalidate_user_registration_ids(self.model, user_ids, using=self.db)
+        return deleted
 
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    @timed_stage("db")
+    def get_user_registration_ids(
+        self, user_ids: Iterable[Any]
+    ) -> dict[Any, list[str]]:
+        """
+        Maps the primary key of every user in ``user_ids`` to the registration IDs
+        of their active devices, through the ``USER_REGISTRATION_ID_CACHE`` when it
+        is enabled and the queryset is unfiltered.
+        """
+        return get_user_registration_ids(self, user_ids)
+
+    @profiled
+    def send_to_users(
+        self,
+        user_ids: Iterable[Any],
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> FirebaseResponseDict:
+        """
+        Sends ``message`` to the active devices of the users in ``user_ids``, with
+        their registration IDs read by ``get_user_registration_ids``, in batches of
+        500 like ``send_message``.
+
+        :param user_ids: primary keys of the users
+        :param message: firebase.messaging.Message
+        :param app: firebase_admin.App. Specify a specific app to use
+        :param more_send_message_kwargs: Parameters for firebase.messaging.send_each()
+
+        :raises FirebaseError
+        :returns FirebaseResponseDict, or None when the send was buffered by
+        ``fcm_django.batching.buffer_notifications``
+        """
+        registration_ids = list(
+            itertools.chain.from_iterable(
+                self.get_user_registration_ids(user_ids).values()
+            )
+        )
+        return self.send_message(
+            message,
+            skip_registration_id_lookup=True,
+            additional_registration_ids=registration_ids,
+            app=app,
+            **more_send_message_kwargs,
+        )
+
+    @profiled
+    async def asend_to_users(
+        self,
+        user_ids: Iterable[Any],
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> FirebaseResponseDict:
+        registration_ids = list(
+            itertools.chain.from_iterable(
+                (await sync_to_async(self.get_user_registration_ids)(user_ids)).values()
+            )
+        )
+        return await self.asend_message(
+            message,
+            skip_registration_id_lookup=True,
+            additional_registration_ids=registration_ids,
+            app=app,
+            **more_send_message_kwargs,
+        )
+
+    @profiled
     def send_message(
         self,
         message: messaging.Message,
@@ -220,26 +511,37 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         If there are any new parameters, you can still specify them here.
 
         :raises FirebaseError
-        :returns FirebaseResponseDict
+        :returns FirebaseResponseDict, or None when the send was buffered by
+        ``fcm_django.batching.buffer_notifications``
         """
         registration_ids = self.get_registration_ids(
             skip_registration_id_lookup,
             additional_registration_ids,
         )
+        notification_buffer = get_notification_buffer()
+        if notification_buffer is not None:
+            notification_buffer.add(
+                self.model, registration_ids, message, app, **more_send_message_kwargs
+            )
+            return None
         app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
         if not registration_ids:
             return self.get_default_send_message_response()
         responses: list[messaging.SendResponse] = []
         for i in range(0, len(registration_ids), MAX_MESSAGES_PER_BATCH):
-            messages = [
-                self._prepare_message(message, token)
-                for token in registration_ids[i : i + MAX_MESSAGES_PER_BATCH]
-            ]
-            responses.extend(
-                messaging.send_each(
+            batch_ids = registration_ids[i : i + MAX_MESSAGES_PER_BATCH]
+            with stage("build"):
+                messages = [
+                    self._prepare_message(message, token) for token in batch_ids
+                ]
+            with stage("http"):
+                batch_responses = messaging.send_each(
                     messages, app=app, **more_send_message_kwargs
                 ).responses
+            self.record_send_results(
+                batch_ids, batch_responses, **more_send_message_kwargs
             )
+            responses.extend(batch_responses)
         return FirebaseResponseDict(
             response=messaging.BatchResponse(responses),
             registration_ids_sent=registration_ids,
@@ -248,6 +550,7 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             ),
         )
 
+    @profiled
     async def asend_message(
         self,
         message: messaging.Message,
@@ -260,17 +563,28 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             skip_registration_id_lookup,
             additional_registration_ids,
         )
+        notification_buffer = get_notification_buffer()
+        if notification_buffer is not None:
+            notification_buffer.add(
+                self.model, registration_ids, message, app, **more_send_message_kwargs
+            )
+            return None
         app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
         if not registration_ids:
             return self.get_default_send_message_response()
         responses: list[messaging.SendResponse] = []
         for i in range(0, len(registration_ids), MAX_MESSAGES_PER_BATCH):
-            messages = [
-                self._prepare_message(message, token)
-                for token in registration_ids[i : i + MAX_MESSAGES_PER_BATCH]
-            ]
-            batch_response = await messaging.send_each_async(
-                messages, app=app, **more_send_message_kwargs
+            batch_ids = registration_ids[i : i + MAX_MESSAGES_PER_BATCH]
+            with stage("build"):
+                messages = [
+                    self._prepare_message(message, token) for token in batch_ids
+                ]
+            with stage("http"):
+                batch_response = await messaging.send_each_async(
+                    messages, app=app, **more_send_message_kwargs
+                )
+            await self.arecord_send_results(
+                batch_ids, batch_response.responses, **more_send_message_kwargs
             )
             responses.extend(batch_response.responses)
         return FirebaseResponseDict(
@@ -281,6 +595,7 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             ),
         )
 
+    @profiled
     def send_bulk_personalized_messages(
         self,
         title_template: str,
@@ -327,11 +642,14 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             messages = self._build_bulk_personalized_messages(
                 batch_ids, title_template, body_template, message_data, data_fields
             )
-            responses.extend(
-                messaging.send_each(
+            with stage("http"):
+                batch_responses = messaging.send_each(
                     messages, app=app, **more_send_message_kwargs
                 ).responses
+            self.record_send_results(
+                batch_ids, batch_responses, **more_send_message_kwargs
             )
+            responses.extend(batch_responses)
 
         return FirebaseResponseDict(
             response=messaging.BatchResponse(responses),
@@ -341,6 +659,7 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             ),
         )
 
+    @profiled
     async def asend_bulk_personalized_messages(
         self,
         title_template: str,
@@ -366,8 +685,12 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             messages = self._build_bulk_personalized_messages(
                 batch_ids, title_template, body_template, message_data, data_fields
             )
-            batch_response = await messaging.send_each_async(
-                messages, app=app, **more_send_message_kwargs
+            with stage("http"):
+                batch_response = await messaging.send_each_async(
+                    messages, app=app, **more_send_message_kwargs
+                )
+            await self.arecord_send_results(
+                batch_ids, batch_response.responses, **more_send_message_kwargs
             )
             responses.extend(batch_response.responses)
 
@@ -379,6 +702,217 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             ),
         )
 
+    @profiled
+    def send_many(
+        self,
+        pairs: Iterable[tuple[str, messaging.Message]],
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> FirebaseResponseDict:
+        """
+        Send a different message to each registration ID. Messages are packed into
+        firebase.messaging.send_each batches of 500, and devices failing with a
+        deactivation error are deactivated like in ``send_message``. The queryset
+        filters are not applied to the given registration IDs.
+
+        :param pairs: Iterable of (registration_id, firebase.messaging.Message). The
+        messages are copied and their token is set to the paired registration ID.
+        :param app: firebase_admin.App. Specify a specific app to use
+        :param more_send_message_kwargs: Parameters for firebase.messaging.send_each()
+        - dry_run: bool. Whether to actually send the notification to the device
+
+        :raises FirebaseError
+        :returns FirebaseResponseDict
+        """
+        registration_ids, messages = self._prepare_message_pairs(pairs)
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        if not registration_ids:
+            return self.get_default_send_message_response()
+        responses: list[messaging.SendResponse] = []
+        for i in range(0, len(messages), MAX_MESSAGES_PER_BATCH):
+            with stage("http"):
+                batch_responses = messaging.send_each(
+                    messages[i : i + MAX_MESSAGES_PER_BATCH],
+                    app=app,
+                    **more_send_message_kwargs,
+                ).responses
+            self.record_send_results(
+                registration_ids[i : i + MAX_MESSAGES_PER_BATCH],
+                batch_responses,
+                **more_send_message_kwargs,
+            )
+            responses.extend(batch_responses)
+        return FirebaseResponseDict(
+            response=messaging.BatchResponse(responses),
+            registration_ids_sent=registration_ids,
+            deactivated_registration_ids=self.deactivate_devices_with_error_results(
+                registration_ids, responses
+            ),
+        )
+
+    @profiled
+    async def asend_many(
+        self,
+        pairs: Iterable[tuple[str, messaging.Message]],
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> FirebaseResponseDict:
+        registration_ids, messages = self._prepare_message_pairs(pairs)
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        if not registration_ids:
+            return self.get_default_send_message_response()
+        responses: list[messaging.SendResponse] = []
+        for i in range(0, len(messages), MAX_MESSAGES_PER_BATCH):
+            with stage("http"):
+                batch_response = await messaging.send_each_async(
+                    messages[i : i + MAX_MESSAGES_PER_BATCH],
+                    app=app,
+                    **more_send_message_kwargs,
+                )
+            await self.arecord_send_results(
+                registration_ids[i : i + MAX_MESSAGES_PER_BATCH],
+                batch_response.responses,
+                **more_send_message_kwargs,
+            )
+            responses.extend(batch_response.responses)
+        return FirebaseResponseDict(
+            response=messaging.BatchResponse(responses),
+            registration_ids_sent=registration_ids,
+            deactivated_registration_ids=await self.adeactivate_devices_with_error_results(
+                registration_ids, responses
+            ),
+        )
+
+    def validate_tokens(
+        self,
+        message: Optional[messaging.Message] = None,
+        batch_size: Optional[int] = None,
+        max_per_second: Optional[float] = None,
+        start_after: Any = None,
+        on_batch: Optional[Callable[[TokenValidationResult], None]] = None,
+        app: Optional["firebase_admin.App"] = None,
+    ) -> TokenValidationResult:
+        """
+        Sends ``message`` with ``dry_run=True`` to the active devices of the queryset,
+        in primary key order, and deactivates the devices whose tokens Firebase
+        reports as unregistered or invalid. Nothing is delivered to the devices.
+
+        :param message: firebase.messaging.Message to validate with. Defaults to an
+        empty message.
+        :param batch_size: devices per send_each call, at most 500
+        :param max_per_second: throttles the sweep to this many tokens per second
+        :param start_after: resume after the device with this primary key
+        :param on_batch: called with the running TokenValidationResult after every
+        batch, e.g. to checkpoint ``last_pk``
+        :param app: firebase_admin.App. Specify a specific app to use
+
+        :raises FirebaseError
+        :returns TokenValidationResult
+        """
+        message = messaging.Message() if message is None else message
+        batch_size = min(batch_size or MAX_MESSAGES_PER_BATCH, MAX_MESSAGES_PER_BATCH)
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        devices = self.filter(active=True).order_by("pk")
+        result = TokenValidationResult(0, [], start_after)
+
+        while True:
+            started = time.monotonic()
+            batch = devices
+            if result.last_pk is not None:
+                batch = batch.filter(pk__gt=result.last_pk)
+            rows = list(batch.values_list("pk", "registration_id")[:batch_size])
+            if not rows:
+                return result
+            registration_ids = [registration_id for _, registration_id in rows]
+            responses = messaging.send_each(
+                [self._prepare_message(message, token) for token in registration_ids],
+                app=app,
+                dry_run=True,
+            ).responses
+            result.deactivated_registration_ids.extend(
+                self.deactivate_devices_with_error_results(registration_ids, responses)
+            )
+            result = result._replace(
+                checked_count=result.checked_count + len(rows), last_pk=rows[-1][0]
+            )
+            if on_batch is not None:
+                on_batch(result)
+            if max_per_second:
+                time.sleep(
+                    max(0, len(rows) / max_per_second - (time.monotonic() - started))
+                )
+
+    def snapshot_audience(
+        self, ttl: Optional[Union[timedelta, int]] = None
+    ) -> "AudienceSnapshot":
+        """
+        Stores the primary keys and registration IDs of the active devices of the
+        queryset in an ``AudienceSnapshot`` with a single ``INSERT ... SELECT``, so
+        an expensive targeting query runs once. Send, retry and resume from the
+        snapshot with ``AudienceSnapshot.send_message``. Expired snapshots are
+        deleted first.
+
+        :param ttl: lifetime of the snapshot, in seconds or as a timedelta.
+        Defaults to the ``AUDIENCE_SNAPSHOT_TTL`` setting.
+        :returns AudienceSnapshot
+        """
+        ttl = SETTINGS["AUDIENCE_SNAPSHOT_TTL"] if ttl is None else ttl
+        if not isinstance(ttl, timedelta):
+            ttl = timedelta(seconds=ttl)
+        database = router.db_for_write(AudienceSnapshot)
+        if self._db is not None and self._db != database:
+            raise ValueError(
+                f"Audience snapshots are stored in the {database!r} database, they "
+                f"cannot be taken from a queryset on {self._db!r}."
+            )
+        AudienceSnapshot.objects.using(database).delete_expired()
+
+        entry_table = AudienceSnapshotEntry._meta.db_table
+        connection = connections[database]
+        quote_name = connection.ops.quote_name
+        with transaction.atomic(using=database):
+            snapshot = AudienceSnapshot.objects.using(database).create(
+                expires_at=timezone.now() + ttl
+            )
+            # model columns come before annotations in the compiled SELECT
+            select_sql, params = (
+                self.using(database)
+                .filter(active=True)
+                .order_by()
+                .annotate(
+                    snapshot_id=models.Value(
+                        snapshot.pk, output_field=models.BigIntegerField()
+                    )
+                )
+                .values_list("pk", "registration_id", "snapshot_id")
+                .query.get_compiler(using=database)
+                .as_sql()
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {quote_name(entry_table)} "
+                    f"({quote_name('device_id')}, {quote_name('registration_id')}, "
+                    f"{quote_name('snapshot_id')}) {select_sql}",
+                    params,
+                )
+                snapshot.size = cursor.rowcount
+            snapshot.save(update_fields=["size"])
+        return snapshot
+
+    @staticmethod
+    @timed_stage("build")
+    def _prepare_message_pairs(
+        pairs: Iterable[tuple[str, messaging.Message]],
+    ) -> tuple[list[str], list[messaging.Message]]:
+        registration_ids = []
+        messages = []
+        for registration_id, message in pairs:
+            prepared_message = copy(message)
+            prepared_message.token = registration_id
+            registration_ids.append(registration_id)
+            messages.append(prepared_message)
+        return registration_ids, messages
+
     def deactivate(
         self,
         *,
@@ -387,6 +921,9 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         metadata: Optional[dict[str, Any]] = None,
     ) -> list[str]:
         active_devices = self.filter(active=True)
+        # select from the database the rows are updated in, never from a lagging
+        # replica, so the returned IDs are the devices this call deactivated
+        active_devices._for_write = True
         device_rows = [
             DeviceDeactivationData(*row)
             for row in active_devices.values_list("registration_id", "id", "user_id")
@@ -395,6 +932,11 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             return []
 
         active_devices.update(active=False)
+        invalidate_user_registration_ids(
+            self.model,
+            [device_row.user_id for device_row in device_rows],
+            using=active_devices.db,
+        )
         self._emit_device_deactivated_signal(
             device_rows=device_rows,
             reason=reason,
@@ -411,6 +953,7 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         metadata: Optional[dict[str, Any]] = None,
     ) -> list[str]:
         active_devices = self.filter(active=True)
+        active_devices._for_write = True
         device_rows = [
             DeviceDeactivationData(*row)
             for row in await sync_to_async(list)(
@@ -421,6 +964,11 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             return []
 
         await active_devices.aupdate(active=False)
+        invalidate_user_registration_ids(
+            self.model,
+            [device_row.user_id for device_row in device_rows],
+            using=active_devices.db,
+        )
         await sync_to_async(self._emit_device_deactivated_signal)(
             device_rows=device_rows,
             reason=reason,
@@ -429,6 +977,99 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         )
         return [device_row.registration_id for device_row in device_rows]
 
+    @timed_stage("db")
+    def record_send_results(
+        self,
+        registration_ids: Sequence[str],
+        responses: Sequence[messaging.SendResponse],
+        dry_run: bool = False,
+        **more_send_message_kwargs,
+    ) -> int:
+        """
+        Stamps ``last_success_at`` / ``last_failure_at`` of the devices a batch was
+        sent to with a single UPDATE when the ``TRACK_DEVICE_ACTIVITY`` setting is
+        enabled. Dry runs are not recorded.
+
+        :returns the number of updated devices
+        """
+        if not SETTINGS["TRACK_DEVICE_ACTIVITY"] or dry_run or not registration_ids:
+            return 0
+        devices, updates = self._get_send_result_updates(registration_ids, responses)
+        return devices.update(**updates)
+
+    @timed_stage("db")
+    async def arecord_send_results(
+        self,
+        registration_ids: Sequence[str],
+        responses: Sequence[messaging.SendResponse],
+        dry_run: bool = False,
+        **more_send_message_kwargs,
+    ) -> int:
+        if not SETTINGS["TRACK_DEVICE_ACTIVITY"] or dry_run or not registration_ids:
+            return 0
+        devices, updates = self._get_send_result_updates(registration_ids, responses)
+        return await devices.aupdate(**updates)
+
+    def _get_send_result_updates(
+        self,
+        registration_ids: Sequence[str],
+        responses: Sequence[messaging.SendResponse],
+    ) -> tuple["FCMDeviceQuerySet", dict[str, Any]]:
+        succeeded = []
+        failed = []
+        for registration_id, response in zip(registration_ids, responses):
+            registration_id_hash = hash_registration_id(registration_id)
+            (succeeded if response.success else failed).append(registration_id_hash)
+
+        now = timezone.now()
+        updates = {}
+        for field_name, hashes, other_hashes in (
+            ("last_success_at", succeeded, failed),
+            ("last_failure_at", failed, succeeded),
+        ):
+            if not hashes:
+                continue
+            updates[field_name] = (
+                models.Case(
+                    models.When(
+                        registration_id_hash__in=hashes, then=models.Value(now)
+                    ),
+                    default=models.F(field_name),
+                )
+                if other_hashes
+                else now
+            )
+        return (
+            self.filter(registration_id_hash__in=succeeded + failed),
+            updates,
+        )
+
+    def touch_last_seen(self) -> int:
+        """
+        Sets ``last_seen`` of the devices in this queryset to now with a single
+        UPDATE, skipping devices seen within ``LAST_SEEN_UPDATE_INTERVAL`` seconds.
+        Does nothing unless the ``TRACK_DEVICE_ACTIVITY`` setting is enabled.
+
+        :returns the number of updated devices
+        """
+        if not SETTINGS["TRACK_DEVICE_ACTIVITY"]:
+            return 0
+        return self._get_stale_last_seen().update(last_seen=timezone.now())
+
+    async def atouch_last_seen(self) -> int:
+        if not SETTINGS["TRACK_DEVICE_ACTIVITY"]:
+            return 0
+        return await self._get_stale_last_seen().aupdate(last_seen=timezone.now())
+
+    def _get_stale_last_seen(self) -> "FCMDeviceQuerySet":
+        seen_after = timezone.now() - timedelta(
+            seconds=SETTINGS["LAST_SEEN_UPDATE_INTERVAL"]
+        )
+        return self.filter(
+            models.Q(last_seen__isnull=True) | models.Q(last_seen__lt=seen_after)
+        )
+
+    @timed_stage("deactivate")
     def deactivate_devices_with_error_results(
         self,
         registration_ids: list[str],
@@ -440,8 +1081,9 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         failed_exceptions = self._get_failed_exception_codes(results)
         if not deactivation_candidates:
             return []
-        deactivated_ids = self.filter(
-            registration_id__in=deactivation_candidates
+        self._add_dead_tokens(deactivation_candidates)
+        deactivated_ids = self.filter_by_registration_ids(
+            deactivation_candidates
         ).deactivate(
             reason="firebase_error",
             source="send_message",
@@ -450,6 +1092,7 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         self._delete_inactive_devices_if_requested(deactivated_ids)
         return deactivated_ids
 
+    @timed_stage("deactivate")
     async def adeactivate_devices_with_error_results(
         self,
         registration_ids: list[str],
@@ -461,8 +1104,9 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         failed_exceptions = self._get_failed_exception_codes(results)
         if not deactivation_candidates:
             return []
-        deactivated_ids = await self.filter(
-            registration_id__in=deactivation_candidates
+        self._add_dead_tokens(deactivation_candidates)
+        deactivated_ids = await self.filter_by_registration_ids(
+            deactivation_candidates
         ).adeactivate(
             reason="firebase_error",
             source="send_message",
@@ -471,13 +1115,20 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         await self._adelete_inactive_devices_if_requested(deactivated_ids)
         return deactivated_ids
 
+    @staticmethod
+    def _add_dead_tokens(registration_ids: list[str]) -> None:
+        # also covers tokens without a device, e.g. additional_registration_ids
+        dead_tokens = get_dead_token_cache()
+        if dead_tokens is not None:
+            dead_tokens.add(registration_ids)
+
     def _delete_inactive_devices_if_requested(self, registration_ids: list[str]):
         if SETTINGS["DELETE_INACTIVE_DEVICES"]:
-            self.filter(registration_id__in=registration_ids).delete()
+            self.filter_by_registration_ids(registration_ids).delete()
 
     async def _adelete_inactive_devices_if_requested(self, registration_ids: list[str]):
         if SETTINGS["DELETE_INACTIVE_DEVICES"]:
-            await self.filter(registration_id__in=registration_ids).adelete()
+            await self.filter_by_registration_ids(registration_ids).adelete()
 
     @staticmethod
     def _get_failed_exception_codes(
@@ -529,6 +1180,7 @@ class FCMDeviceQuerySet(models.query.QuerySet):
             deactivated_registration_ids=[],
         )
 
+    @profiled
     def handle_topic_subscription(
         self,
         should_subscribe: bool,
@@ -569,11 +1221,12 @@ class FCMDeviceQuerySet(models.query.QuerySet):
         topic_results: list[dict[str, str]] = [{} for _ in registration_ids]
         for i in range(0, len(registration_ids), MAX_DEVICES_PER_SUBSCRIBE_REQUEST):
             batch_ids = registration_ids[i : i + MAX_DEVICES_PER_SUBSCRIBE_REQUEST]
-            batch_response = (
-                messaging.subscribe_to_topic
-                if should_subscribe
-                else messaging.unsubscribe_from_topic
-            )(batch_ids, topic, app=app, **more_subscribe_kwargs)
+            with stage("http"):
+                batch_response = (
+                    messaging.subscribe_to_topic
+                    if should_subscribe
+                    else messaging.unsubscribe_from_topic
+                )(batch_ids, topic, app=app, **more_subscribe_kwargs)
             for error in batch_response.errors:
                 topic_results[i + error.index] = {"error": error.reason}
 
@@ -610,6 +1263,11 @@ class AbstractFCMDevice(Device):
         verbose_name=_("Registration token"),
         unique=not SETTINGS["MYSQL_COMPATIBILITY"],
     )
+    registration_id_hash = RegistrationIdHashField(
+        verbose_name=_("Registration token hash"),
+        unique=True,
+        null=True,
+    )
     type = models.CharField(choices=DeviceType.choices, max_length=10)
     objects: "FCMDeviceQuerySet" = FCMDeviceManager()
 
@@ -620,6 +1278,36 @@ class AbstractFCMDevice(Device):
             models.Index(fields=["registration_id", "user"]),
         ]
 
+    def save(self, *args, **kwargs):
+        user_ids = [self.user_id]
+        update_fields = kwargs.get("update_fields")
+        if (
+            not self._state.adding
+            and get_registration_id_cache() is not None
+            and (update_fields is None or {"user", "user_id"} & set(update_fields))
+        ):
+            # the device may move to another user, whose cache is stale too
+            user_ids.extend(
+                type(self)
+                ._base_manager.using(
+                    kwargs.get("using")
+                    or router.db_for_write(type(self), instance=self)
+                )
+                .filter(pk=self.pk)
+                .values_list("user_id", flat=True)
+            )
+        super().save(*args, **kwargs)
+        invalidate_user_registration_ids(type(self), user_ids, using=self._state.db)
+        if self.active:
+            discard_dead_tokens([self.registration_id])
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        invalidate_user_registration_ids(
+            type(self), [self.user_id], using=self._state.db
+        )
+        return deleted
+
     def send_message(
         self,
         message: messaging.Message,
@@ -639,23 +1327,97 @@ class AbstractFCMDevice(Device):
 
         :raises FirebaseError
         :returns messaging.SendResponse or FirebaseError if the device was
-        deactivated due to an error.
+        deactivated due to an error, or None when the send was buffered by
+        ``fcm_django.batching.buffer_notifications``.
         """
         if not self.active:
             return messaging.SendResponse(
                 None,
                 None,
             )
+        notification_buffer = get_notification_buffer()
+        if notification_buffer is not None:
+            notification_buffer.add(
+                type(self),
+                [self.registration_id],
+                message,
+                app,
+                **more_send_message_kwargs,
+            )
+            return None
+        if SETTINGS["COALESCE_SINGLE_SENDS"]:
+            return get_default_coalescer().send_message(
+                self, message, app=app, **more_send_message_kwargs
+            )
         app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
         message.token = self.registration_id
         try:
-            return messaging.SendResponse(
+            response = messaging.SendResponse(
                 {"name": messaging.send(message, app=app, **more_send_message_kwargs)},
                 None,
             )
         except FirebaseError as e:
+            type(self).objects.record_send_results(
+                [self.registration_id],
+                [messaging.SendResponse(None, e)],
+                **more_send_message_kwargs,
+            )
             self.deactivate_devices_with_error_result(self.registration_id, e)
             raise
+        type(self).objects.record_send_results(
+            [self.registration_id], [response], **more_send_message_kwargs
+        )
+        return response
+
+    async def asend_message(
+        self,
+        message: messaging.Message,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> messaging.SendResponse:
+        """
+        Async counterpart of ``send_message``. Sends through
+        firebase.messaging.send_each_async so no thread is held for the duration of
+        the request.
+
+        :raises FirebaseError
+        :returns messaging.SendResponse, or None when the send was buffered by
+        ``fcm_django.batching.buffer_notifications``
+        """
+        if not self.active:
+            return messaging.SendResponse(
+                None,
+                None,
+            )
+        notification_buffer = get_notification_buffer()
+        if notification_buffer is not None:
+            notification_buffer.add(
+                type(self),
+                [self.registration_id],
+                message,
+                app,
+                **more_send_message_kwargs,
+            )
+            return None
+        if SETTINGS["COALESCE_SINGLE_SENDS"]:
+            return await get_default_coalescer().asend_message(
+                self, message, app=app, **more_send_message_kwargs
+            )
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        message.token = self.registration_id
+        batch_response = await messaging.send_each_async(
+            [message], app=app, **more_send_message_kwargs
+        )
+        response = batch_response.responses[0]
+        await type(self).objects.arecord_send_results(
+            [self.registration_id], [response], **more_send_message_kwargs
+        )
+        if response.exception:
+            await self.adeactivate_devices_with_error_result(
+                self.registration_id, response.exception
+            )
+            raise response.exception
+        return response
 
     def handle_topic_subscription(
         self,
@@ -689,9 +1451,50 @@ class AbstractFCMDevice(Device):
         return FirebaseResponseDict(
             response=response,
             registration_ids_sent=_r_ids,
-            deactivated_registration_ids=type(
-                self
-            ).objects.deactivate_devices_with_error_results(_r_ids, response.errors),
+            deactivated_registration_ids=(
+                type(self).objects.deactivate_devices_with_error_results(
+                    _r_ids, response.errors
+                )
+                if response.errors
+                else []
+            ),
+        )
+
+    async def ahandle_topic_subscription(
+        self,
+        should_subscribe: bool,
+        topic: str,
+        app: Optional["firebase_admin.App"] = None,
+        **more_subscribe_kwargs,
+    ) -> FirebaseResponseDict:
+        """
+        Async counterpart of ``handle_topic_subscription``. Uses the native async
+        topic management API when the installed firebase-admin provides it.
+
+        :raises FirebaseError
+        :returns FirebaseResponseDict
+        """
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        _r_ids = [self.registration_id]
+        if should_subscribe:
+            subscribe = getattr(messaging, "subscribe_to_topic_async", None)
+            if subscribe is None:
+                subscribe = sync_to_async(messaging.subscribe_to_topic)
+        else:
+            subscribe = getattr(messaging, "unsubscribe_from_topic_async", None)
+            if subscribe is None:
+                subscribe = sync_to_async(messaging.unsubscribe_from_topic)
+        response = await subscribe(_r_ids, topic, app=app, **more_subscribe_kwargs)
+        return FirebaseResponseDict(
+            response=response,
+            registration_ids_sent=_r_ids,
+            deactivated_registration_ids=(
+                await type(self).objects.adeactivate_devices_with_error_results(
+                    _r_ids, response.errors
+                )
+                if response.errors
+                else []
+            ),
         )
 
     @classmethod
@@ -702,6 +1505,14 @@ class AbstractFCMDevice(Device):
             [registration_id], [messaging.SendResponse({"name": name}, firebase_exc)]
         )
 
+    @classmethod
+    async def adeactivate_devices_with_error_result(
+        cls, registration_id, firebase_exc, name=None
+    ) -> list[str]:
+        return await cls.objects.adeactivate_devices_with_error_results(
+            [registration_id], [messaging.SendResponse({"name": name}, firebase_exc)]
+        )
+
     @staticmethod
     def send_topic_message(
         message: messaging.Message,
@@ -717,6 +1528,120 @@ class AbstractFCMDevice(Device):
             None,
         )
 
+    @staticmethod
+    def _prepare_topic_messages(
+        messages: Union[messaging.Message, Sequence[messaging.Message]],
+        topics: Sequence[str],
+        conditions: Sequence[str],
+    ) -> tuple[list[messaging.Message], list[str]]:
+        if isinstance(messages, messaging.Message):
+            messages = [messages]
+        prepared_messages = []
+        targets = []
+        for message in messages:
+            for topic in topics:
+                prepared_message = copy(message)
+                prepared_message.token = None
+                prepared_message.condition = None
+                prepared_message.topic = topic
+                prepared_messages.append(prepared_message)
+                targets.append(topic)
+            for condition in conditions:
+                prepared_message = copy(message)
+                prepared_message.token = None
+                prepared_message.topic = None
+                prepared_message.condition = condition
+                prepared_messages.append(prepared_message)
+                targets.append(condition)
+        return prepared_messages, targets
+
+    @classmethod
+    def send_topic_messages(
+        cls,
+        messages: Union[messaging.Message, Sequence[messaging.Message]],
+        topics: Sequence[str] = (),
+        conditions: Sequence[str] = (),
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> FirebaseTopicResponseDict:
+        """
+        Send one or more messages to every given topic and condition. Every
+        message/target pair becomes a single message in firebase.messaging.send_each,
+        so for every 500 pairs we make a single call to Firebase. The given messages
+        are copied and left untouched.
+
+        :param messages: firebase.messaging.Message or a sequence of them. Any token,
+        topic or condition on the messages will be overridden.
+        :param topics: Names of the topics to send to. May contain the ``/topics/``
+        prefix.
+        :param conditions: Topic conditions to send to, e.g.
+        ``"'news' in topics && 'sports' in topics"``.
+        :param app: firebase_admin.App. Specify a specific app to use
+        :param more_send_message_kwargs: Parameters for firebase.messaging.send_each()
+        - dry_run: bool. Whether to actually send the notification to the device
+        If there are any new parameters, you can still specify them here.
+
+        :raises FirebaseError
+        :returns FirebaseTopicResponseDict
+        """
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        prepared_messages, targets = cls._prepare_topic_messages(
+            messages, topics, conditions
+        )
+        responses: list[messaging.SendResponse] = []
+        for i in range(0, len(prepared_messages), MAX_MESSAGES_PER_BATCH):
+            responses.extend(
+                messaging.send_each(
+                    prepared_messages[i : i + MAX_MESSAGES_PER_BATCH],
+                    app=app,
+                    **more_send_message_kwargs,
+                ).responses
+            )
+        return FirebaseTopicResponseDict(
+            response=messaging.BatchResponse(responses),
+            topics_sent=targets,
+        )
+
+    @classmethod
+    async def asend_topic_messages(
+        cls,
+        messages: Union[messaging.Message, Sequence[messaging.Message]],
+        topics: Sequence[str] = (),
+        conditions: Sequence[str] = (),
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> FirebaseTopicResponseDict:
+        """
+        Async counterpart of ``send_topic_messages``. Batches of 500 messages are sent
+        with firebase.messaging.send_each_async, at most ``ASYNC_SEND_CONCURRENCY``
+        of them concurrently.
+        """
+        app = SETTINGS["DEFAULT_FIREBASE_APP"] if app is None else app
+        prepared_messages, targets = cls._prepare_topic_messages(
+            messages, topics, conditions
+        )
+        semaphore = asyncio.Semaphore(SETTINGS["ASYNC_SEND_CONCURRENCY"])
+
+        async def send_batch(batch: list[messaging.Message]) -> messaging.BatchResponse:
+            async with semaphore:
+                return await messaging.send_each_async(
+                    batch, app=app, **more_send_message_kwargs
+                )
+
+        batch_responses = await asyncio.gather(
+            *(
+                send_batch(prepared_messages[i : i + MAX_MESSAGES_PER_BATCH])
+                for i in range(0, len(prepared_messages), MAX_MESSAGES_PER_BATCH)
+            )
+        )
+        responses: list[messaging.SendResponse] = []
+        for batch_response in batch_responses:
+            responses.extend(batch_response.responses)
+        return FirebaseTopicResponseDict(
+            response=messaging.BatchResponse(responses),
+            topics_sent=targets,
+        )
+
 
 class FCMDevice(AbstractFCMDevice):
     class Meta:
@@ -730,3 +1655,149 @@ class FCMDevice(AbstractFCMDevice):
 
         app_label = "fcm_django"
         swappable = swapper.swappable_setting("fcm_django", "fcmdevice")
+
+
+class AudienceSnapshotQuerySet(models.query.QuerySet):
+    def delete_expired(self) -> int:
+        """
+        Deletes the expired snapshots and their entries with plain DELETEs.
+
+        :returns the number of deleted snapshots
+        """
+        expired = self.filter(expires_at__lte=timezone.now())
+        entries = AudienceSnapshotEntry.objects.using(expired.db).filter(
+            snapshot__in=expired
+        )
+        entries._raw_delete(entries.db)
+        return expired._raw_delete(expired.db)
+
+
+class AudienceSnapshot(models.Model):
+    """
+    Registration IDs of an audience, frozen by
+    ``FCMDeviceQuerySet.snapshot_audience`` until ``expires_at``.
+    """
+
+    id = models.AutoField(
+        verbose_name="ID",
+        primary_key=True,
+        auto_created=True,
+    )
+    created_at = models.DateTimeField(verbose_name=_("Created at"), auto_now_add=True)
+    expires_at = models.DateTimeField(verbose_name=_("Expires at"), db_index=True)
+    size = models.PositiveIntegerField(verbose_name=_("Size"), default=0)
+
+    objects = AudienceSnapshotQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("Audience snapshot")
+        verbose_name_plural = _("Audience snapshots")
+        app_label = "fcm_django"
+
+    def __str__(self):
+        return f"Audience snapshot {self.pk} ({self.size} devices)"
+
+    @property
+    def is_expired(self) -> bool:
+        return self.expires_at <= timezone.now()
+
+    def iter_registration_ids(
+        self, batch_size: Optional[int] = None, start_after: Any = None
+    ) -> Iterator[tuple[list[str], Any]]:
+        """
+        Yields the registration IDs of the snapshot in batches of ``batch_size``
+        (at most 500), each with the primary key of its last entry to resume after.
+        """
+        batch_size = min(batch_size or MAX_MESSAGES_PER_BATCH, MAX_MESSAGES_PER_BATCH)
+        entries = AudienceSnapshotEntry.objects.using(self._state.db).filter(
+            snapshot=self
+        )
+        last_pk = start_after
+        while True:
+            batch = entries if last_pk is None else entries.filter(pk__gt=last_pk)
+            rows = list(
+                batch.order_by("pk").values_list("pk", "registration_id")[:batch_size]
+            )
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield [registration_id for _, registration_id in rows], last_pk
+            if len(rows) < batch_size:
+                return
+
+    def send_message(
+        self,
+        message: messaging.Message,
+        batch_size: Optional[int] = None,
+        start_after: Any = None,
+        on_batch: Optional[Callable[[AudienceSendResult], None]] = None,
+        app: Optional["firebase_admin.App"] = None,
+        **more_send_message_kwargs,
+    ) -> AudienceSendResult:
+        """
+        Sends ``message`` to the snapshot in entry order, streaming one batch of
+        registration IDs at a time, and deactivates the devices failing with a
+        deactivation error like ``FCMDeviceQuerySet.send_message``.
+
+        :param message: firebase.messaging.Message
+        :param batch_size: registration IDs per send_each call, at most 500
+        :param start_after: resume after the entry with this primary key
+        :param on_batch: called with the running AudienceSendResult after every
+        batch, e.g. to checkpoint ``last_pk``
+        :param app: firebase_admin.App. Specify a specific app to use
+        :param more_send_message_kwargs: Parameters for firebase.messaging.send_each()
+
+        :raises FirebaseError
+        :raises ValueError if the snapshot expired
+        :returns AudienceSendResult
+        """
+        if self.is_expired:
+            raise ValueError(f"{self} expired at {self.expires_at}.")
+        Device = swapper.load_model("fcm_django", "fcmdevice")
+        devices = Device.objects.using(self._state.db)
+        result = AudienceSendResult(0, 0, [], start_after)
+        # sent as a whole, a snapshot is never held back by a notification buffer
+        with bypass_notification_buffer():
+            for registration_ids, last_pk in self.iter_registration_ids(
+                batch_size, start_after
+            ):
+                response = devices.send_message(
+                    message,
+                    skip_registration_id_lookup=True,
+                    additional_registration_ids=registration_ids,
+                    app=app,
+                    **more_send_message_kwargs,
+                )
+                result.deactivated_registration_ids.extend(
+                    response.deactivated_registration_ids
+                )
+                result = result._replace(
+                    sent_count=result.sent_count + len(registration_ids),
+                    failure_count=result.failure_count + response.failure_count,
+                    last_pk=last_pk,
+                )
+                if on_batch is not None:
+                    on_batch(result)
+        return result
+
+
+class AudienceSnapshotEntry(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    snapshot = models.ForeignKey(
+        AudienceSnapshot,
+        on_delete=models.CASCADE,
+        related_name="entries",
+        db_index=False,
+    )
+    # no constraint: devices may be deleted while a snapshot is in use
+    device = models.ForeignKey(
+        swapper.get_model_name("fcm_django", "fcmdevice"),
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name="+",
+    )
+    registration_id = models.TextField()
+
+    class Meta:
+        app_label = "fcm_django"
+        indexes = [models.Index(fields=["snapshot", "id"])]
@@ -0,0 +1,136 @@
+from django.db import models
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
+
+from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
+
+_MYSQL = "mysql"
+_POSTGRESQL = "postgresql"
+
+
+def get_active_device_indexes(model, connection) -> list[models.Index]:
+    """
+    Indexes serving the active registration ID lookups every send runs, adapted to
+    what the backend supports:
+
+    - PostgreSQL: a partial ``(id) INCLUDE (registration_id) WHERE active`` index
+      and a covering ``(user_id, active) INCLUDE (registration_id)`` index
+    - SQLite: a partial ``(registration_id) WHERE active`` index and a
+      ``(user_id, active, registration_id)`` index
+    - MySQL/MariaDB: a ``(user_id, active)`` index (no partial indexes, and the
+      registration_id text column cannot be indexed without a prefix)
+    """
+    table = model._meta.db_table
+    max_name_length = connection.ops.max_name_length() or 63
+
+    def _name(suffix: str) -> str:
+        return truncate_name(f"{table}_{suffix}", max_name_length)
+
+    if connection.vendor == _MYSQL:
+        return [models.Index(fields=["user", "active"], name=_name("user_active"))]
+    if connection.vendor == _POSTGRESQL:
+        return [
+            models.Index(
+                fields=["id"],
+                include=["registration_id"],
+                condition=models.Q(active=True),
+                name=_name("active_token"),
+            ),
+            models.Index(
+                fields=["user", "active"],
+                include=["registration_id"],
+                name=_name("user_active"),
+            ),
+        ]
+    indexes = [
+        models.Index(
+            fields=["user", "active", "registration_id"], name=_name("user_active")
+        )
+    ]
+    if connection.features.supports_partial_indexes:
+        indexes.insert(
+            0,
+            models.Index(
+                fields=["registration_id"],
+                condition=models.Q(active=True),
+                name=_name("active_token"),
+            ),
+        )
+    return indexes
+
+
+def add_active_device_indexes(
+    schema_editor, model, concurrently: bool = False
+) -> list[models.Index]:
+    """
+    Creates the ``get_active_device_indexes`` of ``model`` that do not exist yet.
+    ``concurrently`` builds them without locking writes, on PostgreSQL only and
+    outside of a transaction.
+
+    :returns the created indexes
+    """
+    existing = _get_existing_index_names(schema_editor, model)
+    created = []
+    for index in get_active_device_indexes(model, schema_editor.connection):
+        if index.name in existing:
+            continue
+        if concurrently:
+            schema_editor.add_index(model, index, concurrently=True)
+        else:
+            schema_editor.add_index(model, index)
+        created.append(index)
+    return created
+
+
+def _get_existing_index_names(schema_editor, model) -> set[str]:
+    with schema_editor.connection.cursor() as cursor:
+        return set(
+            schema_editor.connection.introspection.get_constraints(
+                cursor, model._meta.db_table
+            )
+        )
+
+
+class AddActiveDeviceIndexes(Operation):
+    """
+    Database-only operation creating ``get_active_device_indexes`` for a device
+    model when the ``ACTIVE_DEVICE_INDEXES`` setting is enabled. The indexes are
+    not part of the model state, so toggling the setting never produces new
+    migrations. Also usable in the migrations of a custom device model.
+    """
+
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name: str) -> None:
+        self.model_name = model_name
+
+    def deconstruct(self):
+        return self.__class__.__name__, [], {"model_name": self.model_name}
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not SETTINGS["ACTIVE_DEVICE_INDEXES"]:
+            return
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        add_active_device_indexes(schema_editor, model)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        existing = _get_existing_index_names(schema_editor, model)
+        for index in get_active_device_indexes(model, schema_editor.connection):
+            if index.name in existing:
+                schema_editor.remove_index(model, index)
+
+    def describe(self):
+        return f"Add optional active device indexes to {self.model_name}"
+
+    @property
+    def migration_name_fragment(self):
+        return f"{self.model_name.lower()}_active_device_indexes"
@@ -0,0 +1,256 @@
+import cProfile
+import itertools
+import json
+import logging
+import os
+import pstats
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from typing import Any, NamedTuple, Optional, Union
+
+from asgiref.sync import iscoroutinefunction
+from firebase_admin import messaging
+
+from fcm_django.settings import FCM_DJANGO_SETTINGS as SETTINGS
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("db", "build", "encode", "http", "deactivate")
+
+
+class SendProfile:
+    """
+    Timings of one profiled send: its total ``duration`` and the seconds spent in
+    every stage of ``STAGES``, plus the cProfile ``profiler`` when enabled. ``http``
+    excludes the encoding of the messages, which firebase_admin does right before
+    sending them.
+    """
+
+    def __init__(self, operation: str, cprofile: bool = False) -> None:
+        self.operation = operation
+        self.duration = 0.0
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.profiler = cProfile.Profile() if cprofile else None
+
+    @property
+    def other(self) -> float:
+        """Seconds spent outside of the stages."""
+        return max(self.duration - sum(self.stages.values()), 0.0)
+
+    def stats(self) -> pstats.Stats:
+        if self.profiler is None:
+            raise ValueError(f"{self.operation} was profiled without cProfile.")
+        return pstats.Stats(self.profiler)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "operation": self.operation,
+            "duration": self.duration,
+            "stages": {**self.stages, "other": self.other},
+        }
+
+    def __str__(self) -> str:
+        stages = ", ".join(
+            f"{stage} {duration:.3f}s"
+            for stage, duration in [*self.stages.items(), ("other", self.other)]
+        )
+        return f"{self.operation} took {self.duration:.3f}s ({stages})"
+
+
+class _ProfileConfig(NamedTuple):
+    directory: Optional[Path]
+    cprofile: bool
+    profiles: Optional[list[SendProfile]]
+
+
+_profile_config: ContextVar[Optional[_ProfileConfig]] = ContextVar(
+    "fcm_django_profile_config", default=None
+)
+_active_profile: ContextVar[Optional[SendProfile]] = ContextVar(
+    "fcm_django_active_profile", default=None
+)
+_file_counter = itertools.count()
+
+
+@contextmanager
+def profile_sends(
+    directory: Optional[Union[str, os.PathLike]] = None, cprofile: bool = True
+) -> Iterator[list[SendProfile]]:
+    """
+    Profile every queryset send, personalized send and topic subscription made
+    inside the block. The block gets the list of SendProfile collected so far.
+    Every profile is logged to the ``fcm_django.profiling`` logger, and with
+    ``directory`` its cProfile output (``.prof``) and stage timings (``.json``) are
+    written there too.
+    """
+    profiles: list[SendProfile] = []
+    token = _profile_config.set(
+        _ProfileConfig(
+            Path(directory) if directory is not None else None, cprofile, profiles
+        )
+    )
+    try:
+        yield profiles
+    finally:
+        _profile_config.reset(token)
+
+
+def _get_profile_config() -> Optional[_ProfileConfig]:
+    config = _profile_config.get()
+    if config is None and SETTINGS["PROFILE_SENDS"]:
+        directory = SETTINGS["PROFILE_SENDS_DIR"]
+        config = _ProfileConfig(
+            Path(directory) if directory else None, bool(directory), None
+        )
+    return config
+
+
+def _save_profile(profile: SendProfile, config: _ProfileConfig) -> None:
+    if config.profiles is not None:
+        config.profiles.append(profile)
+    logger.info("%s", profile)
+    if config.directory is not None:
+        config.directory.mkdir(parents=True, exist_ok=True)
+        name = (
+            f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(_file_counter)}-"
+            f"{profile.operation}"
+        )
+        if profile.profiler is not None:
+            profile.profiler.dump_stats(config.directory / f"{name}.prof")
+        (config.directory / f"{name}.json").write_text(json.dumps(profile.as_dict()))
+
+
+def _start_profile(operation: str) -> tuple[Optional[SendProfile], Any]:
+    if _active_profile.get() is not None:
+        # already inside a profiled send
+        return None, None
+    config = _get_profile_config()
+    if config is None:
+        return None, None
+    _instrument_encoding()
+    profile = SendProfile(operation, cprofile=config.cprofile)
+    if profile.profiler is not None:
+        try:
+            profile.profiler.enable()
+        except ValueError:
+            # another profiler is active on this thread
+            profile.profiler = None
+    profile.duration = time.perf_counter()
+    return profile, (_active_profile.set(profile), config)
+
+
+def _finish_profile(profile: SendProfile, state) -> None:
+    profile.duration = time.perf_counter() - profile.duration
+    if profile.profiler is not None:
+        profile.profiler.disable()
+    token, config = state
+    _active_profile.reset(token)
+    profile.stages["http"] = max(profile.stages["http"] - profile.stages["encode"], 0)
+    _save_profile(profile, config)
+
+
+def profiled(func):
+    """Profiles the decorated send method while profiling is enabled."""
+    if iscoroutinefunction(func):
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            profile, state = _start_profile(func.__name__)
+            if profile is None:
+                return await func(*args, **kwargs)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _finish_profile(profile, state)
+
+    else:
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profile, state = _start_profile(func.__name__)
+            if profile is None:
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _finish_profile(profile, state)
+
+    return wrapper
+
+
+class _StageTimer:
+    __slots__ = ("profile", "stage", "start")
+
+    def __init__(self, profile: SendProfile, stage: str) -> None:
+        self.profile = profile
+        self.stage = stage
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.profile.stages[self.stage] += time.perf_counter() - self.start
+
+
+_null_stage = nullcontext()
+
+
+def stage(name: str):
+    """Context manager adding the time spent in the block to the current profile."""
+    profile = _active_profile.get()
+    if profile is None:
+        return _null_stage
+    return _StageTimer(profile, name)
+
+
+def timed_stage(name: str):
+    """Decorator adding the time spent in the function to the current profile."""
+
+    def decorator(func):
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with stage(name):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+_encoding_instrumented = False
+
+
+def _instrument_encoding() -> None:
+    """
+    Times the message encoding firebase_admin does before sending, which is
+    otherwise counted as ``http``. Installed once, on the first profiled send.
+    """
+    global _encoding_instrumented
+    if _encoding_instrumented:
+        return
+    _encoding_instrumented = True
+    service_class = getattr(messaging, "_MessagingService", None)
+    message_data = getattr(service_class, "_message_data", None)
+    if message_data is None:
+        # not available in this firebase_admin version
+        return
+
+    @wraps(message_data)
+    def timed_message_data(*args, **kwargs):
+        with stage("encode"):
+            return message_data(*args, **kwargs)
+
+    service_class._message_data = timed_message_data
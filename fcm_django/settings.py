@@ -13,6 +13,7 @@ DEFAULT_SETTINGS = {
     "DELETE_INACTIVE_DEVICES": False,
     "EMIT_DEVICE_DEACTIVATED_SIGNAL": False,
     "UPDATE_ON_DUPLICATE_REG_ID": True,
+    "UPSERT_DEVICE_REGISTRATION": False,
     "ERRORS": {
         "invalid_registration": "InvalidRegistration",
         "missing_registration": "MissingRegistration",
@@ -20,6 +21,21 @@ DEFAULT_SETTINGS = {
         "invalid_package_name": "InvalidPackageName",
     },
     "MYSQL_COMPATIBILITY": False,
+    "ACTIVE_DEVICE_INDEXES": False,
+    "COALESCE_SINGLE_SENDS": False,
+    "COALESCE_MAX_DELAY": 0.005,
+    "NOTIFICATION_BUFFER_BACKGROUND_FLUSH": False,
+    "TRACK_DEVICE_ACTIVITY": False,
+    "LAST_SEEN_UPDATE_INTERVAL": 3600,
+    "REGISTRATION_ID_READ_DATABASE": None,
+    "AUDIENCE_SNAPSHOT_TTL": 86400,
+    "USER_REGISTRATION_ID_CACHE": None,
+    "USER_REGISTRATION_ID_CACHE_TIMEOUT": 300,
+    "DEAD_TOKEN_CACHE_SIZE": 0,
+    "DEAD_TOKEN_CACHE_TTL": 3600,
+    "PROFILE_SENDS": False,
+    "PROFILE_SENDS_DIR": None,
+    "ASYNC_SEND_CONCURRENCY": 10,
 }
 
 
@@ -0,0 +1,650 @@
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections import defaultdict, deque
+from collections.abc import Iterable
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import PathLike
+from typing import IO, Any, Callable, NamedTuple, Optional, Union
+from unittest import mock
+
+import firebase_admin
+import requests
+from firebase_admin import credentials, exceptions, messaging
+from google.auth.credentials import AnonymousCredentials
+
+OK = "OK"
+
+# FCM error code -> (HTTP status, canonical status)
+_FCM_ERRORS = {
+    "INVALID_ARGUMENT": (400, "INVALID_ARGUMENT"),
+    "SENDER_ID_MISMATCH": (403, "PERMISSION_DENIED"),
+    "UNREGISTERED": (404, "NOT_FOUND"),
+    "QUOTA_EXCEEDED": (429, "RESOURCE_EXHAUSTED"),
+    "INTERNAL": (500, "INTERNAL"),
+    "UNAVAILABLE": (503, "UNAVAILABLE"),
+}
+_FCM_ERROR_TYPE = "type.googleapis.com/google.firebase.fcm.v1.FcmError"
+
+# FCM error code -> exception raised by firebase_admin
+_FCM_ERROR_CLASSES = {
+    "UNREGISTERED": messaging.UnregisteredError,
+    "SENDER_ID_MISMATCH": messaging.SenderIdMismatchError,
+    "QUOTA_EXCEEDED": messaging.QuotaExceededError,
+    "THIRD_PARTY_AUTH_ERROR": messaging.ThirdPartyAuthError,
+}
+# canonical status -> exception raised by firebase_admin
+_STATUS_ERROR_CLASSES = {
+    exceptions.INVALID_ARGUMENT: exceptions.InvalidArgumentError,
+    exceptions.UNAUTHENTICATED: exceptions.UnauthenticatedError,
+    exceptions.PERMISSION_DENIED: exceptions.PermissionDeniedError,
+    exceptions.NOT_FOUND: exceptions.NotFoundError,
+    exceptions.RESOURCE_EXHAUSTED: exceptions.ResourceExhaustedError,
+    exceptions.INTERNAL: exceptions.InternalError,
+    exceptions.UNAVAILABLE: exceptions.UnavailableError,
+    exceptions.DEADLINE_EXCEEDED: exceptions.DeadlineExceededError,
+}
+
+
+class EmulatedSend(NamedTuple):
+    token: Optional[str]
+    message: dict[str, Any]
+    validate_only: bool
+    outcome: str
+
+
+class _EmulatorCredential(credentials.Base):
+    def get_credential(self):
+        return AnonymousCredentials()
+
+
+class _RedirectAdapter(requests.adapters.HTTPAdapter):
+    """Sends the requests to the URL prefix it is mounted on to ``base_url`` instead"""
+
+    def __init__(self, prefix: str, base_url: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.prefix = prefix
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        request.url = self.base_url + request.url[len(self.prefix) :]
+        return super().send(request, **kwargs)
+
+
+class _MessagingPatch:
+    """
+    Context manager replacing ``firebase_admin.messaging`` functions with the ones
+    returned by ``get_patches``.
+    """
+
+    _patcher = None
+
+    def get_patches(self) -> dict[str, Callable]:
+        raise NotImplementedError
+
+    def __enter__(self):
+        self._patcher = mock.patch.multiple(messaging, **self.get_patches())
+        self._patcher.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._patcher.stop()
+        self._patcher = None
+
+
+class FakeTransport(_MessagingPatch):
+    """
+    In-process stand-in for the FCM API, for load tests and benchmarks that should
+    only measure fcm-django's own work. Every call is answered at once (or after
+    ``latency`` seconds), failing the tokens in ``failing`` and a ``failure_rate``
+    share of the other tokens with UNREGISTERED.
+
+    Used as a context manager, it replaces the ``firebase_admin.messaging`` send and
+    topic management functions::
+
+        with FakeTransport(failure_rate=0.02):
+            FCMDevice.objects.send_message(message)
+    """
+
+    def __init__(
+        self,
+        failing: Iterable[str] = (),
+        failure_rate: float = 0,
+        latency: float = 0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.failing = frozenset(failing)
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self._random = random.Random(seed)
+        self._ok = messaging.SendResponse({"name": "projects/fake/messages/1"}, None)
+        self._unregistered = messaging.SendResponse(
+            None, messaging.UnregisteredError("Requested entity was not found.")
+        )
+
+    def get_patches(self) -> dict[str, Callable]:
+        return {
+            "send": self.send,
+            "send_each": self.send_each,
+            "send_each_async": self.send_each_async,
+            "subscribe_to_topic": self.subscribe_to_topic,
+            "unsubscribe_from_topic": self.unsubscribe_from_topic,
+        }
+
+    def _fails(self, token: Optional[str]) -> bool:
+        return token in self.failing or (
+            self.failure_rate > 0 and self._random.random() < self.failure_rate
+        )
+
+    def _batch_response(self, messages) -> messaging.BatchResponse:
+        return messaging.BatchResponse(
+            [
+                self._unregistered if self._fails(message.token) else self._ok
+                for message in messages
+            ]
+        )
+
+    def send(self, message, dry_run=False, app=None) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        if self._fails(message.token):
+            raise self._unregistered.exception
+        return self._ok.message_id
+
+    def send_each(self, messages, dry_run=False, app=None) -> messaging.BatchResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._batch_response(messages)
+
+    async def send_each_async(
+        self, messages, dry_run=False, app=None
+    ) -> messaging.BatchResponse:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._batch_response(messages)
+
+    def subscribe_to_topic(
+        self, tokens, topic, app=None
+    ) -> messaging.TopicManagementResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        return messaging.TopicManagementResponse(
+            {
+                "results": [
+                    {"error": "NOT_FOUND"} if self._fails(token) else {}
+                    for token in tokens
+                ]
+            }
+        )
+
+    unsubscribe_from_topic = subscribe_to_topic
+
+
+def _open_recording(path: Union[str, PathLike], mode: str) -> IO[str]:
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _hash_payload(message: messaging.Message) -> str:
+    """Hash of the encoded message without its token."""
+    payload = messaging._MessagingService.encode_message(message)
+    payload.pop("token", None)
+    return hashlib.blake2b(
+        json.dumps(payload, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+
+
+class RecordingTransport(_MessagingPatch):
+    """
+    Passes ``send_each`` and ``send_each_async`` calls through to the transport in
+    place (Firebase, the emulator, ...) and appends them to a JSON lines file, one
+    line per call::
+
+        {"latency": 0.1834, "results": [[payload_hash, token, status, error_code]]}
+
+    ``status`` is ``"OK"`` or the canonical error status (e.g. ``"NOT_FOUND"``)
+    and ``error_code`` the FCM error code (e.g. ``"UNREGISTERED"``), if any. Paths
+    ending in ``.gz`` are gzip compressed. Replay the file with ``ReplayTransport``.
+
+    Usage::
+
+        with RecordingTransport("campaign.jsonl.gz"):
+            FCMDevice.objects.send_message(message)
+    """
+
+    def __init__(self, path: Union[str, PathLike]) -> None:
+        self.path = path
+        self._file: Optional[IO[str]] = None
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "RecordingTransport":
+        self._file = _open_recording(self.path, "a")
+        return super().__enter__()
+
+    def __exit__(self, *exc_info) -> None:
+        super().__exit__(*exc_info)
+        self._file.close()
+        self._file = None
+
+    def get_patches(self) -> dict[str, Callable]:
+        send_each = messaging.send_each
+        send_each_async = messaging.send_each_async
+
+        @wraps(send_each)
+        def recorded_send_each(messages, *args, **kwargs):
+            start = time.perf_counter()
+            response = send_each(messages, *args, **kwargs)
+            self.record(messages, response, time.perf_counter() - start)
+            return response
+
+        @wraps(send_each_async)
+        async def recorded_send_each_async(messages, *args, **kwargs):
+            start = time.perf_counter()
+            response = await send_each_async(messages, *args, **kwargs)
+            self.record(messages, response, time.perf_counter() - start)
+            return response
+
+        return {
+            "send_each": recorded_send_each,
+            "send_each_async": recorded_send_each_async,
+        }
+
+    def record(
+        self,
+        messages: list[messaging.Message],
+        response: messaging.BatchResponse,
+        latency: float,
+    ) -> None:
+        results = []
+        for message, send_response in zip(messages, response.responses):
+            exc = send_response.exception
+            if exc is None:
+                status, error_code = OK, None
+            else:
+                status = exc.code
+                error_code = next(
+                    (
+                        code
+                        for code, error_class in _FCM_ERROR_CLASSES.items()
+                        if isinstance(exc, error_class)
+                    ),
+                    None,
+                )
+            results.append([_hash_payload(message), message.token, status, error_code])
+        line = json.dumps({"latency": round(latency, 4), "results": results})
+        with self._lock:
+            self._file.write(line + "\n")
+
+
+class ReplayTransport(_MessagingPatch):
+    """
+    Answers ``send_each`` and ``send_each_async`` calls from a ``RecordingTransport``
+    file, without network access. A recorded token gets its recorded outcomes in
+    order; other tokens get the recorded outcomes of all tokens in turn, so a
+    recorded failure rate carries over to any audience. Every call sleeps the
+    latency of the recorded call at the same position (times ``latency_scale``,
+    0 disables the sleeps).
+
+    ``tokens`` lists the recorded tokens, to replay the recorded audience with
+    ``skip_registration_id_lookup=True, additional_registration_ids=tokens``. With
+    ``check_payloads``, messages whose payload differs from the recorded one are
+    counted in ``payload_mismatches``.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, PathLike],
+        latency_scale: float = 1,
+        check_payloads: bool = False,
+    ) -> None:
+        self.latency_scale = latency_scale
+        self.check_payloads = check_payloads
+        self.payload_mismatches = 0
+        self.tokens: list[str] = []
+        self._latencies: list[float] = []
+        self._outcomes: defaultdict[str, deque] = defaultdict(deque)
+        all_outcomes = []
+        with _open_recording(path, "r") as file:
+            for line in file:
+                call = json.loads(line)
+                self._latencies.append(call["latency"])
+                for payload_hash, token, status, error_code in call["results"]:
+                    outcome = (payload_hash, status, error_code)
+                    if token not in self._outcomes:
+                        self.tokens.append(token)
+                    self._outcomes[token].append(outcome)
+                    all_outcomes.append(outcome)
+        if not all_outcomes:
+            raise ValueError(f"No recorded FCM calls in {path}")
+        self._other_outcomes = itertools.cycle(all_outcomes)
+        self._calls = itertools.count()
+        self._lock = threading.Lock()
+
+    def get_patches(self) -> dict[str, Callable]:
+        return {
+            "send_each": self.send_each,
+            "send_each_async": self.send_each_async,
+        }
+
+    def _get_latency(self) -> float:
+        with self._lock:
+            call = next(self._calls)
+        return self._latencies[call % len(self._latencies)] * self.latency_scale
+
+    def _get_response(self, message: messaging.Message) -> messaging.SendResponse:
+        with self._lock:
+            outcomes = self._outcomes.get(message.token)
+            if outcomes:
+                outcome = outcomes.popleft()
+            else:
+                outcome = next(self._other_outcomes)
+        payload_hash, status, error_code = outcome
+        if self.check_payloads and payload_hash != _hash_payload(message):
+            with self._lock:
+                self.payload_mismatches += 1
+        if status == OK:
+            return messaging.SendResponse({"name": "projects/replay/messages/1"}, None)
+        description = f"Replayed {error_code or status}"
+        if error_code in _FCM_ERROR_CLASSES:
+            exc = _FCM_ERROR_CLASSES[error_code](description)
+        elif status in _STATUS_ERROR_CLASSES:
+            exc = _STATUS_ERROR_CLASSES[status](description)
+        else:
+            exc = exceptions.FirebaseError(status, description)
+        return messaging.SendResponse(None, exc)
+
+    def _batch_response(self, messages) -> messaging.BatchResponse:
+        return messaging.BatchResponse(
+            [self._get_response(message) for message in messages]
+        )
+
+    def send_each(self, messages, dry_run=False, app=None) -> messaging.BatchResponse:
+        latency = self._get_latency()
+        if latency:
+            time.sleep(latency)
+        return self._batch_response(messages)
+
+    async def send_each_async(
+        self, messages, dry_run=False, app=None
+    ) -> messaging.BatchResponse:
+        latency = self._get_latency()
+        if latency:
+            await asyncio.sleep(latency)
+        return self._batch_response(messages)
+
+
+class FCMEmulator:
+    """
+    Local HTTP server speaking the FCM v1 ``messages:send`` and topic subscription
+    APIs, as well as the Instance ID topic API used by firebase_admin 6 and the
+    ``*_legacy`` topic functions, for exercising the real firebase_admin HTTP
+    clients without network access. Every send gets an outcome, resolved in this
+    order:
+
+    - the next outcome scripted for its token with ``script``
+    - ``UNREGISTERED`` for tokens passed to ``unregister``
+    - an error drawn from ``error_rates``
+    - ``default_outcome``
+
+    Outcomes are ``"OK"`` or one of the FCM error codes ``INVALID_ARGUMENT``,
+    ``SENDER_ID_MISMATCH``, ``UNREGISTERED``, ``QUOTA_EXCEEDED`` (answered with a
+    ``Retry-After: retry_after`` header), ``INTERNAL`` and ``UNAVAILABLE``. Note that
+    firebase_admin itself retries ``INTERNAL`` and ``UNAVAILABLE`` with backoff and
+    ``QUOTA_EXCEEDED`` after ``Retry-After``, and every attempt consumes an outcome.
+
+    Usage::
+
+        with FCMEmulator(latency=0.05) as emulator:
+            emulator.unregister("stale-token")
+            app = emulator.initialize_app()
+            FCMDevice.objects.send_message(message, app=app)
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0,
+        error_rates: Optional[dict[str, float]] = None,
+        retry_after: int = 1,
+        default_outcome: str = OK,
+        seed: Optional[int] = None,
+    ) -> None:
+        for outcome in [default_outcome, *(error_rates or {})]:
+            self._check_outcome(outcome)
+        self.latency = latency
+        self.error_rates = dict(error_rates or {})
+        self.retry_after = retry_after
+        self.default_outcome = default_outcome
+        self.sends: list[EmulatedSend] = []
+        self.topic_subscriptions: defaultdict[str, set[str]] = defaultdict(set)
+        self._scripts: defaultdict[str, deque[str]] = defaultdict(deque)
+        self._unregistered: set[str] = set()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._apps: list[firebase_admin.App] = []
+        self._server = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FCMEmulator":
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._server.serve_forever,
+                name="fcm-django-emulator",
+                daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        for app in self._apps:
+            try:
+                firebase_admin.delete_app(app)
+            except RuntimeError:
+                # the app's async HTTP client outlived the event loop it was used
+                # on (e.g. asyncio.run); the app is unregistered regardless
+                pass
+        self._apps = []
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self) -> "FCMEmulator":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def initialize_app(
+        self, name: str = "fcm-django-emulator", project_id: str = "fcm-emulator"
+    ) -> firebase_admin.App:
+        """
+        Returns a firebase_admin.App whose messaging calls go to this emulator. Pass
+        it as ``app`` or set it as the ``DEFAULT_FIREBASE_APP`` setting. The app is
+        deleted when the emulator stops.
+        """
+        app = firebase_admin.initialize_app(
+            _EmulatorCredential(), options={"projectId": project_id}, name=name
+        )
+        service = messaging._get_messaging_service(app)
+        service._fcm_url = f"{self.url}/v1/projects/{project_id}/messages:send"
+        service._fcm_topic_url = f"{self.url}/v1/projects/{project_id}/registrations"
+        # the Instance ID URL is a class attribute, so it is redirected in the
+        # HTTP session of this app only
+        iid_url = messaging._MessagingService.IID_URL
+        session = service._client.session
+        session.mount(
+            iid_url,
+            _RedirectAdapter(
+                iid_url, self.url, max_retries=session.get_adapter(iid_url).max_retries
+            ),
+        )
+        self._apps.append(app)
+        return app
+
+    def script(self, token: str, *outcomes: str) -> None:
+        """Queue the outcomes of the next sends to ``token``."""
+        for outcome in outcomes:
+            self._check_outcome(outcome)
+        with self._lock:
+            self._scripts[token].extend(outcomes)
+
+    def unregister(self, *tokens: str) -> None:
+        """Answer every send to ``tokens`` with UNREGISTERED."""
+        with self._lock:
+            self._unregistered.update(tokens)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.sends.clear()
+            self.topic_subscriptions.clear()
+            self._scripts.clear()
+            self._unregistered.clear()
+
+    @staticmethod
+    def _check_outcome(outcome: str) -> None:
+        if outcome != OK and outcome not in _FCM_ERRORS:
+            raise ValueError(f"Unknown FCM emulator outcome: {outcome!r}")
+
+    def _get_outcome(self, token: Optional[str]) -> str:
+        with self._lock:
+            if self._scripts.get(token):
+                return self._scripts[token].popleft()
+            if token in self._unregistered:
+                return "UNREGISTERED"
+            roll = self._random.random()
+            for outcome, rate in self.error_rates.items():
+                if roll < rate:
+                    return outcome
+                roll -= rate
+            return self.default_outcome
+
+    def _handle_send(self, project_id: str, body: dict[str, Any]):
+        message = body.get("message") or {}
+        token = message.get("token")
+        outcome = self._get_outcome(token)
+        with self._lock:
+            self.sends.append(
+                EmulatedSend(
+                    token=token,
+                    message=message,
+                    validate_only=bool(body.get("validate_only")),
+                    outcome=outcome,
+                )
+            )
+            message_number = len(self.sends)
+        if outcome == OK:
+            return 200, {"name": f"projects/{project_id}/messages/{message_number}"}, {}
+        return self._error_response(outcome)
+
+    def _handle_topic_subscription(self, method: str, token: str, topic: str):
+        outcome = self._get_outcome(token)
+        if outcome != OK:
+            return self._error_response(outcome)
+        with self._lock:
+            if method == "POST":
+                self.topic_subscriptions[topic].add(token)
+            else:
+                self.topic_subscriptions[topic].discard(token)
+        return 200, {}, {}
+
+    def _handle_iid_topic_subscription(self, method: str, body: dict[str, Any]):
+        topic = body["to"].removeprefix("/topics/")
+        results = []
+        for token in body["registration_tokens"]:
+            status, payload, _ = self._handle_topic_subscription(method, token, topic)
+            # per token errors are reported as canonical status codes
+            results.append(
+                {} if status == 200 else {"error": payload["error"]["status"]}
+            )
+        return 200, {"results": results}, {}
+
+    def _error_response(self, code: str):
+        status, canonical_status = _FCM_ERRORS[code]
+        headers = {}
+        if code == "QUOTA_EXCEEDED":
+            headers["Retry-After"] = str(self.retry_after)
+        body = {
+            "error": {
+                "code": status,
+                "message": f"Emulated {code}",
+                "status": canonical_status,
+                "details": [{"@type": _FCM_ERROR_TYPE, "errorCode": code}],
+            }
+        }
+        return status, body, headers
+
+    def _route(self, method: str, path: str, body: dict[str, Any]):
+        parsed = urllib.parse.urlsplit(path)
+        parts = [urllib.parse.unquote(part) for part in parsed.path.split("/")]
+        # /v1/projects/<project>/messages:send
+        if (
+            method == "POST"
+            and parts[1:3] == ["v1", "projects"]
+            and (parts[4:] == ["messages:send"])
+        ):
+            return self._handle_send(parts[3], body)
+        # /v1/projects/<project>/registrations/<token>/topicSubscriptions[/<topic>]
+        if parts[1:3] == ["v1", "projects"] and parts[4:5] == ["registrations"]:
+            token = parts[5]
+            if method == "POST" and parts[6:] == ["topicSubscriptions"]:
+                query = urllib.parse.parse_qs(parsed.query)
+                return self._handle_topic_subscription(
+                    method, token, query["topic_name"][0]
+                )
+            if method == "DELETE" and parts[6:7] == ["topicSubscriptions"]:
+                return self._handle_topic_subscription(method, token, parts[7])
+        # /iid/v1:batchAdd and /iid/v1:batchRemove
+        if method == "POST" and parts[1:2] == ["iid"]:
+            if parts[2:] == ["v1:batchAdd"]:
+                return self._handle_iid_topic_subscription("POST", body)
+            if parts[2:] == ["v1:batchRemove"]:
+                return self._handle_iid_topic_subscription("DELETE", body)
+        return 404, {"error": {"code": 404, "message": "Not found"}}, {}
+
+    def _get_handler_class(self) -> type[BaseHTTPRequestHandler]:
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length) if length else b""
+                body = json.loads(raw_body) if raw_body else {}
+                if emulator.latency:
+                    time.sleep(emulator.latency)
+                status, payload, headers = emulator._route(
+                    self.command, self.path, body
+                )
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_POST = do_DELETE = _handle
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
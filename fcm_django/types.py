@@ -84,7 +84,65 @@ class FirebaseResponseDict(NamedTuple):
         }
 
 
+class FirebaseTopicResponseDict(NamedTuple):
+    # One entry in topics_sent per response; conditions are stored verbatim
+    response: messaging.BatchResponse
+    topics_sent: list[str]
+
+    @property
+    def success_count(self) -> int:
+        return self.response.success_count
+
+    @property
+    def failure_count(self) -> int:
+        return self.response.failure_count
+
+    @property
+    def has_failures(self) -> bool:
+        return self.failure_count > 0
+
+    @property
+    def responses_by_topic(self) -> dict[str, list[messaging.SendResponse]]:
+        results: dict[str, list[messaging.SendResponse]] = {}
+        for send_response, topic in zip(self.response.responses, self.topics_sent):
+            results.setdefault(topic, []).append(send_response)
+        return results
+
+    @property
+    def failed_topics(self) -> list[str]:
+        return [
+            topic
+            for topic, send_responses in self.responses_by_topic.items()
+            if any(send_response.exception for send_response in send_responses)
+        ]
+
+    @property
+    def summary(self) -> dict[str, Any]:
+        return {
+            "success_count": self.success_count,
+            "failure_count": self.failure_count,
+            "has_failures": self.has_failures,
+            "topics_sent": list(self.responses_by_topic),
+            "failed_topics": self.failed_topics,
+        }
+
+
 class DeviceDeactivationData(NamedTuple):
     registration_id: str
     device_id: Any
     user_id: Any
+
+
+class TokenValidationResult(NamedTuple):
+    checked_count: int
+    deactivated_registration_ids: list[str]
+    # Primary key of the last validated device, to resume a sweep from
+    last_pk: Any
+
+
+class AudienceSendResult(NamedTuple):
+    sent_count: int
+    failure_count: int
+    deactivated_registration_ids: list[str]
+    # Primary key of the last snapshot entry sent to, to resume a send from
+    last_pk: Any
@@ -15,7 +15,10 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
 ]
 
-DATABASES = {"default": dj_database_url.config(default="sqlite://")}
+DATABASES = {
+    "default": dj_database_url.config(default="sqlite://"),
+    "replica": dj_database_url.config(env="REPLICA_DATABASE_URL", default="sqlite://"),
+}
 USE_TZ = True
 ROOT_URLCONF = "tests.urls"
 TEMPLATES = [
@@ -8,6 +8,8 @@ import django.db.models.deletion
 from django.conf import settings
 from django.db import migrations, models
 
+import fcm_django.fields
+
 
 class Migration(migrations.Migration):
     initial = True
@@ -40,6 +42,34 @@ class Migration(migrations.Migration):
                         auto_now_add=True, null=True, verbose_name="Creation date"
                     ),
                 ),
+                (
+                    "last_seen",
+                    models.DateTimeField(
+                        blank=True,
+                        editable=False,
+                        help_text="Last registration or refresh of the device",
+                        null=True,
+                        verbose_name="Last seen",
+                    ),
+                ),
+                (
+                    "last_success_at",
+                    models.DateTimeField(
+                        blank=True,
+                        editable=False,
+                        null=True,
+                        verbose_name="Last successful send",
+                    ),
+                ),
+                (
+                    "last_failure_at",
+                    models.DateTimeField(
+                        blank=True,
+                        editable=False,
+                        null=True,
+                        verbose_name="Last failed send",
+                    ),
+                ),
                 (
                     "device_id",
                     models.CharField(
@@ -51,6 +81,15 @@ class Migration(migrations.Migration):
                         verbose_name="Device ID",
                     ),
                 ),
+                (
+                    "registration_id_hash",
+                    fcm_django.fields.RegistrationIdHashField(
+                        editable=False,
+                        null=True,
+                        unique=True,
+                        verbose_name="Registration token hash",
+                    ),
+                ),
                 (
                     "type",
                     models.CharField(
@@ -0,0 +1,261 @@
+import asyncio
+
+import pytest
+import swapper
+from django.contrib.auth.models import AnonymousUser
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from fcm_django.api.adrf import (
+    AsyncFCMDeviceAuthorizedViewSet,
+    AsyncFCMDeviceCreateOnlyViewSet,
+    AsyncFCMDeviceSerializer,
+    AsyncFCMDeviceViewSet,
+)
+from fcm_django.models import DeviceType
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+def _call(viewset, actions, request, user=None, **kwargs):
+    if user is not None:
+        force_authenticate(request, user=user)
+    return asyncio.run(viewset.as_view(actions)(request, **kwargs))
+
+
+def _post_device(data, user=None, viewset=AsyncFCMDeviceViewSet):
+    request = APIRequestFactory().post("/devices/", data, format="json")
+    return _call(viewset, {"post": "acreate"}, request, user=user)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_viewsets_are_async():
+    assert AsyncFCMDeviceViewSet.view_is_async
+    assert AsyncFCMDeviceCreateOnlyViewSet.view_is_async
+    assert AsyncFCMDeviceAuthorizedViewSet.view_is_async
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_endpoint_add_device(registration_id):
+    response = _post_device({"registration_id": registration_id, "type": "web"})
+
+    assert response.status_code == 201
+    device = FCMDevice.objects.get(registration_id=registration_id)
+    assert str(response.data["id"]) == str(device.id)
+    assert device.type == DeviceType.WEB
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_endpoint_add_device_with_existed_token_updates_device(
+    user, fcm_device: FCMDevice
+):
+    response = _post_device(
+        {"registration_id": fcm_device.registration_id, "type": "android"},
+        user=user,
+    )
+
+    assert response.status_code == 200
+    assert FCMDevice.objects.count() == 1
+    fcm_device.refresh_from_db()
+    assert fcm_device.type == DeviceType.ANDROID
+    assert fcm_device.user == user
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_endpoint_rejects_duplicate_registration_id(fcm_device: FCMDevice):
+    with override_settings(FCM_DJANGO_SETTINGS={"UPDATE_ON_DUPLICATE_REG_ID": False}):
+        response = _post_device(
+            {"registration_id": fcm_device.registration_id, "type": "web"},
+            viewset=AsyncFCMDeviceCreateOnlyViewSet,
+        )
+
+    assert response.status_code == 400
+    assert response.data == {"registration_id": ["This field must be unique."]}
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize(
+    "method,action", [("put", "aupdate"), ("patch", "partial_aupdate")]
+)
+def test_async_endpoint_update_rejects_duplicate_registration_id(
+    fcm_device: FCMDevice, method, action
+):
+    other_device = FCMDevice.objects.create(
+        registration_id="other-token", type=DeviceType.WEB
+    )
+    request = getattr(APIRequestFactory(), method)(
+        f"/devices/{other_device.registration_id}/",
+        {"registration_id": fcm_device.registration_id, "type": "web"},
+        format="json",
+    )
+
+    response = _call(
+        AsyncFCMDeviceViewSet,
+        {method: action},
+        request,
+        registration_id=other_device.registration_id,
+    )
+
+    assert response.status_code == 400
+    assert response.data == {"registration_id": ["This field must be unique."]}
+    other_device.refresh_from_db()
+    assert other_device.registration_id == "other-token"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_endpoint_deactivates_duplicate_of_other_user(
+    user, fcm_device: FCMDevice
+):
+    with override_settings(FCM_DJANGO_SETTINGS={"UPDATE_ON_DUPLICATE_REG_ID": False}):
+        serializer = AsyncFCMDeviceSerializer(
+            data={"registration_id": fcm_device.registration_id, "type": "web"},
+            context={"request": _authenticated_request(user)},
+        )
+        assert asyncio.run(serializer.ais_valid())
+
+    fcm_device.refresh_from_db()
+    assert fcm_device.active is False
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("authenticated", [False, True], ids=["anonymous", "user"])
+def test_sync_is_valid_rejects_duplicate_registration_id(
+    user, fcm_device: FCMDevice, authenticated
+):
+    request = APIRequestFactory().post("/devices/")
+    request.user = user if authenticated else AnonymousUser()
+    serializer = AsyncFCMDeviceSerializer(
+        data={"registration_id": fcm_device.registration_id, "type": "web"},
+        context={"request": request},
+    )
+
+    assert not serializer.is_valid()
+    assert [error.code for error in serializer.errors["registration_id"]] == ["unique"]
+
+
+def _authenticated_request(user):
+    request = APIRequestFactory().post("/devices/")
+    request.user = user
+    return request
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_endpoint_upsert(user, fcm_device: FCMDevice):
+    with override_settings(FCM_DJANGO_SETTINGS={"UPSERT_DEVICE_REGISTRATION": True}):
+        updated = _post_device(
+            {"registration_id": fcm_device.registration_id, "type": "ios"},
+            user=user,
+        )
+        created = _post_device({"registration_id": "new-token", "type": "web"})
+
+    assert updated.status_code == 200
+    assert created.status_code == 201
+    fcm_device.refresh_from_db()
+    assert fcm_device.type == DeviceType.IOS
+    assert fcm_device.user == user
+    assert FCMDevice.objects.filter(registration_id="new-token").exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_endpoint_one_device_per_user(user):
+    old_device = FCMDevice.objects.create(
+        registration_id="old-token", type=DeviceType.WEB, user=user
+    )
+
+    with override_settings(FCM_DJANGO_SETTINGS={"ONE_DEVICE_PER_USER": True}):
+        response = _post_device(
+            {"registration_id": "new-token", "type": "web"}, user=user
+        )
+
+    assert response.status_code == 201
+    old_device.refresh_from_db()
+    assert old_device.active is False
+    assert FCMDevice.objects.get(registration_id="new-token").active is True
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_endpoint_list_and_retrieve(fcm_device: FCMDevice):
+    FCMDevice.objects.create(registration_id="other-token", type=DeviceType.IOS)
+    factory = APIRequestFactory()
+
+    listed = _call(AsyncFCMDeviceViewSet, {"get": "alist"}, factory.get("/devices/"))
+    retrieved = _call(
+        AsyncFCMDeviceViewSet,
+        {"get": "aretrieve"},
+        factory.get(f"/devices/{fcm_device.registration_id}/"),
+        registration_id=fcm_device.registration_id,
+    )
+    missing = _call(
+        AsyncFCMDeviceViewSet,
+        {"get": "aretrieve"},
+        factory.get("/devices/unknown/"),
+        registration_id="unknown",
+    )
+
+    assert {device["registration_id"] for device in listed.data} == {
+        "other-token",
+        fcm_device.registration_id,
+    }
+    assert retrieved.data["registration_id"] == fcm_device.registration_id
+    assert retrieved.data["type"] == DeviceType.WEB
+    assert missing.status_code == 404
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_authorized_endpoint_only_destroys_own_device(user, registration_id):
+    own_device = FCMDevice.objects.create(
+        registration_id=registration_id, type=DeviceType.WEB, user=user
+    )
+    other_device = FCMDevice.objects.create(
+        registration_id="other-token", type=DeviceType.WEB
+    )
+    factory = APIRequestFactory()
+
+    forbidden = _call(
+        AsyncFCMDeviceAuthorizedViewSet,
+        {"delete": "adestroy"},
+        factory.delete("/devices/other-token/"),
+        user=user,
+        registration_id="other-token",
+    )
+    deleted = _call(
+        AsyncFCMDeviceAuthorizedViewSet,
+        {"delete": "adestroy"},
+        factory.delete(f"/devices/{registration_id}/"),
+        user=user,
+        registration_id=registration_id,
+    )
+
+    assert forbidden.status_code == 404
+    assert deleted.status_code == 204
+    assert not FCMDevice.objects.filter(pk=own_device.pk).exists()
+    assert FCMDevice.objects.filter(pk=other_device.pk).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_authorized_endpoint_refresh(user, registration_id):
+    device = FCMDevice.objects.create(
+        registration_id=registration_id, type=DeviceType.WEB, user=user
+    )
+    FCMDevice.objects.create(registration_id="other-token", type=DeviceType.WEB)
+
+    def refresh(old_registration_id):
+        request = APIRequestFactory().post(
+            "/devices/refresh/",
+            {
+                "old_registration_id": old_registration_id,
+                "registration_id": "new-token",
+            },
+            format="json",
+        )
+        return _call(
+            AsyncFCMDeviceAuthorizedViewSet, {"post": "refresh"}, request, user=user
+        )
+
+    assert refresh("other-token").status_code == 404
+    response = refresh(registration_id)
+
+    assert response.status_code == 200
+    assert response.data["registration_id"] == "new-token"
+    device.refresh_from_db()
+    assert device.registration_id == "new-token"
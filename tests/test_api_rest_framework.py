@@ -3,7 +3,14 @@ import base64
 import pytest
 import swapper
 from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
 
+from fcm_django.api.rest_framework import (
+    DeviceCursorPagination,
+    FCMDeviceAuthorizedViewSet,
+    FCMDeviceSerializer,
+    FCMDeviceViewSet,
+)
 from fcm_django.models import DeviceType
 from fcm_django.signals import device_deactivated
 
@@ -126,3 +133,376 @@ def test_drf_endpoint_emits_signal_for_one_device_per_user(client, user, mocker)
     assert kwargs["reason"] == "one_device_per_user"
     assert kwargs["source"] == "perform_create"
     assert kwargs["metadata"] == {"user_id": user.id}
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_detail_lookup_by_registration_id(client, fcm_device: FCMDevice):
+    response = client.get(f"/drf/devices/{fcm_device.registration_id}/")
+
+    assert response.status_code == 200
+    assert response.json()["registration_id"] == fcm_device.registration_id
+    assert client.get("/drf/devices/unknown-token/").status_code == 404
+
+
+@pytest.fixture
+def upsert_settings():
+    with override_settings(FCM_DJANGO_SETTINGS={"UPSERT_DEVICE_REGISTRATION": True}):
+        yield
+
+
+def _post_device(data, user=None):
+    request = APIRequestFactory().post("/drf/devices/", data)
+    if user is not None:
+        force_authenticate(request, user=user)
+    return FCMDeviceViewSet.as_view({"post": "create"})(request)
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_upsert_creates_device(
+    upsert_settings, registration_id, django_assert_num_queries
+):
+    with django_assert_num_queries(2):
+        response = _post_device({"registration_id": registration_id, "type": "web"})
+
+    assert response.status_code == 201
+    device = FCMDevice.objects.get(registration_id=registration_id)
+    assert str(response.data["id"]) == str(device.id)
+    assert device.type == DeviceType.WEB
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_upsert_reassigns_existing_device(
+    upsert_settings, user, fcm_device: FCMDevice, django_assert_num_queries
+):
+    fcm_device.active = False
+    fcm_device.save()
+
+    with django_assert_num_queries(2):
+        response = _post_device(
+            {"registration_id": fcm_device.registration_id, "type": "android"},
+            user=user,
+        )
+
+    assert response.status_code == 200
+    assert str(response.data["id"]) == str(fcm_device.id)
+    assert FCMDevice.objects.count() == 1
+    date_created = fcm_device.date_created
+    fcm_device.refresh_from_db()
+    assert fcm_device.user == user
+    assert fcm_device.type == DeviceType.ANDROID
+    assert fcm_device.active is True
+    assert fcm_device.date_created == date_created
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_upsert_one_device_per_user(user, fcm_device: FCMDevice):
+    old_device = FCMDevice.objects.create(
+        registration_id="old-token", type=DeviceType.WEB, user=user
+    )
+
+    with override_settings(
+        FCM_DJANGO_SETTINGS={
+            "UPSERT_DEVICE_REGISTRATION": True,
+            "ONE_DEVICE_PER_USER": True,
+        }
+    ):
+        response = _post_device(
+            {
+                "registration_id": fcm_device.registration_id,
+                "type": "web",
+                "active": True,
+            },
+            user=user,
+        )
+
+    assert response.status_code == 200
+    old_device.refresh_from_db()
+    fcm_device.refresh_from_db()
+    assert old_device.active is False
+    assert fcm_device.active is True
+    assert fcm_device.user == user
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_bulk_register(
+    client, user, fcm_device: FCMDevice, django_assert_max_num_queries
+):
+    client.force_login(user)
+
+    with django_assert_max_num_queries(8):
+        response = client.post(
+            "/drf/devices/bulk/",
+            [
+                {"registration_id": fcm_device.registration_id, "type": "android"},
+                {"registration_id": "new-token-1", "type": "web"},
+                {"registration_id": "new-token-2", "type": "ios", "active": False},
+            ],
+            content_type="application/json",
+        )
+
+    assert response.status_code == 200
+    assert response.json() == {"created": 2, "updated": 1}
+    fcm_device.refresh_from_db()
+    assert fcm_device.type == DeviceType.ANDROID
+    assert fcm_device.user == user
+    assert set(
+        FCMDevice.objects.filter(user=user).values_list("registration_id", "active")
+    ) == {
+        (fcm_device.registration_id, True),
+        ("new-token-1", True),
+        ("new-token-2", False),
+    }
+    assert FCMDevice.objects.get(registration_id="new-token-1").registration_id_hash
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "payload",
+    [
+        [{"registration_id": "token", "type": "web"}] * 2,
+        [{"registration_id": "token", "type": "unknown"}],
+        {"registration_id": "token", "type": "web"},
+    ],
+    ids=["duplicate", "invalid", "not_a_list"],
+)
+def test_drf_endpoint_bulk_register_rejects_invalid_payloads(client, payload):
+    response = client.post(
+        "/drf/devices/bulk/", payload, content_type="application/json"
+    )
+
+    assert response.status_code == 400
+    assert not FCMDevice.objects.exists()
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_bulk_register_one_device_per_user(client, user):
+    old_device = FCMDevice.objects.create(
+        registration_id="old-token", type=DeviceType.WEB, user=user
+    )
+    client.force_login(user)
+
+    with override_settings(FCM_DJANGO_SETTINGS={"ONE_DEVICE_PER_USER": True}):
+        rejected = client.post(
+            "/drf/devices/bulk/",
+            [
+                {"registration_id": "token-1", "type": "web"},
+                {"registration_id": "token-2", "type": "web"},
+            ],
+            content_type="application/json",
+        )
+        response = client.post(
+            "/drf/devices/bulk/",
+            [
+                {"registration_id": "token-1", "type": "web"},
+                {"registration_id": "token-2", "type": "web", "active": False},
+            ],
+            content_type="application/json",
+        )
+
+    assert rejected.status_code == 400
+    assert response.status_code == 200
+    old_device.refresh_from_db()
+    assert old_device.active is False
+    assert list(
+        FCMDevice.objects.filter(active=True).values_list("registration_id", flat=True)
+    ) == ["token-1"]
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_bulk_deactivate(client):
+    FCMDevice.objects.bulk_create(
+        FCMDevice(registration_id=f"token-{i}", type=DeviceType.WEB) for i in range(3)
+    )
+
+    response = client.post(
+        "/drf/devices/bulk-deactivate/",
+        {"registration_ids": ["token-0", "token-2", "unknown"]},
+        content_type="application/json",
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {"deactivated": 2}
+    assert list(
+        FCMDevice.objects.filter(active=True).values_list("registration_id", flat=True)
+    ) == ["token-1"]
+
+
+@pytest.mark.django_db
+def test_authorized_drf_endpoint_bulk_deactivate_only_own_devices(user):
+    own_device = FCMDevice.objects.create(
+        registration_id="own-token", type=DeviceType.WEB, user=user
+    )
+    other_device = FCMDevice.objects.create(
+        registration_id="other-token", type=DeviceType.WEB
+    )
+    request = APIRequestFactory().post(
+        "/drf-authorized/devices/bulk-deactivate/",
+        {"registration_ids": ["own-token", "other-token"]},
+        format="json",
+    )
+    force_authenticate(request, user=user)
+
+    response = FCMDeviceAuthorizedViewSet.as_view({"post": "bulk_deactivate"})(request)
+
+    assert response.data == {"deactivated": 1}
+    own_device.refresh_from_db()
+    other_device.refresh_from_db()
+    assert own_device.active is False
+    assert other_device.active is True
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_list_serializes_values(client, user, django_assert_num_queries):
+    FCMDevice.objects.bulk_create(
+        FCMDevice(registration_id=f"token-{i}", type=DeviceType.WEB, user=user)
+        for i in range(3)
+    )
+    expected = FCMDeviceSerializer(FCMDevice.objects.order_by("-id"), many=True).data
+
+    with django_assert_num_queries(1) as captured:
+        response = FCMDeviceViewSet.as_view(
+            {"get": "list"}, lean_list_serialization=True
+        )(APIRequestFactory().get("/drf/devices/"))
+
+    assert response.data == expected
+    # only the serialized columns are read
+    assert "registration_id_hash" not in captured.captured_queries[0]["sql"]
+
+
+def test_drf_endpoint_list_serializes_instances_by_default():
+    viewset = FCMDeviceViewSet()
+    viewset.request = viewset.format_kwarg = None
+
+    assert viewset.get_lean_list_fields() is None
+
+
+def test_drf_endpoint_list_needs_instances_for_related_fields():
+    class UserDeviceSerializer(FCMDeviceSerializer):
+        class Meta(FCMDeviceSerializer.Meta):
+            fields = (*FCMDeviceSerializer.Meta.fields, "user")
+
+    viewset = FCMDeviceViewSet(
+        serializer_class=UserDeviceSerializer, lean_list_serialization=True
+    )
+    viewset.request = viewset.format_kwarg = None
+
+    assert viewset.get_lean_list_fields() is None
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_list_cursor_pagination():
+    FCMDevice.objects.bulk_create(
+        FCMDevice(registration_id=f"token-{i}", type=DeviceType.WEB) for i in range(5)
+    )
+    expected = list(FCMDevice.objects.order_by("-id").values_list("id", flat=True))
+    view = FCMDeviceViewSet.as_view(
+        {"get": "list"}, pagination_class=DeviceCursorPagination
+    )
+
+    ids = []
+    url = "/drf/devices/?page_size=2"
+    while url:
+        response = view(APIRequestFactory().get(url))
+        assert response.status_code == 200
+        assert len(response.data["results"]) <= 2
+        ids += [device["id"] for device in response.data["results"]]
+        url = response.data["next"]
+
+    assert [str(pk) for pk in ids] == [str(pk) for pk in expected]
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_refresh_registration_id(client, user):
+    device = FCMDevice.objects.create(
+        registration_id="old-token", type=DeviceType.WEB, user=user
+    )
+    client.force_login(user)
+
+    response = client.post(
+        "/drf/devices/refresh/",
+        {"old_registration_id": "old-token", "registration_id": "new-token"},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["registration_id"] == "new-token"
+    device.refresh_from_db()
+    assert device.registration_id == "new-token"
+    assert device.user == user
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_refresh_errors(client, fcm_device: FCMDevice):
+    FCMDevice.objects.create(registration_id="other-token", type=DeviceType.WEB)
+
+    missing = client.post(
+        "/drf/devices/refresh/",
+        {"old_registration_id": "unknown", "registration_id": "new-token"},
+    )
+    with override_settings(FCM_DJANGO_SETTINGS={"UPDATE_ON_DUPLICATE_REG_ID": False}):
+        duplicate = client.post(
+            "/drf/devices/refresh/",
+            {
+                "old_registration_id": fcm_device.registration_id,
+                "registration_id": "other-token",
+            },
+        )
+
+    assert missing.status_code == 404
+    assert duplicate.status_code == 400
+    assert duplicate.json() == {"registration_id": ["This field must be unique."]}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("upsert", [False, True], ids=["create", "upsert"])
+def test_drf_endpoint_registration_updates_last_seen(
+    client, fcm_device: FCMDevice, upsert
+):
+    with override_settings(
+        FCM_DJANGO_SETTINGS={
+            "TRACK_DEVICE_ACTIVITY": True,
+            "UPSERT_DEVICE_REGISTRATION": upsert,
+        }
+    ):
+        client.post("/drf/devices/", {"registration_id": "new-token", "type": "web"})
+        client.post(
+            "/drf/devices/",
+            {"registration_id": fcm_device.registration_id, "type": "web"},
+        )
+        client.post(
+            "/drf/devices/bulk/",
+            [{"registration_id": "bulk-token", "type": "web"}],
+            content_type="application/json",
+        )
+
+    assert not FCMDevice.objects.filter(last_seen__isnull=True).exists()
+    assert FCMDevice.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_drf_endpoint_lean_list_cursor_pagination_without_id_field():
+    class TokenSerializer(FCMDeviceSerializer):
+        class Meta(FCMDeviceSerializer.Meta):
+            fields = ("registration_id",)
+
+    FCMDevice.objects.bulk_create(
+        FCMDevice(registration_id=f"token-{i}", type=DeviceType.WEB) for i in range(3)
+    )
+    expected = list(
+        FCMDevice.objects.order_by("-id").values_list("registration_id", flat=True)
+    )
+    view = FCMDeviceViewSet.as_view(
+        {"get": "list"},
+        serializer_class=TokenSerializer,
+        pagination_class=DeviceCursorPagination,
+        lean_list_serialization=True,
+    )
+
+    results = []
+    url = "/drf/devices/?page_size=2"
+    while url:
+        response = view(APIRequestFactory().get(url))
+        assert response.status_code == 200
+        results += response.data["results"]
+        url = response.data["next"]
+
+    assert results == [{"registration_id": token} for token in expected]
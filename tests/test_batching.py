@@ -0,0 +1,377 @@
+import asyncio
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+import swapper
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from firebase_admin.exceptions import FirebaseError, InvalidArgumentError
+from firebase_admin.messaging import Message, SendResponse
+
+from fcm_django.batching import (
+    NotificationBufferMiddleware,
+    SendCoalescer,
+    buffer_notifications,
+    bypass_notification_buffer,
+    get_notification_buffer,
+)
+from fcm_django.models import DeviceType
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+@pytest.fixture
+def devices():
+    return [
+        FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+        for i in range(3)
+    ]
+
+
+def _respond_to_each(messages, **kwargs):
+    response = MagicMock()
+    response.responses = [
+        SendResponse({"name": f"message-{message.token}"}, None) for message in messages
+    ]
+    return response
+
+
+@pytest.mark.django_db(transaction=True)
+class TestSendCoalescer:
+    def test_coalesces_single_sends_into_one_send_each(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+        coalescer = SendCoalescer(max_delay=10)
+
+        futures = [coalescer.submit(device, message) for device in devices]
+        coalescer.close()
+
+        mock_firebase_send_each.assert_called_once()
+        sent_messages = mock_firebase_send_each.call_args.args[0]
+        assert [m.token for m in sent_messages] == [d.registration_id for d in devices]
+        # the submitted message is copied, not mutated
+        assert message.token is None
+        assert [future.result().message_id for future in futures] == [
+            "message-token-0",
+            "message-token-1",
+            "message-token-2",
+        ]
+
+    def test_flushes_when_batch_is_full(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+        coalescer = SendCoalescer(max_delay=10, max_batch_size=2)
+
+        futures = [coalescer.submit(device, message) for device in devices[:2]]
+        assert futures[0].result(timeout=5).message_id == "message-token-0"
+        coalescer.close()
+
+        mock_firebase_send_each.assert_called_once()
+
+    def test_groups_by_send_kwargs(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+        coalescer = SendCoalescer(max_delay=10)
+
+        coalescer.submit(devices[0], message)
+        coalescer.submit(devices[1], message, dry_run=True)
+        coalescer.close()
+
+        assert [call.kwargs for call in mock_firebase_send_each.call_args_list] == [
+            {"app": None},
+            {"app": None, "dry_run": True},
+        ]
+
+    def test_groups_by_unhashable_send_kwargs(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+        coalescer = SendCoalescer(max_delay=10)
+
+        futures = [
+            coalescer.submit(devices[0], message, extra={"b": [1]}),
+            coalescer.submit(devices[1], message, extra={"b": [1]}),
+            coalescer.submit(devices[2], message, extra={"b": [2]}),
+        ]
+        coalescer.close()
+
+        assert all(future.result(timeout=1).success for future in futures)
+        assert [call.kwargs for call in mock_firebase_send_each.call_args_list] == [
+            {"app": None, "extra": {"b": [1]}},
+            {"app": None, "extra": {"b": [2]}},
+        ]
+
+    def test_deactivates_failed_devices_in_bulk_and_raises(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock
+    ):
+        error = InvalidArgumentError(message="Error", cause="Invalid registration")
+
+        def _fail_unless_token_1(messages, **kwargs):
+            response = MagicMock()
+            response.responses = [
+                (
+                    SendResponse({"name": "ok"}, None)
+                    if message.token == "token-1"
+                    else SendResponse(None, error)
+                )
+                for message in messages
+            ]
+            return response
+
+        mock_firebase_send_each.side_effect = _fail_unless_token_1
+        coalescer = SendCoalescer(max_delay=0)
+
+        futures = [coalescer.submit(device, message) for device in devices]
+        with pytest.raises(FirebaseError):
+            coalescer.send_message(devices[0], message)
+        coalescer.close()
+
+        assert [future.result().success for future in futures] == [False, True, False]
+        assert list(
+            FCMDevice.objects.filter(active=True).values_list(
+                "registration_id", flat=True
+            )
+        ) == ["token-1"]
+
+    def test_send_each_error_is_propagated_to_every_caller(
+        self,
+        devices,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+        firebase_error: FirebaseError,
+    ):
+        mock_firebase_send_each.side_effect = firebase_error
+        coalescer = SendCoalescer(max_delay=10)
+
+        futures = [coalescer.submit(device, message) for device in devices]
+        coalescer.close()
+
+        assert all(future.exception() is firebase_error for future in futures)
+
+    def test_asend_message(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+        coalescer = SendCoalescer(max_delay=0.1)
+
+        async def send_all():
+            return await asyncio.gather(
+                *(coalescer.asend_message(device, message) for device in devices)
+            )
+
+        responses = asyncio.run(send_all())
+        coalescer.close()
+
+        mock_firebase_send_each.assert_called_once()
+        assert [response.message_id for response in responses] == [
+            "message-token-0",
+            "message-token-1",
+            "message-token-2",
+        ]
+
+    def test_device_send_message_uses_coalescer_when_enabled(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock, mocker
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+        mock_firebase_send = mocker.patch("fcm_django.models.messaging.send")
+
+        with override_settings(
+            FCM_DJANGO_SETTINGS={
+                "COALESCE_SINGLE_SENDS": True,
+                "COALESCE_MAX_DELAY": 0,
+            }
+        ):
+            response = devices[0].send_message(message)
+
+        assert response.message_id == "message-token-0"
+        mock_firebase_send.assert_not_called()
+        mock_firebase_send_each.assert_called_once()
+
+    def test_send_message_in_transaction_is_sent_from_calling_thread(
+        self, devices, message: Message, mock_firebase_send_each: MagicMock
+    ):
+        error = InvalidArgumentError(message="Error", cause="Invalid registration")
+        sending_threads = []
+
+        def _fail(messages, **kwargs):
+            sending_threads.append(threading.current_thread())
+            response = MagicMock()
+            response.responses = [SendResponse(None, error) for _ in messages]
+            return response
+
+        mock_firebase_send_each.side_effect = _fail
+        coalescer = SendCoalescer(max_delay=10)
+
+        with override_settings(FCM_DJANGO_SETTINGS={"TRACK_DEVICE_ACTIVITY": True}):
+            with transaction.atomic():
+                devices[0].name = "renamed"
+                devices[0].save()
+                with pytest.raises(FirebaseError):
+                    coalescer.send_message(devices[0], message)
+        coalescer.close()
+
+        assert sending_threads == [threading.current_thread()]
+        device = FCMDevice.objects.get(pk=devices[0].pk)
+        assert (device.name, device.active) == ("renamed", False)
+        assert device.last_failure_at is not None
+
+
+@pytest.mark.django_db
+class TestNotificationBuffer:
+    def test_device_and_queryset_sends_are_merged_on_commit(
+        self,
+        devices,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+        mock_firebase_send: MagicMock,
+        django_capture_on_commit_callbacks,
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+        other_message = Message(data={"other": "message"})
+
+        with django_capture_on_commit_callbacks(execute=True):
+            with buffer_notifications() as buffer:
+                assert devices[0].send_message(message) is None
+                assert (
+                    FCMDevice.objects.filter(
+                        registration_id__in=["token-1", "token-2"]
+                    ).send_message(other_message)
+                    is None
+                )
+                assert len(buffer) == 3
+                mock_firebase_send_each.assert_not_called()
+
+        mock_firebase_send.assert_not_called()
+        mock_firebase_send_each.assert_called_once()
+        sent_messages = mock_firebase_send_each.call_args.args[0]
+        assert sorted((m.token, tuple(m.data.items())) for m in sent_messages) == [
+            ("token-0", (("foo", "bar"),)),
+            ("token-1", (("other", "message"),)),
+            ("token-2", (("other", "message"),)),
+        ]
+        assert message.token is None
+
+    def test_nothing_is_sent_when_transaction_rolls_back(
+        self,
+        devices,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+        django_capture_on_commit_callbacks,
+    ):
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            with pytest.raises(RuntimeError):
+                with transaction.atomic():
+                    with buffer_notifications():
+                        devices[0].send_message(message)
+                        raise RuntimeError("rollback")
+
+        assert callbacks == []
+        mock_firebase_send_each.assert_not_called()
+
+    def test_sends_of_rolled_back_savepoint_are_dropped(
+        self,
+        devices,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+        django_capture_on_commit_callbacks,
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+
+        with django_capture_on_commit_callbacks(execute=True):
+            with buffer_notifications():
+                with pytest.raises(RuntimeError):
+                    with transaction.atomic():
+                        devices[0].send_message(message)
+                        raise RuntimeError("rollback")
+                devices[1].send_message(message)
+
+        mock_firebase_send_each.assert_called_once()
+        assert [m.token for m in mock_firebase_send_each.call_args.args[0]] == [
+            "token-1"
+        ]
+
+    def test_flush_errors_are_logged(
+        self,
+        caplog,
+        devices,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+        firebase_error: FirebaseError,
+        django_capture_on_commit_callbacks,
+    ):
+        mock_firebase_send_each.side_effect = firebase_error
+
+        with django_capture_on_commit_callbacks(execute=True):
+            with buffer_notifications():
+                devices[0].send_message(message)
+
+        assert [record.message for record in caplog.records] == [
+            "Flushing buffered notifications failed"
+        ]
+        assert caplog.records[0].exc_info[1] is firebase_error
+
+    def test_bypass_sends_immediately(
+        self,
+        devices,
+        message: Message,
+        mock_firebase_send: MagicMock,
+        django_capture_on_commit_callbacks,
+    ):
+        with django_capture_on_commit_callbacks() as callbacks:
+            with buffer_notifications() as buffer:
+                with bypass_notification_buffer():
+                    response = devices[0].send_message(message)
+
+        assert response.success
+        mock_firebase_send.assert_called_once()
+        assert len(buffer) == 0
+        assert callbacks == []
+
+    def test_middleware_buffers_request(
+        self,
+        devices,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+        django_capture_on_commit_callbacks,
+    ):
+        mock_firebase_send_each.side_effect = _respond_to_each
+
+        def view(request):
+            assert get_notification_buffer() is not None
+            devices[0].send_message(message)
+            devices[1].send_message(message)
+            return HttpResponse()
+
+        middleware = NotificationBufferMiddleware(view)
+        with django_capture_on_commit_callbacks(execute=True):
+            middleware(RequestFactory().get("/"))
+
+        assert get_notification_buffer() is None
+        mock_firebase_send_each.assert_called_once()
+        assert [m.token for m in mock_firebase_send_each.call_args.args[0]] == [
+            "token-0",
+            "token-1",
+        ]
+
+    def test_middleware_drops_sends_of_server_errors(
+        self,
+        devices,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+        django_capture_on_commit_callbacks,
+    ):
+        def view(request):
+            devices[0].send_message(message)
+            return HttpResponse(status=500)
+
+        middleware = NotificationBufferMiddleware(view)
+        with django_capture_on_commit_callbacks(execute=True):
+            response = middleware(RequestFactory().get("/"))
+
+        assert response.status_code == 500
+        mock_firebase_send_each.assert_not_called()
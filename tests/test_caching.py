@@ -0,0 +1,363 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+import swapper
+from django.core.cache import cache
+from django.test import override_settings
+from firebase_admin.messaging import Message, SendResponse, UnregisteredError
+
+from fcm_django.caching import (
+    DeadTokenCache,
+    get_dead_token_cache,
+    get_registration_id_cache,
+)
+from fcm_django.models import DeviceType
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+def _respond_to_each(messages, **kwargs):
+    response = MagicMock()
+    response.responses = [
+        (
+            SendResponse(None, UnregisteredError("Unregistered"))
+            if message.token.startswith("dead")
+            else SendResponse({"name": f"message-{message.token}"}, None)
+        )
+        for message in messages
+    ]
+    return response
+
+
+@pytest.fixture
+def registration_id_cache():
+    with override_settings(
+        FCM_DJANGO_SETTINGS={"USER_REGISTRATION_ID_CACHE": "default"}
+    ):
+        cache.clear()
+        yield get_registration_id_cache()
+        cache.clear()
+
+
+@pytest.fixture
+def other_user(django_user_model):
+    return django_user_model.objects.create_user(username="other")
+
+
+@pytest.fixture
+def user_devices(user, other_user):
+    return [
+        FCMDevice.objects.create(
+            registration_id=registration_id, type=DeviceType.WEB, user=owner
+        )
+        for registration_id, owner in [
+            ("token-1", user),
+            ("token-2", user),
+            ("token-3", other_user),
+        ]
+    ]
+
+
+@pytest.fixture
+def send_each(mock_firebase_send_each: MagicMock):
+    mock_firebase_send_each.side_effect = _respond_to_each
+    return mock_firebase_send_each
+
+
+def _sent_tokens(send_each: MagicMock) -> list[str]:
+    return [
+        message.token for call in send_each.call_args_list for message in call.args[0]
+    ]
+
+
+@pytest.mark.django_db
+class TestSendToUsers:
+    def test_without_cache(
+        self, user, other_user, user_devices, send_each, django_assert_num_queries
+    ):
+        FCMDevice.objects.create(
+            registration_id="inactive", type=DeviceType.WEB, user=user, active=False
+        )
+
+        with django_assert_num_queries(1):
+            response = FCMDevice.objects.send_to_users([user.pk], Message())
+
+        assert sorted(response.registration_ids_sent) == ["token-1", "token-2"]
+        assert sorted(_sent_tokens(send_each)) == ["token-1", "token-2"]
+
+    def test_reads_cache(
+        self,
+        registration_id_cache,
+        user,
+        other_user,
+        user_devices,
+        send_each,
+        django_assert_num_queries,
+    ):
+        # one query for both users
+        with django_assert_num_queries(1):
+            FCMDevice.objects.send_to_users([user.pk, other_user.pk], Message())
+        with django_assert_num_queries(0):
+            response = FCMDevice.objects.send_to_users(
+                [user.pk, other_user.pk], Message()
+            )
+
+        assert sorted(response.registration_ids_sent) == [
+            "token-1",
+            "token-2",
+            "token-3",
+        ]
+
+    def test_caches_users_without_devices(
+        self, registration_id_cache, user, send_each, django_assert_num_queries
+    ):
+        assert FCMDevice.objects.get_user_registration_ids([user.pk]) == {user.pk: []}
+        with django_assert_num_queries(0):
+            response = FCMDevice.objects.send_to_users([user.pk], Message())
+
+        assert response.registration_ids_sent == []
+        send_each.assert_not_called()
+
+    def test_filtered_queryset_skips_cache(
+        self, registration_id_cache, user, user_devices, send_each
+    ):
+        FCMDevice.objects.get_user_registration_ids([user.pk])
+
+        response = FCMDevice.objects.filter(registration_id="token-1").send_to_users(
+            [user.pk], Message()
+        )
+
+        assert response.registration_ids_sent == ["token-1"]
+
+    def test_sends_in_batches(self, mocker, registration_id_cache, user, send_each):
+        mocker.patch("fcm_django.models.MAX_MESSAGES_PER_BATCH", 2)
+        for i in range(3):
+            FCMDevice.objects.create(
+                registration_id=f"batched-{i}", type=DeviceType.WEB, user=user
+            )
+
+        FCMDevice.objects.send_to_users([user.pk], Message())
+
+        assert [len(call.args[0]) for call in send_each.call_args_list] == [2, 1]
+
+    def test_failed_tokens_are_deactivated_and_invalidated(
+        self, registration_id_cache, user, user_devices, send_each
+    ):
+        FCMDevice.objects.create(
+            registration_id="dead-token", type=DeviceType.WEB, user=user
+        )
+
+        response = FCMDevice.objects.send_to_users([user.pk], Message())
+
+        assert response.deactivated_registration_ids == ["dead-token"]
+        registration_ids = FCMDevice.objects.get_user_registration_ids([user.pk])
+        assert sorted(registration_ids[user.pk]) == ["token-1", "token-2"]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_asend_to_users(
+        self,
+        registration_id_cache,
+        user,
+        user_devices,
+        mock_firebase_send_each_async,
+    ):
+        mock_firebase_send_each_async.side_effect = None
+        mock_firebase_send_each_async.return_value.responses = [
+            SendResponse({"name": "message"}, None)
+        ] * 2
+
+        response = asyncio.run(FCMDevice.objects.asend_to_users([user.pk], Message()))
+
+        assert sorted(response.registration_ids_sent) == ["token-1", "token-2"]
+
+
+@pytest.mark.django_db
+class TestRegistrationIdCacheInvalidation:
+    @pytest.fixture(autouse=True)
+    def cached(self, registration_id_cache, user, other_user, user_devices):
+        FCMDevice.objects.get_user_registration_ids([user.pk, other_user.pk])
+
+    def registration_ids(self, user) -> list[str]:
+        return sorted(FCMDevice.objects.get_user_registration_ids([user.pk])[user.pk])
+
+    def test_create(self, user):
+        FCMDevice.objects.create(registration_id="new", type=DeviceType.WEB, user=user)
+
+        assert self.registration_ids(user) == ["new", "token-1", "token-2"]
+
+    def test_save_moving_device_to_other_user(self, user, other_user, user_devices):
+        device = user_devices[0]
+        device.user = other_user
+        device.save()
+
+        assert self.registration_ids(user) == ["token-2"]
+        assert self.registration_ids(other_user) == ["token-1", "token-3"]
+
+    def test_delete(self, user, user_devices):
+        user_devices[0].delete()
+
+        assert self.registration_ids(user) == ["token-2"]
+
+    def test_queryset_delete(self, user):
+        FCMDevice.objects.filter(registration_id="token-1").delete()
+
+        assert self.registration_ids(user) == ["token-2"]
+
+    def test_deactivate(self, user):
+        FCMDevice.objects.filter(registration_id="token-1").deactivate(
+            reason="test", source="test"
+        )
+
+        assert self.registration_ids(user) == ["token-2"]
+
+    def test_replace_token(self, user):
+        FCMDevice.objects.replace_token("token-1", "rotated")
+
+        assert self.registration_ids(user) == ["rotated", "token-2"]
+
+    def test_admin_enable(self, client, admin_user, settings, user, user_devices):
+        FCMDevice.objects.filter(pk=user_devices[0].pk).update(active=False)
+        cache.clear()
+        assert self.registration_ids(user) == ["token-2"]
+        client.force_login(admin_user)
+        base_admin_url = (
+            "/admin/swapped_models/customdevice/"
+            if settings.IS_SWAP
+            else "/admin/fcm_django/fcmdevice/"
+        )
+
+        # the changelist of devices to enable is usually filtered on active=False
+        client.post(
+            f"{base_admin_url}?active__exact=0",
+            {"action": "enable", "_selected_action": [str(user_devices[0].pk)]},
+        )
+
+        assert self.registration_ids(user) == ["token-1", "token-2"]
+
+    def test_drf_registration_moves_device(self, client, user, other_user):
+        client.force_login(other_user)
+
+        client.post(
+            "/drf-authorized/devices",
+            {"registration_id": "token-1", "type": "web"},
+        )
+
+        assert self.registration_ids(user) == ["token-2"]
+        assert self.registration_ids(other_user) == ["token-1", "token-3"]
+
+
+class TestDeadTokenCache:
+    def test_tokens_expire(self, mocker):
+        monotonic = mocker.patch("fcm_django.caching.time.monotonic", return_value=0)
+        dead_tokens = DeadTokenCache(max_size=10, ttl=60)
+
+        dead_tokens.add(["token-1"])
+        monotonic.return_value = 30
+        dead_tokens.add(["token-2"])
+
+        assert dead_tokens.exclude(["token-1", "token-2", "token-3"]) == ["token-3"]
+        monotonic.return_value = 60
+        assert "token-1" not in dead_tokens
+        assert dead_tokens.exclude(["token-1", "token-2", "token-3"]) == [
+            "token-1",
+            "token-3",
+        ]
+
+    def test_evicts_oldest_tokens(self):
+        dead_tokens = DeadTokenCache(max_size=2, ttl=60)
+
+        dead_tokens.add(["token-1", "token-2"])
+        dead_tokens.add(["token-3"])
+
+        assert len(dead_tokens) == 2
+        assert "token-1" not in dead_tokens
+        assert "token-2" in dead_tokens and "token-3" in dead_tokens
+
+    def test_discard(self):
+        dead_tokens = DeadTokenCache(max_size=2, ttl=60)
+        dead_tokens.add(["token-1", "token-2"])
+
+        dead_tokens.discard(["token-1", "unknown"])
+
+        assert dead_tokens.exclude(["token-1", "token-2"]) == ["token-1"]
+
+
+@pytest.mark.django_db
+class TestDeadTokenCacheSends:
+    @pytest.fixture(autouse=True)
+    def dead_tokens(self):
+        with override_settings(FCM_DJANGO_SETTINGS={"DEAD_TOKEN_CACHE_SIZE": 100}):
+            dead_tokens = get_dead_token_cache()
+            dead_tokens.clear()
+            yield dead_tokens
+            dead_tokens.clear()
+
+    def test_disabled_by_default(self):
+        with override_settings(FCM_DJANGO_SETTINGS={}):
+            assert get_dead_token_cache() is None
+
+    def test_skips_tokens_reported_dead(self, dead_tokens, send_each):
+        FCMDevice.objects.create(registration_id="dead-device", type=DeviceType.WEB)
+
+        first = FCMDevice.objects.send_message(
+            Message(), additional_registration_ids=["dead-external", "token"]
+        )
+        # the device is deactivated, the external token is only known to the cache
+        FCMDevice.objects.update(active=True)
+        send_each.reset_mock()
+        second = FCMDevice.objects.send_message(
+            Message(), additional_registration_ids=["dead-external", "token"]
+        )
+
+        assert sorted(first.deactivated_registration_ids) == ["dead-device"]
+        assert "dead-external" in dead_tokens
+        assert second.registration_ids_sent == ["token"]
+        assert _sent_tokens(send_each) == ["token"]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_aget_registration_ids(self, dead_tokens):
+        FCMDevice.objects.create(registration_id="dead-device", type=DeviceType.WEB)
+        FCMDevice.objects.create(registration_id="token", type=DeviceType.WEB)
+        dead_tokens.add(["dead-device"])
+
+        assert asyncio.run(FCMDevice.objects.aget_registration_ids()) == ["token"]
+
+    def test_registering_again_forgets_token(self, dead_tokens):
+        device = FCMDevice.objects.create(
+            registration_id="dead-device", type=DeviceType.WEB, active=False
+        )
+        dead_tokens.add(["dead-device"])
+
+        device.active = True
+        device.save()
+
+        assert FCMDevice.objects.get_registration_ids() == ["dead-device"]
+
+    def test_admin_enable_forgets_tokens(
+        self, client, admin_user, settings, dead_tokens
+    ):
+        device = FCMDevice.objects.create(
+            registration_id="dead-device", type=DeviceType.WEB, active=False
+        )
+        dead_tokens.add(["dead-device"])
+        client.force_login(admin_user)
+        base_admin_url = (
+            "/admin/swapped_models/customdevice/"
+            if settings.IS_SWAP
+            else "/admin/fcm_django/fcmdevice/"
+        )
+
+        client.post(
+            f"{base_admin_url}?active__exact=0",
+            {"action": "enable", "_selected_action": [str(device.pk)]},
+        )
+
+        assert FCMDevice.objects.get_registration_ids() == ["dead-device"]
+
+    def test_replace_token_forgets_new_token(self, dead_tokens, fcm_device):
+        dead_tokens.add(["rotated"])
+
+        FCMDevice.objects.replace_token(fcm_device.registration_id, "rotated")
+
+        assert "rotated" not in dead_tokens
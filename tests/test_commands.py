@@ -0,0 +1,273 @@
+import json
+from datetime import timedelta
+from io import StringIO
+
+import pytest
+import swapper
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import override_settings
+from django.utils import timezone
+from firebase_admin.messaging import SendResponse
+
+from fcm_django.management.commands import (
+    fcm_add_active_device_indexes,
+    fcm_loadtest,
+    fcm_prune_devices,
+    fcm_validate_tokens,
+)
+from fcm_django.models import DeviceType
+from fcm_django.operations import get_active_device_indexes
+from fcm_django.signals import device_deactivated
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+def _prune(*args) -> str:
+    stdout = StringIO()
+    # fcm_django is not an installed app when the device model is swapped
+    call_command(fcm_prune_devices.Command(), *args, stdout=stdout)
+    return stdout.getvalue()
+
+
+@pytest.fixture
+def devices():
+    old = timezone.now() - timedelta(days=100)
+    devices = {
+        "stale": FCMDevice.objects.create(registration_id="stale", type=DeviceType.WEB),
+        "seen": FCMDevice.objects.create(registration_id="seen", type=DeviceType.WEB),
+        "new": FCMDevice.objects.create(registration_id="new", type=DeviceType.WEB),
+        "inactive": FCMDevice.objects.create(
+            registration_id="inactive", type=DeviceType.WEB, active=False
+        ),
+    }
+    FCMDevice.objects.exclude(registration_id="new").update(date_created=old)
+    FCMDevice.objects.filter(registration_id="seen").update(last_seen=timezone.now())
+    return devices
+
+
+@pytest.mark.django_db
+def test_prune_devices_deactivates_unseen_devices_in_chunks(
+    devices, mocker, django_assert_num_queries
+):
+    receiver = mocker.Mock()
+    device_deactivated.connect(receiver)
+    try:
+        with (
+            override_settings(
+                FCM_DJANGO_SETTINGS={"EMIT_DEVICE_DEACTIVATED_SIGNAL": True}
+            ),
+            django_assert_num_queries(3),
+        ):
+            output = _prune("--unseen-for", "30", "--chunk-size", "1")
+    finally:
+        device_deactivated.disconnect(receiver)
+
+    assert output == "1 device(s) deactivated.\n"
+    assert set(
+        FCMDevice.objects.filter(active=True).values_list("registration_id", flat=True)
+    ) == {"seen", "new"}
+    receiver.assert_called_once()
+    assert receiver.call_args.kwargs["registration_ids"] == ["stale"]
+    assert receiver.call_args.kwargs["source"] == "fcm_prune_devices"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("delete_option", ["--delete", "--raw-delete"])
+def test_prune_devices_deletes_inactive_devices(devices, delete_option):
+    assert _prune("--inactive", delete_option, "--chunk-size", "1") == (
+        "1 device(s) deleted.\n"
+    )
+
+    assert not FCMDevice.objects.filter(registration_id="inactive").exists()
+    assert FCMDevice.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_prune_devices_dry_run(devices):
+    assert _prune("--older-than", "30", "--delete", "--dry-run") == (
+        "3 device(s) would be deleted.\n"
+    )
+    assert FCMDevice.objects.count() == 4
+
+
+@pytest.mark.parametrize(
+    "args",
+    [(), ("--inactive",), ("--older-than", "30", "--chunk-size", "0")],
+    ids=["no_criteria", "deactivate_inactive", "chunk_size"],
+)
+def test_prune_devices_rejects_invalid_options(args):
+    with pytest.raises(CommandError):
+        _prune(*args)
+
+
+@pytest.mark.django_db
+def test_validate_tokens_checkpoints_and_resumes(tmp_path, mocker):
+    for i in range(3):
+        FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+    send_each = mocker.patch(
+        "fcm_django.models.messaging.send_each",
+        side_effect=lambda messages, **kwargs: mocker.Mock(
+            responses=[SendResponse({"name": "message"}, None) for _ in messages]
+        ),
+    )
+    checkpoint = tmp_path / "checkpoint.json"
+    stdout = StringIO()
+
+    call_command(
+        fcm_validate_tokens.Command(),
+        "--batch-size",
+        "2",
+        "--max-duration",
+        "0.000001",
+        "--checkpoint",
+        str(checkpoint),
+        stdout=stdout,
+    )
+
+    assert stdout.getvalue().startswith("2 token(s) checked, 0 deactivated.\n")
+    assert checkpoint.exists()
+
+    stdout = StringIO()
+    call_command(
+        fcm_validate_tokens.Command(), "--checkpoint", str(checkpoint), stdout=stdout
+    )
+
+    assert stdout.getvalue() == "1 token(s) checked, 0 deactivated.\n"
+    assert not checkpoint.exists()
+    tokens = list(
+        FCMDevice.objects.order_by("pk").values_list("registration_id", flat=True)
+    )
+    assert [
+        [message.token for message in call.args[0]] for call in send_each.call_args_list
+    ] == [tokens[:2], tokens[2:]]
+
+
+def _loadtest(*args) -> str:
+    stdout = StringIO()
+    call_command(fcm_loadtest.Command(), *args, stdout=stdout)
+    return stdout.getvalue()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("path", fcm_loadtest.PATHS)
+def test_loadtest_reports_and_cleans_up(path, django_user_model):
+    output = _loadtest(
+        "--devices", "600", "--users", "3", "--path", path, "--failure-rate", "1"
+    )
+
+    lines = output.splitlines()
+    assert lines[0].startswith("Sent to 600 token(s) in ")
+    assert lines[1].startswith("Batch latency: p50 ")
+    assert lines[1].endswith(f"({1 if path == 'topic' else 2} batch(es))")
+    assert lines[2].startswith("Database: ")
+    if path != "topic":
+        assert lines[3] == "Deactivated 600 device(s)"
+    assert not FCMDevice.objects.exists()
+    assert not django_user_model.objects.exists()
+
+
+@pytest.mark.django_db
+def test_loadtest_keeps_devices(django_user_model):
+    output = _loadtest(
+        "--devices", "10", "--users", "2", "--types", "ios=1", "--keep", "--seed", "0"
+    )
+
+    assert "Kept the devices and users named fcm-loadtest-" in output
+    assert FCMDevice.objects.filter(type=DeviceType.IOS, active=True).count() == 10
+    assert [
+        FCMDevice.objects.filter(user=user).count()
+        for user in django_user_model.objects.all()
+    ] == [5, 5]
+
+
+@pytest.mark.django_db
+def test_loadtest_through_emulator():
+    output = _loadtest("--devices", "5", "--emulator", "--failure-rate", "1")
+
+    assert output.startswith("Sent to 5 token(s) in ")
+    assert "Deactivated 5 device(s)" in output
+    assert not FCMDevice.objects.exists()
+
+
+@pytest.mark.django_db
+def test_loadtest_replays_recording(tmp_path):
+    recording = tmp_path / "recording.jsonl"
+    recording.write_text(
+        json.dumps(
+            {
+                "latency": 0,
+                "results": [
+                    ["payload", "dead", "NOT_FOUND", "UNREGISTERED"],
+                    ["payload", "alive", "OK", None],
+                ],
+            }
+        )
+    )
+
+    output = _loadtest("--devices", "10", "--replay", str(recording))
+
+    assert "Deactivated 5 device(s)" in output
+
+
+@pytest.mark.parametrize(
+    "args",
+    [("--devices", "0"), ("--failure-rate", "2"), ("--types", "windows=1")],
+    ids=["devices", "failure_rate", "types"],
+)
+def test_loadtest_rejects_invalid_options(args):
+    with pytest.raises(CommandError):
+        _loadtest(*args)
+
+
+def _add_indexes(*args) -> str:
+    stdout = StringIO()
+    call_command(fcm_add_active_device_indexes.Command(), *args, stdout=stdout)
+    return stdout.getvalue()
+
+
+def _index_names() -> set[str]:
+    with connection.cursor() as cursor:
+        return set(
+            connection.introspection.get_constraints(cursor, FCMDevice._meta.db_table)
+        )
+
+
+@pytest.fixture
+def active_device_indexes():
+    indexes = get_active_device_indexes(FCMDevice, connection)
+    yield [index.name for index in indexes]
+    with connection.schema_editor() as schema_editor:
+        for index in indexes:
+            if index.name in _index_names():
+                schema_editor.remove_index(FCMDevice, index)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_add_active_device_indexes_in_place(active_device_indexes):
+    FCMDevice.objects.create(registration_id="kept", type=DeviceType.WEB)
+
+    output = _add_indexes()
+
+    assert set(active_device_indexes) <= _index_names()
+    assert output.splitlines() == [
+        f"Created index {name}." for name in active_device_indexes
+    ]
+    assert FCMDevice.objects.get().registration_id == "kept"
+    assert _add_indexes() == "The active device indexes already exist.\n"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_add_active_device_indexes_prints_sql(active_device_indexes):
+    output = _add_indexes("--sql")
+
+    assert output.count("CREATE INDEX") == len(active_device_indexes)
+    assert not set(active_device_indexes) & _index_names()
+
+
+@pytest.mark.django_db
+def test_add_active_device_indexes_concurrently_needs_postgresql():
+    if connection.vendor == "postgresql":
+        pytest.skip("Only rejected on other backends")
+    with pytest.raises(CommandError):
+        _add_indexes("--concurrently")
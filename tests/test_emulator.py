@@ -0,0 +1,184 @@
+import asyncio
+
+import pytest
+import swapper
+from firebase_admin import messaging
+from firebase_admin.messaging import Message, UnregisteredError
+
+from fcm_django.models import DeviceType
+from fcm_django.testing import (
+    FakeTransport,
+    FCMEmulator,
+    RecordingTransport,
+    ReplayTransport,
+)
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+@pytest.fixture
+def emulator():
+    with FCMEmulator(seed=0) as emulator:
+        yield emulator
+
+
+@pytest.fixture
+def emulator_app(emulator):
+    return emulator.initialize_app()
+
+
+@pytest.fixture
+def devices():
+    return [
+        FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+        for i in range(3)
+    ]
+
+
+@pytest.mark.django_db
+def test_queryset_send_message_through_emulator(emulator, emulator_app, devices):
+    emulator.unregister("token-1")
+    emulator.script("token-2", "SENDER_ID_MISMATCH")
+
+    result = FCMDevice.objects.send_message(
+        Message(data={"foo": "bar"}), app=emulator_app
+    )
+
+    assert result.success_count == 1
+    assert sorted(result.failed_registration_ids) == ["token-1", "token-2"]
+    assert sorted(result.deactivated_registration_ids) == ["token-1", "token-2"]
+    assert sorted(send.token for send in emulator.sends) == [
+        "token-0",
+        "token-1",
+        "token-2",
+    ]
+    assert emulator.sends[0].message["data"] == {"foo": "bar"}
+    assert set(
+        FCMDevice.objects.filter(active=True).values_list("registration_id", flat=True)
+    ) == {"token-0"}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_queryset_asend_message_through_emulator(emulator, emulator_app, devices):
+    emulator.unregister("token-0")
+
+    result = asyncio.run(
+        FCMDevice.objects.asend_message(Message(), app=emulator_app, dry_run=True)
+    )
+
+    assert result.success_count == 2
+    assert result.deactivated_registration_ids == ["token-0"]
+    assert all(send.validate_only for send in emulator.sends)
+
+
+@pytest.mark.django_db
+def test_device_send_message_through_emulator(
+    emulator, emulator_app, devices, mocker, mock_firebase_send
+):
+    mocker.stop(mock_firebase_send)
+    device = devices[0]
+    emulator.script(device.registration_id, "OK", "UNREGISTERED")
+
+    response = device.send_message(Message(), app=emulator_app)
+    assert response.message_id == "projects/fcm-emulator/messages/1"
+
+    with pytest.raises(UnregisteredError):
+        device.send_message(Message(), app=emulator_app)
+    device.refresh_from_db()
+    assert not device.active
+
+
+@pytest.mark.django_db
+def test_topic_subscription_through_emulator(emulator, emulator_app, devices):
+    emulator.script("token-1", "UNREGISTERED")
+
+    result = FCMDevice.objects.handle_topic_subscription(
+        True, topic="news", app=emulator_app
+    )
+
+    assert emulator.topic_subscriptions["news"] == {"token-0", "token-2"}
+    assert result.failed_registration_ids == ["token-1"]
+
+
+def test_instance_id_topic_subscription_through_emulator(emulator, emulator_app):
+    # firebase_admin 6 manages topics through the Instance ID API only
+    emulator.script("token-1", "UNREGISTERED")
+
+    with pytest.warns(DeprecationWarning):
+        subscribed = messaging.subscribe_to_topic_legacy(
+            ["token-0", "token-1", "token-2"], "/topics/news", app=emulator_app
+        )
+    with pytest.warns(DeprecationWarning):
+        messaging.unsubscribe_from_topic_legacy(["token-2"], "news", app=emulator_app)
+
+    assert emulator.topic_subscriptions["news"] == {"token-0"}
+    assert subscribed.success_count == 2
+    assert [(error.index, error.reason) for error in subscribed.errors] == [
+        (1, "NOT_FOUND")
+    ]
+
+
+def test_error_rates():
+    with FCMEmulator(error_rates={"UNREGISTERED": 1}) as emulator:
+        responses = messaging.send_each(
+            [Message(token="token")], app=emulator.initialize_app()
+        ).responses
+
+    assert isinstance(responses[0].exception, UnregisteredError)
+
+
+def test_unknown_outcomes_are_rejected():
+    with pytest.raises(ValueError):
+        FCMEmulator(default_outcome="NOT_A_CODE")
+
+
+@pytest.mark.django_db
+def test_record_and_replay(emulator, emulator_app, devices, tmp_path):
+    recording = tmp_path / "recording.jsonl.gz"
+    emulator.unregister("token-1")
+    emulator.script("token-2", "SENDER_ID_MISMATCH")
+    with RecordingTransport(recording):
+        recorded = FCMDevice.objects.send_message(
+            Message(data={"foo": "bar"}), app=emulator_app
+        )
+    FCMDevice.objects.update(active=True)
+
+    replay = ReplayTransport(recording, latency_scale=0, check_payloads=True)
+    with replay:
+        replayed = FCMDevice.objects.send_message(
+            Message(data={"foo": "bar"}),
+            skip_registration_id_lookup=True,
+            additional_registration_ids=replay.tokens,
+        )
+
+    assert sorted(replay.tokens) == ["token-0", "token-1", "token-2"]
+    assert replay.payload_mismatches == 0
+    assert len(emulator.sends) == 3
+    assert [type(response.exception) for response in replayed.response.responses] == [
+        type(response.exception) for response in recorded.response.responses
+    ]
+    assert sorted(replayed.deactivated_registration_ids) == ["token-1", "token-2"]
+
+
+def test_replay_cycles_recorded_outcomes_for_other_tokens(tmp_path):
+    recording = tmp_path / "recording.jsonl"
+    with FakeTransport(failing={"dead"}), RecordingTransport(recording):
+        messaging.send_each([Message(token="dead"), Message(token="alive")])
+    assert recording.read_text().count("\n") == 1
+
+    with ReplayTransport(recording, check_payloads=True) as replay:
+        responses = messaging.send_each(
+            [Message(token=f"other-{i}", data={"a": "b"}) for i in range(4)]
+        ).responses
+
+    assert [response.success for response in responses] == [False, True] * 2
+    assert isinstance(responses[0].exception, UnregisteredError)
+    assert replay.payload_mismatches == 4
+
+
+def test_replay_rejects_empty_recordings(tmp_path):
+    recording = tmp_path / "recording.jsonl"
+    recording.touch()
+
+    with pytest.raises(ValueError):
+        ReplayTransport(recording)
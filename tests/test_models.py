@@ -1,18 +1,23 @@
 import asyncio
+import importlib
+from datetime import timedelta
 from typing import Any, Optional
-from unittest.mock import MagicMock, sentinel
+from unittest.mock import AsyncMock, MagicMock, sentinel
 from uuid import UUID
 
 import pytest
 import swapper
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection, models, transaction
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from firebase_admin.exceptions import FirebaseError, InvalidArgumentError
-from firebase_admin.messaging import Message, SendResponse
+from firebase_admin.messaging import Message, SendResponse, UnregisteredError
 
-from fcm_django.models import DeviceType
+from fcm_django.fields import hash_registration_id
+from fcm_django.models import AudienceSnapshot, AudienceSnapshotEntry, DeviceType
 from fcm_django.signals import device_deactivated
 from fcm_django.types import FirebaseResponseDict
 
@@ -48,6 +53,150 @@ def test_fields_on_the_device_can_be_added_by_swapped_model(fcm_device: FCMDevic
         assert before_update < fcm_device.updated_at < timezone.now()
 
 
+@pytest.mark.django_db
+def test_registration_id_hash_is_maintained_on_save_and_bulk_create():
+    device = FCMDevice.objects.create(registration_id="token-1", type=DeviceType.WEB)
+    [bulk_device] = FCMDevice.objects.bulk_create(
+        [FCMDevice(registration_id="token-2", type=DeviceType.WEB)]
+    )
+    assert device.registration_id_hash == hash_registration_id("token-1")
+    assert bulk_device.registration_id_hash == hash_registration_id("token-2")
+
+    device.registration_id = "token-3"
+    device.save()
+
+    device.refresh_from_db()
+    assert device.registration_id_hash == hash_registration_id("token-3")
+    assert len(device.registration_id_hash) == 64
+
+
+@pytest.mark.django_db
+def test_registration_id_hash_is_maintained_on_update():
+    device = FCMDevice.objects.create(registration_id="token-1", type=DeviceType.WEB)
+
+    FCMDevice.objects.filter(pk=device.pk).update(registration_id="token-2")
+
+    assert FCMDevice.objects.filter_by_registration_id("token-2").get() == device
+    with pytest.raises(ValueError):
+        FCMDevice.objects.update(registration_id=models.F("name"))
+
+
+@pytest.mark.django_db
+def test_registration_id_hash_is_maintained_on_bulk_update():
+    devices = [
+        FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+        for i in range(2)
+    ]
+    for device in devices:
+        device.registration_id = f"rotated-{device.registration_id}"
+
+    FCMDevice.objects.bulk_update(iter(devices), ["registration_id"])
+
+    assert set(
+        FCMDevice.objects.filter_by_registration_ids(
+            ["rotated-token-0", "rotated-token-1"]
+        )
+    ) == set(devices)
+    assert not FCMDevice.objects.filter_by_registration_ids(["token-0"]).exists()
+
+
+@pytest.mark.django_db
+def test_filter_by_registration_ids_uses_hash_column():
+    first = FCMDevice.objects.create(registration_id="token-1", type=DeviceType.WEB)
+    second = FCMDevice.objects.create(registration_id="token-2", type=DeviceType.WEB)
+    FCMDevice.objects.create(registration_id="token-3", type=DeviceType.WEB)
+
+    queryset = FCMDevice.objects.filter_by_registration_ids(["token-1", "token-2"])
+
+    assert "registration_id_hash" in str(queryset.query)
+    assert set(queryset) == {first, second}
+    assert FCMDevice.objects.filter_by_registration_id("token-2").get() == second
+
+
+@pytest.mark.django_db
+def test_migrations_match_models():
+    if settings.IS_SWAP:
+        pytest.skip("The fcm_django migrations only run for the default model")
+    from django.core.management import call_command
+
+    # exits with status 1 when the models need a migration
+    call_command("makemigrations", "fcm_django", check=True, dry_run=True)
+
+
+@pytest.mark.django_db
+def test_registration_id_hash_backfill_migration(mocker):
+    if settings.IS_SWAP:
+        pytest.skip("The fcm_django migrations only run for the default model")
+    from django.apps import apps
+    from django.db import connection
+
+    backfill = importlib.import_module(
+        "fcm_django.migrations.0013_fcmdevice_registration_id_hash"
+    ).backfill_registration_id_hashes
+    devices = [
+        FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+        for i in range(3)
+    ]
+    FCMDevice.objects.update(registration_id_hash=None)
+
+    backfill(apps, mocker.Mock(connection=connection))
+
+    assert [
+        FCMDevice.objects.get(pk=device.pk).registration_id_hash for device in devices
+    ] == [hash_registration_id(f"token-{i}") for i in range(3)]
+
+
+@pytest.fixture
+def non_unique_registration_id():
+    """Drops the unique constraint of registration_id, as in MySQL compatibility mode"""
+    field = FCMDevice._meta.get_field("registration_id")
+    non_unique_field = field.clone()
+    non_unique_field.set_attributes_from_name("registration_id")
+    non_unique_field.model = FCMDevice
+    non_unique_field._unique = False
+    with connection.schema_editor() as schema_editor:
+        schema_editor.alter_field(FCMDevice, field, non_unique_field)
+    yield
+    FCMDevice.objects.all().delete()
+    with connection.schema_editor() as schema_editor:
+        schema_editor.alter_field(FCMDevice, non_unique_field, field)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_registration_id_hash_backfill_migration_deactivates_duplicates(
+    mocker, non_unique_registration_id
+):
+    if settings.IS_SWAP:
+        pytest.skip("The fcm_django migrations only run for the default model")
+    from django.apps import apps
+
+    backfill = importlib.import_module(
+        "fcm_django.migrations.0013_fcmdevice_registration_id_hash"
+    ).backfill_registration_id_hashes
+    oldest, older, newest, other = [
+        FCMDevice.objects.create(registration_id=f"unhashed-{i}", type=DeviceType.WEB)
+        for i in range(4)
+    ]
+    FCMDevice.objects.update(registration_id_hash=None)
+    FCMDevice.objects.exclude(pk=other.pk).update(
+        registration_id="duplicated", registration_id_hash=None
+    )
+
+    backfill(apps, mocker.Mock(connection=connection))
+
+    assert FCMDevice.objects.filter_by_registration_id("duplicated").get() == newest
+    assert list(
+        FCMDevice.objects.order_by("pk").values_list(
+            "pk", "active", "registration_id_hash"
+        )
+    ) == [
+        (oldest.pk, False, None),
+        (older.pk, False, None),
+        (newest.pk, True, hash_registration_id("duplicated")),
+        (other.pk, True, hash_registration_id("unhashed-3")),
+    ]
+
+
 def test_firebase_response_dict_summary_for_batch_response(mocker):
     ok_response = mocker.Mock(spec=SendResponse)
     ok_response.exception = None
@@ -294,6 +443,111 @@ class TestFCMDeviceSendMessage:
         assert fcm_device.active
 
 
+@pytest.mark.django_db(transaction=True)
+class TestFCMDeviceAsyncSendMessage:
+    def test_ok(
+        self,
+        fcm_device: FCMDevice,
+        message: Message,
+        mock_firebase_send_each_async: MagicMock,
+    ):
+        response = SendResponse({"name": "message-id"}, None)
+        mock_firebase_send_each_async.return_value.responses = [response]
+
+        result = asyncio.run(fcm_device.asend_message(message, dry_run=True))
+
+        assert result is response
+        mock_firebase_send_each_async.assert_awaited_once_with(
+            [message], app=None, dry_run=True
+        )
+        assert message.token == fcm_device.registration_id
+
+    def test_inactive_device_is_not_sent(
+        self,
+        fcm_device: FCMDevice,
+        message: Message,
+        mock_firebase_send_each_async: MagicMock,
+    ):
+        fcm_device.active = False
+
+        result = asyncio.run(fcm_device.asend_message(message))
+
+        assert result.message_id is None
+        mock_firebase_send_each_async.assert_not_awaited()
+
+    def test_invalid_registration_deactivates_device_and_raises(
+        self,
+        fcm_device: FCMDevice,
+        message: Message,
+        mock_firebase_send_each_async: MagicMock,
+    ):
+        error = InvalidArgumentError(message="Error", cause="Invalid registration")
+        mock_firebase_send_each_async.return_value.responses = [
+            SendResponse(None, error)
+        ]
+
+        with pytest.raises(FirebaseError, match=str(error)):
+            asyncio.run(fcm_device.asend_message(message))
+
+        fcm_device.refresh_from_db()
+        assert not fcm_device.active
+
+    def test_unknown_error_keeps_device_active(
+        self,
+        fcm_device: FCMDevice,
+        message: Message,
+        mock_firebase_send_each_async: MagicMock,
+        firebase_error: FirebaseError,
+    ):
+        mock_firebase_send_each_async.return_value.responses = [
+            SendResponse(None, firebase_error)
+        ]
+
+        with pytest.raises(FirebaseError):
+            asyncio.run(fcm_device.asend_message(message))
+
+        fcm_device.refresh_from_db()
+        assert fcm_device.active
+
+
+@pytest.mark.django_db(transaction=True)
+class TestFCMDeviceAsyncHandleTopicSubscription:
+    def test_subscribe(self, fcm_device: FCMDevice, mocker):
+        mock_subscribe = mocker.patch(
+            "fcm_django.models.messaging.subscribe_to_topic_async",
+            new_callable=AsyncMock,
+            create=True,
+        )
+        mock_subscribe.return_value = mocker.Mock(spec=["errors"], errors=[])
+
+        result = asyncio.run(fcm_device.ahandle_topic_subscription(True, "news"))
+
+        mock_subscribe.assert_awaited_once_with(
+            [fcm_device.registration_id], "news", app=None
+        )
+        assert result.registration_ids_sent == [fcm_device.registration_id]
+        assert result.deactivated_registration_ids == []
+
+    def test_unsubscribe_reports_errors(self, fcm_device: FCMDevice, mocker):
+        mock_unsubscribe = mocker.patch(
+            "fcm_django.models.messaging.unsubscribe_from_topic_async",
+            new_callable=AsyncMock,
+            create=True,
+        )
+        mock_unsubscribe.return_value = mocker.Mock(
+            spec=["errors"],
+            errors=[mocker.Mock(index=0, reason="INTERNAL")],
+        )
+
+        result = asyncio.run(fcm_device.ahandle_topic_subscription(False, "news"))
+
+        mock_unsubscribe.assert_awaited_once_with(
+            [fcm_device.registration_id], "news", app=None
+        )
+        assert result.failed_registration_ids == [fcm_device.registration_id]
+        assert result.deactivated_registration_ids == []
+
+
 class TestFCMDeviceSendTopicMessage:
     def assert_sent_successfully(
         self,
@@ -378,6 +632,121 @@ class TestFCMDeviceSendTopicMessage:
             FCMDevice.send_topic_message(message, "example")
 
 
+class TestFCMDeviceSendTopicMessages:
+    def test_fans_out_messages_to_topics_and_conditions(
+        self,
+        mocker,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+    ):
+        second_message = Message(data={"foo": "baz"})
+        responses = [SendResponse({"name": f"message-{i}"}, None) for i in range(6)]
+        responses[4] = SendResponse(
+            None, FirebaseError(code="unknown", message="failed")
+        )
+        mock_firebase_send_each.return_value.responses = responses
+
+        result = FCMDevice.send_topic_messages(
+            [message, second_message],
+            topics=["news-en", "news-de"],
+            conditions=["'sports' in topics"],
+            dry_run=True,
+        )
+
+        sent_messages = mock_firebase_send_each.call_args.args[0]
+        assert [(m.data, m.topic, m.condition) for m in sent_messages] == [
+            ({"foo": "bar"}, "news-en", None),
+            ({"foo": "bar"}, "news-de", None),
+            ({"foo": "bar"}, None, "'sports' in topics"),
+            ({"foo": "baz"}, "news-en", None),
+            ({"foo": "baz"}, "news-de", None),
+            ({"foo": "baz"}, None, "'sports' in topics"),
+        ]
+        assert mock_firebase_send_each.call_args.kwargs == {
+            "app": None,
+            "dry_run": True,
+        }
+        # the caller's message is left untouched
+        assert message.topic is None
+        assert result.topics_sent == [
+            "news-en",
+            "news-de",
+            "'sports' in topics",
+            "news-en",
+            "news-de",
+            "'sports' in topics",
+        ]
+        assert result.responses_by_topic["news-de"] == [responses[1], responses[4]]
+        assert result.failed_topics == ["news-de"]
+        assert result.failure_count == 1
+
+    def test_splits_into_batches(
+        self,
+        mocker,
+        message: Message,
+        mock_firebase_send_each: MagicMock,
+    ):
+        mocker.patch("fcm_django.models.MAX_MESSAGES_PER_BATCH", 2)
+
+        FCMDevice.send_topic_messages(message, topics=["a", "b", "c"])
+
+        assert [
+            [m.topic for m in call.args[0]]
+            for call in mock_firebase_send_each.call_args_list
+        ] == [["a", "b"], ["c"]]
+
+    def test_async(
+        self,
+        mocker,
+        message: Message,
+        mock_firebase_send_each_async: MagicMock,
+    ):
+        mocker.patch("fcm_django.models.MAX_MESSAGES_PER_BATCH", 1)
+        response = SendResponse({"name": "message"}, None)
+        mock_firebase_send_each_async.return_value.responses = [response]
+
+        result = asyncio.run(
+            FCMDevice.asend_topic_messages(
+                message, topics=["a"], conditions=["'b' in topics"]
+            )
+        )
+
+        assert mock_firebase_send_each_async.await_count == 2
+        assert result.topics_sent == ["a", "'b' in topics"]
+        assert result.success_count == 2
+
+    def test_async_bounds_concurrent_batches(
+        self,
+        mocker,
+        message: Message,
+        mock_firebase_send_each_async: MagicMock,
+    ):
+        mocker.patch("fcm_django.models.MAX_MESSAGES_PER_BATCH", 1)
+        in_flight = max_in_flight = 0
+
+        async def send_each_async(messages, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            response = MagicMock()
+            response.responses = [SendResponse({"name": "message"}, None)]
+            return response
+
+        mock_firebase_send_each_async.side_effect = send_each_async
+        with override_settings(FCM_DJANGO_SETTINGS={"ASYNC_SEND_CONCURRENCY": 2}):
+            result = asyncio.run(
+                FCMDevice.asend_topic_messages(
+                    message, topics=[f"topic-{i}" for i in range(5)]
+                )
+            )
+
+        assert mock_firebase_send_each_async.await_count == 5
+        assert max_in_flight == 2
+        assert result.success_count == 5
+
+
 @pytest.mark.django_db
 class TestFCMDeviceQuerySetSendBulkPersonalizedMessages:
     def test_ok(
@@ -656,6 +1025,74 @@ class TestFCMDeviceQuerySetAsyncSendBulkPersonalizedMessages:
         assert message.notification.body == "You have {count} updates"
 
 
+@pytest.mark.django_db
+class TestFCMDeviceQuerySetSendMany:
+    def test_ok(self, mocker, mock_firebase_send_each: MagicMock):
+        mocker.patch("fcm_django.models.MAX_MESSAGES_PER_BATCH", 2)
+        FCMDevice.objects.create(registration_id="token-3", type=DeviceType.WEB)
+        invalid_registration = InvalidArgumentError(
+            message="Error", cause="Invalid registration"
+        )
+        mock_firebase_send_each.side_effect = [
+            mocker.Mock(
+                responses=[
+                    SendResponse({"name": "message-1"}, None),
+                    SendResponse({"name": "message-2"}, None),
+                ]
+            ),
+            mocker.Mock(responses=[SendResponse(None, invalid_registration)]),
+        ]
+        messages = [Message(data={"digest": str(i)}) for i in range(3)]
+
+        result = FCMDevice.objects.send_many(
+            [
+                ("token-1", messages[0]),
+                ("token-2", messages[1]),
+                ("token-3", messages[2]),
+            ],
+            dry_run=True,
+        )
+
+        sent = [
+            (message.token, message.data)
+            for call in mock_firebase_send_each.call_args_list
+            for message in call.args[0]
+        ]
+        assert sent == [
+            ("token-1", {"digest": "0"}),
+            ("token-2", {"digest": "1"}),
+            ("token-3", {"digest": "2"}),
+        ]
+        assert all(message.token is None for message in messages)
+        assert mock_firebase_send_each.call_args.kwargs == {
+            "app": None,
+            "dry_run": True,
+        }
+        assert result.registration_ids_sent == ["token-1", "token-2", "token-3"]
+        assert result.success_count == 2
+        assert result.deactivated_registration_ids == ["token-3"]
+
+    def test_empty(self, mock_firebase_send_each: MagicMock):
+        result = FCMDevice.objects.send_many([])
+
+        mock_firebase_send_each.assert_not_called()
+        assert result.registration_ids_sent == []
+
+
+@pytest.mark.django_db(transaction=True)
+def test_queryset_asend_many(message: Message, mock_firebase_send_each_async):
+    mock_firebase_send_each_async.return_value.responses = [
+        SendResponse({"name": "message-1"}, None)
+    ]
+
+    result = asyncio.run(FCMDevice.objects.asend_many([("token-1", message)]))
+
+    mock_firebase_send_each_async.assert_awaited_once()
+    assert mock_firebase_send_each_async.call_args.args[0][0].token == "token-1"
+    assert result.registration_ids_sent == ["token-1"]
+    assert result.deactivated_registration_ids == []
+
+
 @pytest.mark.django_db
 def test_queryset_send_message_invalid_argument_error_does_not_deactivate_device(
     fcm_device: FCMDevice,
@@ -792,3 +1229,455 @@ def test_deactivate_emits_signal_with_explicit_reason_and_source(mocker):
         "request_method": "create",
         "target_user_id": 999,
     }
+
+
+@pytest.mark.django_db
+class TestFCMDeviceQuerySetReplaceToken:
+    def test_replaces_token_in_place(self, user):
+        device = FCMDevice.objects.create(
+            registration_id="old-token", type=DeviceType.WEB, user=user, name="phone"
+        )
+
+        with (
+            override_settings(
+                FCM_DJANGO_SETTINGS={"UPDATE_ON_DUPLICATE_REG_ID": False}
+            ),
+            CaptureQueriesContext(connection) as captured,
+        ):
+            replaced = FCMDevice.objects.replace_token("old-token", "new-token")
+
+        assert replaced == 1
+        assert [
+            query["sql"].split()[0]
+            for query in captured.captured_queries
+            if "SAVEPOINT" not in query["sql"]
+        ] == ["UPDATE"]
+        device.refresh_from_db()
+        assert device.registration_id == "new-token"
+        assert device.registration_id_hash == hash_registration_id("new-token")
+        assert (device.user, device.name) == (user, "phone")
+
+    def test_unknown_token_is_not_replaced(self, fcm_device):
+        assert FCMDevice.objects.replace_token("unknown", "new-token") == 0
+        fcm_device.refresh_from_db()
+        assert fcm_device.registration_id != "new-token"
+
+    def test_deletes_device_already_using_new_token(self, user):
+        device = FCMDevice.objects.create(
+            registration_id="old-token", type=DeviceType.WEB, user=user
+        )
+        duplicate = FCMDevice.objects.create(
+            registration_id="new-token", type=DeviceType.WEB
+        )
+
+        assert FCMDevice.objects.replace_token("old-token", "new-token") == 1
+
+        assert not FCMDevice.objects.filter(pk=duplicate.pk).exists()
+        assert FCMDevice.objects.get(registration_id="new-token").pk == device.pk
+
+    def test_duplicate_is_kept_when_old_token_is_not_in_queryset(self, user):
+        FCMDevice.objects.create(registration_id="old-token", type=DeviceType.WEB)
+        duplicate = FCMDevice.objects.create(
+            registration_id="new-token", type=DeviceType.WEB
+        )
+
+        replaced = FCMDevice.objects.filter(user=user).replace_token(
+            "old-token", "new-token"
+        )
+
+        assert replaced == 0
+        assert FCMDevice.objects.filter(pk=duplicate.pk).exists()
+
+    def test_duplicate_raises_without_update_on_duplicate(self):
+        FCMDevice.objects.create(registration_id="old-token", type=DeviceType.WEB)
+        FCMDevice.objects.create(registration_id="new-token", type=DeviceType.WEB)
+
+        with (
+            override_settings(
+                FCM_DJANGO_SETTINGS={"UPDATE_ON_DUPLICATE_REG_ID": False}
+            ),
+            pytest.raises(IntegrityError),
+        ):
+            FCMDevice.objects.replace_token("old-token", "new-token")
+
+        assert FCMDevice.objects.filter_by_registration_id("old-token").exists()
+
+    def test_subscribes_new_token_to_topics(self, fcm_device, mocker):
+        mock_subscribe = mocker.patch(
+            "fcm_django.models.messaging.subscribe_to_topic",
+            return_value=MagicMock(errors=[]),
+        )
+
+        FCMDevice.objects.replace_token(
+            fcm_device.registration_id, "new-token", topics=["news", "sports"]
+        )
+
+        assert [call.args[:2] for call in mock_subscribe.call_args_list] == [
+            (["new-token"], "news"),
+            (["new-token"], "sports"),
+        ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_queryset_areplace_token(fcm_device):
+    assert asyncio.run(
+        FCMDevice.objects.areplace_token(fcm_device.registration_id, "new-token")
+    )
+    fcm_device.refresh_from_db()
+    assert fcm_device.registration_id == "new-token"
+
+
+@pytest.mark.django_db
+class TestFCMDeviceActivityTracking:
+    @pytest.fixture(autouse=True)
+    def track_device_activity(self):
+        with override_settings(FCM_DJANGO_SETTINGS={"TRACK_DEVICE_ACTIVITY": True}):
+            yield
+
+    def test_send_results_are_recorded_with_one_update_per_batch(
+        self, mocker, mock_firebase_send_each: MagicMock
+    ):
+        mocker.patch("fcm_django.models.MAX_MESSAGES_PER_BATCH", 2)
+        devices = [
+            FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+            for i in range(3)
+        ]
+        error = FirebaseError(code="UNAVAILABLE", message="Error")
+        mock_firebase_send_each.side_effect = [
+            mocker.Mock(
+                responses=[
+                    SendResponse({"name": "message-0"}, None),
+                    SendResponse(None, error),
+                ]
+            ),
+            mocker.Mock(responses=[SendResponse({"name": "message-2"}, None)]),
+        ]
+
+        with CaptureQueriesContext(connection) as captured:
+            FCMDevice.objects.send_message(
+                Message(),
+                skip_registration_id_lookup=True,
+                additional_registration_ids=["token-0", "token-1", "token-2"],
+            )
+
+        assert [query["sql"].split()[0] for query in captured.captured_queries] == [
+            "UPDATE",
+            "UPDATE",
+        ]
+        for device in devices:
+            device.refresh_from_db()
+        assert devices[0].last_success_at is not None
+        assert devices[0].last_failure_at is None
+        assert devices[1].last_success_at is None
+        assert devices[1].last_failure_at is not None
+        assert devices[2].last_success_at is not None
+
+    def test_previous_results_are_kept(self, fcm_device):
+        last_success_at = timezone.now() - timedelta(days=1)
+        FCMDevice.objects.filter(pk=fcm_device.pk).update(
+            last_success_at=last_success_at
+        )
+
+        FCMDevice.objects.record_send_results(
+            [fcm_device.registration_id, "unknown"],
+            [
+                SendResponse(None, FirebaseError(code="UNAVAILABLE", message="")),
+                SendResponse({"name": "message"}, None),
+            ],
+        )
+
+        fcm_device.refresh_from_db()
+        assert fcm_device.last_success_at == last_success_at
+        assert fcm_device.last_failure_at is not None
+
+    def test_dry_run_is_not_recorded(self, fcm_device, django_assert_num_queries):
+        with django_assert_num_queries(0):
+            FCMDevice.objects.record_send_results(
+                [fcm_device.registration_id],
+                [SendResponse({"name": "message"}, None)],
+                dry_run=True,
+            )
+
+    def test_nothing_is_recorded_by_default(
+        self, fcm_device, django_assert_num_queries
+    ):
+        with (
+            override_settings(FCM_DJANGO_SETTINGS={}),
+            django_assert_num_queries(0),
+        ):
+            FCMDevice.objects.record_send_results(
+                [fcm_device.registration_id],
+                [SendResponse({"name": "message"}, None)],
+            )
+            FCMDevice.objects.touch_last_seen()
+
+    def test_device_send_message_records_result(self, fcm_device, message):
+        fcm_device.send_message(message)
+        fcm_device.refresh_from_db()
+        assert fcm_device.last_success_at is not None
+
+    def test_touch_last_seen_is_throttled(self, fcm_device):
+        devices = FCMDevice.objects.filter(pk=fcm_device.pk)
+
+        assert devices.touch_last_seen() == 1
+        assert devices.touch_last_seen() == 0
+
+        with override_settings(
+            FCM_DJANGO_SETTINGS={
+                "TRACK_DEVICE_ACTIVITY": True,
+                "LAST_SEEN_UPDATE_INTERVAL": 0,
+            }
+        ):
+            assert devices.touch_last_seen() == 1
+
+    def test_replace_token_updates_last_seen(self, fcm_device):
+        FCMDevice.objects.replace_token(fcm_device.registration_id, "new-token")
+
+        fcm_device.refresh_from_db()
+        assert fcm_device.last_seen is not None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_device_asend_message_records_failure(
+    fcm_device, message, firebase_error, mock_firebase_send_each_async
+):
+    mock_firebase_send_each_async.return_value.responses = [
+        SendResponse(None, firebase_error)
+    ]
+
+    with (
+        override_settings(FCM_DJANGO_SETTINGS={"TRACK_DEVICE_ACTIVITY": True}),
+        pytest.raises(FirebaseError),
+    ):
+        asyncio.run(fcm_device.asend_message(message))
+
+    fcm_device.refresh_from_db()
+    assert fcm_device.last_success_at is None
+    assert fcm_device.last_failure_at is not None
+
+
+@pytest.mark.django_db
+class TestFCMDeviceQuerySetValidateTokens:
+    def test_deactivates_invalid_tokens_with_dry_run_batches(
+        self, mocker, mock_firebase_send_each: MagicMock
+    ):
+        devices = [
+            FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+            for i in range(3)
+        ]
+        FCMDevice.objects.create(
+            registration_id="inactive", type=DeviceType.WEB, active=False
+        )
+        tokens = list(
+            FCMDevice.objects.filter(active=True)
+            .order_by("pk")
+            .values_list("registration_id", flat=True)
+        )
+        invalid_registration = InvalidArgumentError(
+            message="Error", cause="Invalid registration"
+        )
+        mock_firebase_send_each.side_effect = lambda messages, **kwargs: mocker.Mock(
+            responses=[
+                SendResponse(
+                    *(
+                        (None, invalid_registration)
+                        if message.token == tokens[1]
+                        else ({"name": "message"}, None)
+                    )
+                )
+                for message in messages
+            ]
+        )
+        on_batch = mocker.Mock()
+
+        result = FCMDevice.objects.validate_tokens(batch_size=2, on_batch=on_batch)
+
+        assert [
+            [message.token for message in call.args[0]]
+            for call in mock_firebase_send_each.call_args_list
+        ] == [tokens[:2], tokens[2:]]
+        assert all(
+            call.kwargs["dry_run"] for call in mock_firebase_send_each.call_args_list
+        )
+        assert result.checked_count == 3
+        assert result.deactivated_registration_ids == [tokens[1]]
+        assert result.last_pk == max(device.pk for device in devices)
+        assert [call.args[0].checked_count for call in on_batch.call_args_list] == [
+            2,
+            3,
+        ]
+        assert set(
+            FCMDevice.objects.filter(active=False).values_list(
+                "registration_id", flat=True
+            )
+        ) == {"inactive", tokens[1]}
+
+    def test_resumes_after_checkpoint(self, mock_firebase_send_each: MagicMock):
+        first, second = sorted(
+            (
+                FCMDevice.objects.create(
+                    registration_id=f"token-{i}", type=DeviceType.WEB
+                )
+                for i in range(2)
+            ),
+            key=lambda device: device.pk,
+        )
+        mock_firebase_send_each.return_value.responses = [
+            SendResponse({"name": "message"}, None)
+        ]
+
+        result = FCMDevice.objects.validate_tokens(start_after=first.pk)
+
+        assert [
+            message.token for message in mock_firebase_send_each.call_args.args[0]
+        ] == [second.registration_id]
+        assert result.checked_count == 1
+
+
+@pytest.mark.django_db(transaction=True, databases=["default", "replica"])
+class TestRegistrationIdReadDatabase:
+    @pytest.fixture(autouse=True)
+    def read_from_replica(self):
+        with override_settings(
+            FCM_DJANGO_SETTINGS={"REGISTRATION_ID_READ_DATABASE": "replica"}
+        ):
+            yield
+
+    @pytest.fixture
+    def lagging_replica(self):
+        """A device deactivated on the primary that the replica still sees active."""
+        for database, active in [("default", False), ("replica", True)]:
+            FCMDevice.objects.using(database).create(
+                registration_id="lagging", type=DeviceType.WEB, active=active
+            )
+        FCMDevice.objects.using("default").create(
+            registration_id="primary-only", type=DeviceType.WEB
+        )
+
+    def test_registration_ids_are_read_from_replica(self, lagging_replica):
+        assert FCMDevice.objects.get_registration_ids() == ["lagging"]
+        assert FCMDevice.objects.using("default").get_registration_ids() == [
+            "primary-only"
+        ]
+
+    def test_registration_ids_are_read_from_primary_in_transaction(
+        self, lagging_replica
+    ):
+        with transaction.atomic():
+            assert FCMDevice.objects.get_registration_ids() == ["primary-only"]
+
+    def test_aget_registration_ids_reads_from_replica(self, lagging_replica):
+        assert asyncio.run(FCMDevice.objects.aget_registration_ids()) == ["lagging"]
+
+    def test_deactivation_reads_and_writes_primary(
+        self, lagging_replica, mock_firebase_send_each: MagicMock
+    ):
+        mock_firebase_send_each.return_value.responses = [
+            SendResponse(None, UnregisteredError("Unregistered"))
+        ]
+
+        response = FCMDevice.objects.send_message(Message())
+
+        assert response.registration_ids_sent == ["lagging"]
+        # already inactive on the primary, so this call deactivated nothing
+        assert response.deactivated_registration_ids == []
+        assert FCMDevice.objects.using("replica").get().active
+        assert FCMDevice.objects.using("default").filter(active=True).count() == 1
+
+
+@pytest.mark.django_db
+class TestAudienceSnapshot:
+    @pytest.fixture(autouse=True)
+    def skip_swap(self):
+        if settings.IS_SWAP:
+            pytest.skip("Audience snapshots are only installed with fcm_django")
+
+    @pytest.fixture
+    def devices(self):
+        devices = [
+            FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+            for i in range(3)
+        ]
+        FCMDevice.objects.create(
+            registration_id="inactive", type=DeviceType.WEB, active=False
+        )
+        return devices
+
+    def test_snapshot_audience(self, devices, django_assert_num_queries):
+        # expired snapshots and their entries, then the snapshot, its entries
+        # and its size inside a transaction
+        with django_assert_num_queries(7):
+            snapshot = FCMDevice.objects.exclude(
+                registration_id="token-2"
+            ).snapshot_audience(ttl=60)
+
+        assert snapshot.size == 2
+        assert set(snapshot.entries.values_list("device_id", "registration_id")) == {
+            (device.pk, device.registration_id) for device in devices[:2]
+        }
+        assert not snapshot.is_expired
+        assert snapshot.expires_at - snapshot.created_at < timedelta(seconds=61)
+
+    def test_expired_snapshots_are_deleted(self, devices):
+        expired = FCMDevice.objects.snapshot_audience(ttl=timedelta(seconds=-1))
+        assert expired.is_expired
+
+        snapshot = FCMDevice.objects.snapshot_audience()
+
+        assert list(AudienceSnapshot.objects.all()) == [snapshot]
+        assert not AudienceSnapshotEntry.objects.filter(snapshot_id=expired.pk)
+
+    def test_send_message_streams_the_snapshot(
+        self, mocker, devices, mock_firebase_send_each: MagicMock
+    ):
+        snapshot = FCMDevice.objects.snapshot_audience()
+        # changes after the snapshot do not change its audience
+        FCMDevice.objects.create(registration_id="late", type=DeviceType.WEB)
+        mock_firebase_send_each.side_effect = lambda messages, **kwargs: mocker.Mock(
+            responses=[
+                SendResponse(
+                    *(
+                        (None, UnregisteredError("Unregistered"))
+                        if message.token == "token-1"
+                        else ({"name": "message"}, None)
+                    )
+                )
+                for message in messages
+            ]
+        )
+        on_batch = mocker.Mock()
+
+        result = snapshot.send_message(Message(), batch_size=2, on_batch=on_batch)
+
+        assert [
+            [message.token for message in call.args[0]]
+            for call in mock_firebase_send_each.call_args_list
+        ] == [["token-0", "token-1"], ["token-2"]]
+        assert result.sent_count == 3
+        assert result.failure_count == 1
+        assert result.deactivated_registration_ids == ["token-1"]
+        assert result.last_pk == snapshot.entries.order_by("pk").last().pk
+        assert [call.args[0].sent_count for call in on_batch.call_args_list] == [2, 3]
+        assert not FCMDevice.objects.get(registration_id="token-1").active
+
+    def test_send_message_resumes_after_checkpoint(
+        self, devices, mock_firebase_send_each: MagicMock
+    ):
+        snapshot = FCMDevice.objects.snapshot_audience()
+        first = snapshot.entries.order_by("pk").first()
+        mock_firebase_send_each.return_value.responses = [
+            SendResponse({"name": "message"}, None)
+        ] * 2
+
+        result = snapshot.send_message(Message(), start_after=first.pk)
+
+        assert [
+            message.token for message in mock_firebase_send_each.call_args.args[0]
+        ] == ["token-1", "token-2"]
+        assert result.sent_count == 2
+
+    def test_send_message_refuses_expired_snapshot(self, devices):
+        snapshot = FCMDevice.objects.snapshot_audience(ttl=-1)
+
+        with pytest.raises(ValueError):
+            snapshot.send_message(Message())
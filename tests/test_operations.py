@@ -0,0 +1,116 @@
+import pytest
+import swapper
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.state import ProjectState
+from django.test import override_settings
+
+from fcm_django.models import DeviceType
+from fcm_django.operations import AddActiveDeviceIndexes, get_active_device_indexes
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+def _index_names() -> set[str]:
+    with connection.cursor() as cursor:
+        return set(
+            connection.introspection.get_constraints(cursor, FCMDevice._meta.db_table)
+        )
+
+
+@pytest.fixture
+def active_device_indexes():
+    operation = AddActiveDeviceIndexes(model_name=FCMDevice._meta.model_name)
+    app_label = FCMDevice._meta.app_label
+    state = ProjectState.from_apps(apps)
+    with override_settings(FCM_DJANGO_SETTINGS={"ACTIVE_DEVICE_INDEXES": True}):
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards(app_label, schema_editor, state, state)
+    yield [index.name for index in get_active_device_indexes(FCMDevice, connection)]
+    with connection.schema_editor() as schema_editor:
+        operation.database_backwards(app_label, schema_editor, state, state)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_active_device_indexes_are_not_created_by_default():
+    operation = AddActiveDeviceIndexes(model_name=FCMDevice._meta.model_name)
+    state = ProjectState.from_apps(apps)
+    before = _index_names()
+
+    with connection.schema_editor() as schema_editor:
+        operation.database_forwards(
+            FCMDevice._meta.app_label, schema_editor, state, state
+        )
+
+    assert _index_names() == before
+
+
+@pytest.mark.django_db(transaction=True)
+def test_active_device_indexes_are_created_and_removed(active_device_indexes):
+    assert set(active_device_indexes) <= _index_names()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize(
+    "lookup",
+    [{}, {"user_id__in": [1, 2]}],
+    ids=["all_active", "active_for_users"],
+)
+def test_active_registration_id_lookups_are_index_only_scans(
+    active_device_indexes, lookup
+):
+    if connection.vendor not in ("sqlite", "postgresql"):
+        pytest.skip("Query plan assertions are only written for SQLite and PostgreSQL")
+    FCMDevice.objects.bulk_create(
+        FCMDevice(registration_id=f"token-{i}", type=DeviceType.WEB, active=bool(i % 2))
+        for i in range(200)
+    )
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(f"VACUUM ANALYZE {FCMDevice._meta.db_table}")
+            cursor.execute("SET enable_seqscan = off")
+        else:
+            cursor.execute("ANALYZE")
+
+    plan = (
+        FCMDevice.objects.filter(active=True, **lookup)
+        .values_list("registration_id", flat=True)
+        .explain()
+    )
+
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("RESET enable_seqscan")
+        assert "Index Only Scan" in plan
+    else:
+        assert "USING COVERING INDEX" in plan
+    assert any(name in plan for name in active_device_indexes)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_active_device_indexes_survive_later_migrations():
+    if settings.IS_SWAP:
+        pytest.skip("The fcm_django migrations only run for the default model")
+    executor = MigrationExecutor(connection)
+    latest = executor.loader.graph.leaf_nodes("fcm_django")
+    executor.migrate(
+        [("fcm_django", "0011_fcmdevice_fcm_django_registration_id_user_id_idx")]
+    )
+    try:
+        with override_settings(FCM_DJANGO_SETTINGS={"ACTIVE_DEVICE_INDEXES": True}):
+            executor = MigrationExecutor(connection)
+            executor.migrate(latest)
+
+        # SQLite rebuilds the table in 0013
+        assert {
+            index.name for index in get_active_device_indexes(FCMDevice, connection)
+        } <= _index_names()
+    finally:
+        operation = AddActiveDeviceIndexes(model_name=FCMDevice._meta.model_name)
+        state = ProjectState.from_apps(apps)
+        with connection.schema_editor() as schema_editor:
+            operation.database_backwards(
+                FCMDevice._meta.app_label, schema_editor, state, state
+            )
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+
+import pytest
+import swapper
+from django.test import override_settings
+from firebase_admin.messaging import Message
+
+from fcm_django.models import DeviceType
+from fcm_django.profiling import STAGES, profile_sends
+from fcm_django.testing import FakeTransport, FCMEmulator
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+@pytest.fixture
+def devices():
+    return [
+        FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+        for i in range(3)
+    ]
+
+
+@pytest.mark.django_db
+def test_profile_sends_collects_stage_timings(devices):
+    with FakeTransport(failing={"token-0"}):
+        with profile_sends() as profiles:
+            FCMDevice.objects.send_message(Message())
+            FCMDevice.objects.handle_topic_subscription(True, "news")
+        FCMDevice.objects.send_message(Message())
+
+    assert [profile.operation for profile in profiles] == [
+        "send_message",
+        "handle_topic_subscription",
+    ]
+    profile = profiles[0]
+    assert set(profile.stages) == set(STAGES)
+    assert profile.stages["db"] > 0
+    assert profile.stages["deactivate"] > 0
+    assert profile.duration >= sum(profile.stages.values())
+    assert str(profile).startswith("send_message took ")
+    assert profile.stats().total_calls > 0
+
+
+@pytest.mark.django_db
+def test_profile_sends_writes_profiles(devices, tmp_path, caplog):
+    with (
+        FakeTransport(),
+        caplog.at_level(logging.INFO, logger="fcm_django.profiling"),
+        profile_sends(directory=tmp_path),
+    ):
+        FCMDevice.objects.send_bulk_personalized_messages(
+            title_template="Hi", body_template="Hello"
+        )
+
+    assert caplog.messages[0].startswith("send_bulk_personalized_messages took ")
+    (json_file,) = tmp_path.glob("*.json")
+    assert json_file.name.endswith("-send_bulk_personalized_messages.json")
+    assert set(json.loads(json_file.read_text())["stages"]) == {*STAGES, "other"}
+    assert json_file.with_suffix(".prof").exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_profile_async_send_through_emulator(devices):
+    async def send():
+        with profile_sends(cprofile=False) as profiles:
+            await FCMDevice.objects.asend_message(Message(), app=emulator_app)
+        return profiles
+
+    with FCMEmulator() as emulator:
+        emulator_app = emulator.initialize_app()
+        (profile,) = asyncio.run(send())
+
+    assert profile.operation == "asend_message"
+    assert profile.profiler is None
+    assert profile.stages["encode"] > 0
+    assert profile.stages["http"] > 0
+
+
+@pytest.mark.django_db
+@override_settings(
+    FCM_DJANGO_SETTINGS={"PROFILE_SENDS": True, "PROFILE_SENDS_DIR": None}
+)
+def test_profile_sends_setting_logs_stage_timings(devices, caplog):
+    with FakeTransport(), caplog.at_level(logging.INFO, "fcm_django.profiling"):
+        FCMDevice.objects.send_many(
+            (device.registration_id, Message()) for device in devices
+        )
+
+    assert len(caplog.messages) == 1
+    assert caplog.messages[0].startswith("send_many took ")
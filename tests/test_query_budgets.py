@@ -0,0 +1,261 @@
+"""
+Pins the number of queries of the public entry points, so a change that adds a
+query per request, per batch or per device fails here before it reaches a
+production database.
+"""
+
+import pytest
+import swapper
+from django.test import override_settings
+from firebase_admin.messaging import (
+    BatchResponse,
+    Message,
+    SendResponse,
+    TopicManagementResponse,
+    UnregisteredError,
+)
+from pytest_mock import MockerFixture
+
+from fcm_django.models import DeviceType
+
+FCMDevice = swapper.load_model("fcm_django", "fcmdevice")
+
+
+def _ok():
+    return SendResponse({"name": "projects/p/messages/1"}, None)
+
+
+def _unregistered():
+    return SendResponse(None, UnregisteredError("Requested entity was not found."))
+
+
+@pytest.fixture
+def devices():
+    return [
+        FCMDevice.objects.create(registration_id=f"token-{i}", type=DeviceType.WEB)
+        for i in range(3)
+    ]
+
+
+@pytest.fixture
+def send_each(mocker: MockerFixture):
+    """send_each answering UNREGISTERED for token-0 and OK for the other tokens."""
+    return mocker.patch(
+        "fcm_django.models.messaging.send_each",
+        side_effect=lambda messages, **kwargs: BatchResponse(
+            [
+                _unregistered() if message.token == "token-0" else _ok()
+                for message in messages
+            ]
+        ),
+    )
+
+
+@pytest.fixture
+def subscribe_to_topic(mocker: MockerFixture):
+    return mocker.patch(
+        "fcm_django.models.messaging.subscribe_to_topic",
+        side_effect=lambda tokens, topic, **kwargs: TopicManagementResponse(
+            {
+                "results": [
+                    {"error": "NOT_FOUND"} if token == "token-0" else {}
+                    for token in tokens
+                ]
+            }
+        ),
+    )
+
+
+@pytest.mark.django_db
+class TestRegistrationQueryBudget:
+    def test_create(self, client, django_assert_num_queries):
+        # duplicate lookup, unique validator, uniqueness check, INSERT
+        with django_assert_num_queries(4):
+            response = client.post(
+                "/drf/devices/", {"registration_id": "token", "type": "web"}
+            )
+        assert response.status_code == 201
+
+    def test_update_on_duplicate_registration_id(
+        self, client, fcm_device, django_assert_num_queries
+    ):
+        # duplicate lookup, unique validator, uniqueness check, UPDATE
+        with django_assert_num_queries(4):
+            response = client.post(
+                "/drf/devices/",
+                {"registration_id": fcm_device.registration_id, "type": "android"},
+            )
+        assert response.status_code == 200
+
+    def test_authenticated_create(self, client, user, django_assert_num_queries):
+        client.force_login(user)
+        # session and user, duplicate lookup, unique validator, SELECT of the
+        # devices of other users to deactivate, uniqueness check, INSERT
+        with django_assert_num_queries(7):
+            response = client.post(
+                "/drf-authorized/devices",
+                {"registration_id": "token", "type": "web"},
+            )
+        assert response.status_code == 201
+
+    @override_settings(FCM_DJANGO_SETTINGS={"UPSERT_DEVICE_REGISTRATION": True})
+    def test_upsert(self, client, fcm_device, django_assert_num_queries):
+        # lookup of the existing device, INSERT ... ON CONFLICT
+        with django_assert_num_queries(2):
+            response = client.post(
+                "/drf/devices/",
+                {"registration_id": fcm_device.registration_id, "type": "android"},
+            )
+        assert response.status_code == 200
+
+
+@pytest.mark.django_db
+class TestSendQueryBudget:
+    def test_queryset_send_message(self, devices, send_each, django_assert_num_queries):
+        # registration IDs, then SELECT and UPDATE deactivating token-0
+        with django_assert_num_queries(3):
+            FCMDevice.objects.send_message(Message())
+
+    def test_queryset_send_message_without_failures(
+        self, devices, send_each, django_assert_num_queries
+    ):
+        with django_assert_num_queries(1):
+            FCMDevice.objects.exclude(registration_id="token-0").send_message(Message())
+
+    def test_queryset_send_message_without_lookup(
+        self, send_each, django_assert_num_queries
+    ):
+        with django_assert_num_queries(0):
+            FCMDevice.objects.send_message(
+                Message(),
+                skip_registration_id_lookup=True,
+                additional_registration_ids=["token-1", "token-2"],
+            )
+
+    def test_send_many(self, devices, send_each, django_assert_num_queries):
+        with django_assert_num_queries(2):
+            FCMDevice.objects.send_many(
+                (device.registration_id, Message()) for device in devices
+            )
+
+    def test_send_bulk_personalized_messages(
+        self, devices, send_each, django_assert_num_queries
+    ):
+        with django_assert_num_queries(3):
+            FCMDevice.objects.send_bulk_personalized_messages(
+                title_template="Hi {name}",
+                body_template="Hello",
+                message_data={
+                    device.registration_id: {"name": device.registration_id}
+                    for device in devices
+                },
+            )
+
+    @override_settings(FCM_DJANGO_SETTINGS={"TRACK_DEVICE_ACTIVITY": True})
+    def test_queryset_send_message_tracking_activity(
+        self, devices, send_each, django_assert_num_queries
+    ):
+        # plus one UPDATE of the send timestamps per batch
+        with django_assert_num_queries(4):
+            FCMDevice.objects.send_message(Message())
+
+    def test_queryset_handle_topic_subscription(
+        self, devices, subscribe_to_topic, django_assert_num_queries
+    ):
+        with django_assert_num_queries(1):
+            FCMDevice.objects.handle_topic_subscription(True, "news")
+
+    def test_device_send_message(self, fcm_device, django_assert_num_queries):
+        with django_assert_num_queries(0):
+            fcm_device.send_message(Message())
+
+    def test_device_handle_topic_subscription(
+        self, devices, subscribe_to_topic, django_assert_num_queries
+    ):
+        with django_assert_num_queries(0):
+            devices[1].handle_topic_subscription(True, "news")
+
+
+@pytest.mark.django_db
+class TestDeactivateQueryBudget:
+    def test_deactivate(self, devices, django_assert_num_queries):
+        # the deactivated rows are selected for the return value and the
+        # device_deactivated signal, then updated at once
+        with django_assert_num_queries(2):
+            FCMDevice.objects.deactivate(reason="test", source="test")
+
+    def test_deactivate_nothing(self, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            FCMDevice.objects.deactivate(reason="test", source="test")
+
+    def test_deactivate_devices_with_error_results(
+        self, devices, django_assert_num_queries
+    ):
+        with django_assert_num_queries(2):
+            FCMDevice.objects.deactivate_devices_with_error_results(
+                [device.registration_id for device in devices],
+                [_unregistered()] * len(devices),
+            )
+
+    def test_deactivate_devices_without_errors(
+        self, devices, django_assert_num_queries
+    ):
+        with django_assert_num_queries(0):
+            FCMDevice.objects.deactivate_devices_with_error_results(
+                [device.registration_id for device in devices],
+                [_ok()] * len(devices),
+            )
+
+
+@pytest.fixture
+def base_admin_url(settings) -> str:
+    if settings.IS_SWAP:
+        return "/admin/swapped_models/customdevice/"
+    else:
+        return "/admin/fcm_django/fcmdevice/"
+
+
+@pytest.mark.django_db
+class TestAdminActionQueryBudget:
+    @pytest.fixture(autouse=True)
+    def _login_as_admin(self, client, admin_user) -> None:
+        client.force_login(admin_user)
+
+    def post_action(self, client, base_admin_url, action, devices):
+        return client.post(
+            base_admin_url,
+            {
+                "action": action,
+                "_selected_action": [str(device.pk) for device in devices],
+            },
+        )
+
+    # session, user and the two changelist counts come first (4 queries)
+    @pytest.mark.parametrize(
+        "action,num_queries",
+        [
+            ("send_message", 5),
+            # registration IDs, then SELECT and UPDATE deactivating token-0
+            ("send_bulk_message", 7),
+            ("subscribe_to_topic", 5),
+            ("bulk_subscribe_to_topic", 5),
+            ("send_topic_message", 4),
+            ("enable", 5),
+            ("disable", 6),
+        ],
+    )
+    def test_action(
+        self,
+        client,
+        base_admin_url,
+        devices,
+        send_each,
+        subscribe_to_topic,
+        mock_firebase_send,
+        action,
+        num_queries,
+        django_assert_num_queries,
+    ):
+        with django_assert_num_queries(num_queries):
+            response = self.post_action(client, base_admin_url, action, devices)
+        assert response.status_code == 302